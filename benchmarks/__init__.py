@@ -0,0 +1,9 @@
+"""
+Micro benchmarks. Run one with::
+
+    PYTHONPATH=src python -m benchmarks.bench_token_handler
+
+Results are printed as JSON and compared with the stored baseline in
+benchmarks/baseline. Baselines are machine specific, regenerate them with
+--save-baseline on the machine the comparison is done on.
+"""
@@ -0,0 +1,48 @@
+"""
+Compare the buffered identifier generator with the one it replaced.
+
+Usage::
+
+    python -m benchmarks.bench_rndstr [--output FILE] [--save-baseline]
+"""
+import hashlib
+import random
+import string
+import sys
+
+from benchmarks.common import main
+from benchmarks.common import measure
+from oidcendpoint import rndstr
+from oidcendpoint.token_handler import DefaultToken
+
+_basech = string.ascii_letters + string.digits
+_sysrnd = random.SystemRandom()
+
+
+def old_rndstr(size=16):
+    return "".join([_sysrnd.choice(_basech) for _ in range(size)])
+
+
+def old_key():
+    csum = hashlib.new('sha224')
+    csum.update(old_rndstr(32).encode('utf-8'))
+    return csum.hexdigest()
+
+
+def run(quick=False, number=20000):
+    _token = DefaultToken('password', typ='A')
+    cases = [
+        ('rndstr(16)', lambda: old_rndstr(16), lambda: rndstr(16)),
+        ('rndstr(32)', lambda: old_rndstr(32), lambda: rndstr(32)),
+        ('DefaultToken.key', old_key, _token.key),
+    ]
+
+    res = {}
+    for name, old, new in cases:
+        res['old/' + name] = measure(old, number)
+        res['new/' + name] = measure(new, number)
+    return res
+
+
+if __name__ == '__main__':
+    sys.exit(main('rndstr', run))
@@ -0,0 +1,86 @@
+"""
+Micro benchmarks for reading and writing session information.
+
+Usage::
+
+    python -m benchmarks.bench_session [--output FILE] [--baseline FILE]
+        [--save-baseline] [--tolerance 0.25]
+
+Every case is run against a store keeping SessionInfo instances and one
+keeping JSON documents.
+"""
+import sys
+
+from oidcmsg.oidc import AuthorizationRequest
+
+from benchmarks.common import main
+from benchmarks.common import measure
+from oidcendpoint.authn_event import create_authn_event
+from oidcendpoint.in_memory_db import InMemoryDataBase
+from oidcendpoint.session import SessionDB
+from oidcendpoint.sso_db import SSODb
+from oidcendpoint.token_handler import factory
+
+AREQ = AuthorizationRequest(
+    response_type='code', client_id='client_1',
+    redirect_uri='https://example.com/cb', scope=['openid', 'email'],
+    state='state000', nonce='nonce000')
+
+
+class JSONDataBase(InMemoryDataBase):
+    native = False
+
+
+STORES = {'native': InMemoryDataBase, 'json': JSONDataBase}
+
+
+def session_db(store):
+    sdb = SessionDB(store(), factory('password'), SSODb())
+    sid = sdb.create_authz_session(create_authn_event('uid', 'salt'), AREQ,
+                                   client_id='client_1')
+    sdb.do_sub(sid, 'client_salt')
+    sdb.upgrade_to_token(key=sid, issue_refresh=True)
+    return sdb, sid
+
+
+def user_sessions(store, clients=10, per_client=5):
+    """ One user with several sessions with each of a number of clients """
+    sdb = SessionDB(store(), factory('password'), SSODb())
+    for n in range(per_client):
+        for i in range(clients):
+            _client_id = 'client_{}'.format(i)
+            _areq = AREQ.copy()
+            _areq['client_id'] = _client_id
+            sid = sdb.create_authz_session(create_authn_event('uid', 'salt'),
+                                           _areq, client_id=_client_id)
+            sdb.do_sub(sid, 'client_salt')
+    return sdb
+
+
+def run(quick=False, number=2000):
+    res = {}
+    for name, store in STORES.items():
+        sdb, sid = session_db(store)
+        _info = sdb[sid]
+        _token = _info['access_token']
+
+        res['{}/get'.format(name)] = measure(lambda: sdb[sid], number)
+        res['{}/set'.format(name)] = measure(
+            lambda: sdb.__setitem__(sid, _info), number)
+        res['{}/update'.format(name)] = measure(
+            lambda: sdb.update(sid, state='x'), number)
+        res['{}/read_by_token'.format(name)] = measure(
+            lambda: sdb.read(_token), number)
+        res['{}/is_token_valid'.format(name)] = measure(
+            lambda: sdb.is_token_valid(_token), number)
+
+        sdb = user_sessions(store)
+        res['{}/match_session'.format(name)] = measure(
+            lambda: sdb.match_session('uid', client_id='client_7'), number)
+        res['{}/match_session_miss'.format(name)] = measure(
+            lambda: sdb.match_session('uid', client_id='other'), number)
+    return res
+
+
+if __name__ == '__main__':
+    sys.exit(main('session', run))
@@ -0,0 +1,71 @@
+"""
+Storage needed per session with the different session codecs.
+
+Usage::
+
+    python -m benchmarks.bench_session_size [--output FILE]
+        [--baseline FILE] [--save-baseline] [--tolerance 0.25]
+
+Sessions for a number of clients are created and upgraded to tokens. The
+result is the number of bytes stored per session, for the compact codec
+including the share of the values stored by reference.
+"""
+import sys
+
+from oidcmsg.oidc import AuthorizationRequest
+
+from benchmarks.common import main
+from oidcendpoint.authn_event import create_authn_event
+from oidcendpoint.in_memory_db import InMemoryDataBase
+from oidcendpoint.session import SessionDB
+from oidcendpoint.session_codec import CompactCodec
+from oidcendpoint.session_codec import JSONCodec
+from oidcendpoint.sso_db import SSODb
+from oidcendpoint.token_handler import factory
+
+CLAIMS = {'userinfo': {'email': {'essential': True}, 'phone_number': None},
+          'id_token': {'auth_time': {'essential': True}}}
+
+
+class SerializingDataBase(InMemoryDataBase):
+    native = False
+
+
+def authn_req(client_id, n):
+    return AuthorizationRequest(
+        response_type='code', client_id=client_id,
+        redirect_uri='https://{}.example.com/authz/callback'.format(client_id),
+        scope=['openid', 'email', 'profile', 'phone'], claims=CLAIMS,
+        state='state{}'.format(n), nonce='nonce{}'.format(n))
+
+
+def stored_bytes(db):
+    return sum(len(v) for v in db.db.values())
+
+
+def run(quick=False, sessions=1000, clients=10):
+    if quick:
+        sessions = 200
+
+    res = {}
+    _handler = factory('password')
+    for name, codec in [('json', JSONCodec()), ('compact', CompactCodec())]:
+        _db = SerializingDataBase()
+        sdb = SessionDB(_db, _handler, SSODb(), codec=codec)
+        for n in range(sessions):
+            _client_id = 'client_{}'.format(n % clients)
+            sid = sdb.create_authz_session(
+                create_authn_event('uid{}'.format(n), 'salt'),
+                authn_req(_client_id, n), client_id=_client_id)
+            sdb.do_sub(sid, 'client_salt')
+            sdb.upgrade_to_token(key=sid, issue_refresh=True)
+
+        _bytes = stored_bytes(_db)
+        if isinstance(codec, CompactCodec):
+            _bytes += stored_bytes(codec.refs)
+        res['{}/bytes_per_session'.format(name)] = _bytes / sessions
+    return res
+
+
+if __name__ == '__main__':
+    sys.exit(main('session_size', run, unit='bytes/session'))
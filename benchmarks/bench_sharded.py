@@ -0,0 +1,59 @@
+"""
+Throughput of a sharded store used by several threads, by number of
+shards. The cost is the wall clock time per operation, a write and a read
+of a session sized value, over all the threads.
+
+Usage::
+
+    python -m benchmarks.bench_sharded [--output FILE] [--baseline FILE]
+        [--save-baseline] [--tolerance 0.25]
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+from benchmarks.bench_thread_safe import per_op
+from benchmarks.common import main
+from oidcendpoint.in_memory_db import InMemoryDataBase
+from oidcendpoint.sharded_db import ShardedDataBase
+from oidcendpoint.sqlite_db import SQLiteDataBase
+
+SHARDS = [1, 2, 4, 8]
+THREADS = 8
+VALUE = 'x' * 1000
+
+
+def _op(db):
+    def op(n, i):
+        _key = 'sid {} {}'.format(n, i % 200)
+        db.set(_key, VALUE, ttl=600)
+        db.get(_key)
+    return op
+
+
+def run(quick=False, number=1000):
+    res = {}
+    for shards in SHARDS:
+        db = ShardedDataBase(
+            {str(i): InMemoryDataBase() for i in range(shards)})
+        res['memory/{}'.format(shards)] = per_op(_op(db), THREADS, number)
+
+    if quick:
+        return res
+
+    for shards in SHARDS:
+        _dir = tempfile.mkdtemp()
+        try:
+            db = ShardedDataBase(
+                {str(i): SQLiteDataBase(os.path.join(_dir, str(i)))
+                 for i in range(shards)})
+            res['sqlite/{}'.format(shards)] = per_op(_op(db), THREADS,
+                                                     number // 4)
+        finally:
+            shutil.rmtree(_dir)
+    return res
+
+
+if __name__ == '__main__':
+    sys.exit(main('sharded', run))
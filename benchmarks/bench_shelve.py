@@ -0,0 +1,48 @@
+"""
+Micro benchmarks for the shelve backed client database.
+
+Usage::
+
+    python -m benchmarks.bench_shelve [--output FILE] [--baseline FILE]
+        [--save-baseline] [--tolerance 0.25]
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+from benchmarks.common import main
+from benchmarks.common import measure
+from oidcendpoint import shelve_wrapper
+
+CLIENT_INFO = {
+    'client_secret': 'a longer secret than this',
+    'redirect_uris': [('https://example.com/cb', {})],
+    'response_types': ['code'],
+    'token_endpoint_auth_method': 'client_secret_basic'
+}
+
+
+def run(quick=False, number=500):
+    res = {}
+    _dir = tempfile.mkdtemp()
+    try:
+        cdb = shelve_wrapper.open(os.path.join(_dir, 'cdb'))
+        for i in range(100):
+            cdb['client_{}'.format(i)] = CLIENT_INFO
+
+        res['get'] = measure(lambda: cdb['client_42'], number)
+        res['contains'] = measure(lambda: 'client_42' in cdb, number)
+        res['set'] = measure(
+            lambda: cdb.__setitem__('client_42', CLIENT_INFO), number)
+        cdb.sync_every = 100
+        res['set_batched'] = measure(
+            lambda: cdb.__setitem__('client_42', CLIENT_INFO), number)
+        cdb.close()
+    finally:
+        shutil.rmtree(_dir)
+    return res
+
+
+if __name__ == '__main__':
+    sys.exit(main('shelve', run))
@@ -0,0 +1,92 @@
+"""
+Throughput of the SSO and session databases used by several threads, with
+one lock for the whole SSODb and with per key locks, see
+oidcendpoint.thread_safe. The cost is the wall clock time per operation
+over all the threads, so a case that scales with the number of threads
+gets cheaper as threads are added.
+
+Usage::
+
+    python -m benchmarks.bench_thread_safe [--output FILE] [--baseline FILE]
+        [--save-baseline] [--tolerance 0.25]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.common import main
+from oidcendpoint import token_handler
+from oidcendpoint.authn_event import create_authn_event
+from oidcendpoint.in_memory_db import InMemoryDataBase
+from oidcendpoint.session import SessionDB
+from oidcendpoint.sqlite_db import SQLiteDataBase
+from oidcendpoint.sso_db import SSODb
+from oidcendpoint.thread_safe import ThreadSafeDataBase
+from oidcmsg.oidc import AuthorizationRequest
+
+AREQ = AuthorizationRequest(response_type="code", client_id="client1",
+                            redirect_uri="http://example.com/authz",
+                            scope=["openid"], state="state000")
+
+THREADS = [1, 2, 4, 8]
+
+
+def per_op(func, threads, number):
+    """
+    Run func(thread number, op number) number times in each of a number of
+    threads.
+
+    :return: Microseconds per operation, over all the threads
+    """
+
+    def work(n):
+        for i in range(number):
+            func(n, i)
+
+    _threads = [threading.Thread(target=work, args=(n,))
+                for n in range(threads)]
+    _start = time.perf_counter()
+    for thread in _threads:
+        thread.start()
+    for thread in _threads:
+        thread.join()
+    return (time.perf_counter() - _start) / (threads * number) * 1e6
+
+
+def run(quick=False, number=2000):
+    res = {}
+    for threads in THREADS:
+        for name, db in [('global', InMemoryDataBase()),
+                         ('striped', ThreadSafeDataBase(InMemoryDataBase()))]:
+            sso_db = SSODb(db)
+            res['sso/{}/{}'.format(name, threads)] = per_op(
+                lambda n, i: sso_db.map_sid('sid {} {}'.format(n, i),
+                                            uid='uid {}'.format(i % 100),
+                                            sub='sub {}'.format(i % 100)),
+                threads, number)
+
+    if quick:
+        return res
+
+    _dir = tempfile.mkdtemp()
+    try:
+        sdb = SessionDB(
+            ThreadSafeDataBase(SQLiteDataBase(os.path.join(_dir, 'sdb'))),
+            token_handler.factory('losenord'), SSODb())
+        _sids = [sdb.create_authz_session(create_authn_event('uid', 'salt'),
+                                          AREQ, client_id='client1')
+                 for _ in range(max(THREADS))]
+        for threads in THREADS:
+            res['session_update/sqlite/{}'.format(threads)] = per_op(
+                lambda n, i: sdb.update(_sids[n], counter=i), threads,
+                number // 4)
+    finally:
+        shutil.rmtree(_dir)
+    return res
+
+
+if __name__ == '__main__':
+    sys.exit(main('thread_safe', run))
@@ -0,0 +1,96 @@
+"""
+Micro benchmarks for minting and verifying tokens.
+
+Usage::
+
+    python -m benchmarks.bench_token_handler [--quick] [--output FILE]
+        [--baseline FILE] [--save-baseline] [--tolerance 0.25]
+
+--quick skips the black list with 1M entries.
+"""
+import sys
+import time
+
+from benchmarks.common import main
+from benchmarks.common import measure
+from oidcendpoint.token_handler import factory
+from oidcendpoint.token_handler import lv_pack
+from oidcendpoint.token_handler import lv_unpack
+
+PASSWORD = 'The longer the better. Is this close to enough ?'
+SID = 'a1b2c3d4' * 7
+TYPES = {'A': 'code', 'T': 'access_token', 'R': 'refresh_token'}
+
+
+def _call(func, *args):
+    """ Call a function that is expected to fail """
+    def _func():
+        try:
+            func(*args)
+        except KeyError:
+            pass
+    return _func
+
+
+def fill_black_list(handler, size):
+    _exp = int(time.time()) + 86400
+    for i in range(size):
+        handler.blist.add('revoked.{}'.format(i), _exp)
+
+
+def run(quick=False, number=2000):
+    res = {}
+
+    _txt = lv_pack('x' * 32, 'T', SID, '1546300800')
+    res['lv_pack'] = measure(lambda: lv_pack('x' * 32, 'T', SID, '1546300800'),
+                             number * 10)
+    res['lv_unpack'] = measure(lambda: lv_unpack(_txt), number * 10)
+
+    for fmt in ['fernet', 'aead']:
+        th = factory(PASSWORD, token_format=fmt)
+        for typ, name in TYPES.items():
+            _handler = th[name]
+            _token = _handler(SID)
+            res['{}/mint/{}'.format(fmt, typ)] = measure(
+                lambda: _handler(SID), number)
+            res['{}/handler_info/{}'.format(fmt, typ)] = measure(
+                lambda: _handler.info(_token), number)
+            res['{}/token_handler_info/{}'.format(fmt, typ)] = measure(
+                lambda: th.info(_token), number)
+
+        _token = th['refresh_token'](SID)
+        # A token of another type
+        res['{}/miss/wrong_type'.format(fmt)] = measure(
+            _call(th.info, _token, ['code', 'access_token']), number)
+        # Garbage with and without an envelope
+        res['{}/miss/invalid_tagged'.format(fmt)] = measure(
+            _call(th.info, 'T.00000000.' + 'A' * 120), number)
+        res['{}/miss/invalid'.format(fmt)] = measure(
+            _call(th.info, 'A' * 160), number)
+
+        cached = factory(PASSWORD, token_format=fmt, cache_size=1024)
+        _token = cached['access_token'](SID)
+        res['{}/token_handler_info_cached/T'.format(fmt)] = measure(
+            lambda: cached.info(_token), number)
+
+    sizes = [0, 10000] if quick else [0, 10000, 1000000]
+    th = factory(PASSWORD)
+    _handler = th['access_token']
+    _token = _handler(SID)
+    _filled = 0
+    for size in sizes:
+        fill_black_list(_handler, size - _filled)
+        _filled = size
+        res['black_list/{}/miss'.format(size)] = measure(
+            lambda: _handler.is_black_listed(_token), number * 10)
+        res['black_list/{}/token_handler'.format(size)] = measure(
+            lambda: th.is_black_listed(_token), number * 10)
+        _handler.blist.add('revoked.x', int(time.time()) + 86400)
+        res['black_list/{}/hit'.format(size)] = measure(
+            lambda: _handler.is_black_listed('revoked.x'), number * 10)
+
+    return res
+
+
+if __name__ == '__main__':
+    sys.exit(main('token_handler', run))
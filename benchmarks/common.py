@@ -0,0 +1,110 @@
+"""
+Helpers shared by the benchmarks.
+
+Every benchmark module has a run() function returning a dictionary that
+maps a case name to a cost, by default the time per operation in
+microseconds. main() adds a command line interface that writes the result
+as JSON and compares it with a stored baseline.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'baseline')
+
+
+def measure(func, number=1000, repeat=5):
+    """
+    Time a function.
+
+    :param func: Function without arguments
+    :param number: Number of calls per round
+    :param repeat: Number of rounds, the best one is used
+    :return: Microseconds per call
+    """
+    _timer = timeit.Timer(func)
+    return min(_timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def compare(result, baseline, tolerance=0.25):
+    """
+    Compare a result with a baseline.
+
+    :param result: Dictionary with case name and microseconds per call
+    :param baseline: A result from an earlier run
+    :param tolerance: How much slower, as a fraction, a case may be
+    :return: Dictionary of the regressed cases with the times before and
+        after
+    """
+    regressions = {}
+    for name, usec in result.items():
+        try:
+            _base = baseline[name]
+        except KeyError:
+            continue
+        if usec > _base * (1 + tolerance):
+            regressions[name] = {'baseline': _base, 'result': usec}
+    return regressions
+
+
+def main(name, run, argv=None, unit='usec/op'):
+    """
+    Command line interface for a benchmark module.
+
+    :param name: Name of the benchmark, used for the baseline file name
+    :param run: The run function, it is given the 'quick' flag
+    :param argv: Command line arguments
+    :param unit: What the numbers in the result are, lower is better
+    :return: Exit code, 1 if there are regressions
+    """
+    parser = argparse.ArgumentParser(description='Benchmark {}'.format(name))
+    parser.add_argument('--quick', action='store_true',
+                        help='Skip the slowest cases')
+    parser.add_argument('--output', help='Write the result to this file')
+    parser.add_argument(
+        '--baseline', default=os.path.join(BASELINE_DIR, name + '.json'),
+        help='Baseline to compare with')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store the result as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown as a fraction')
+    args = parser.parse_args(argv)
+
+    result = run(quick=args.quick)
+    doc = {
+        'benchmark': name,
+        'python': platform.python_version(),
+        'unit': unit,
+        'result': result
+    }
+    _json = json.dumps(doc, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(_json)
+    else:
+        print(_json)
+
+    if args.save_baseline:
+        _dir = os.path.dirname(args.baseline)
+        if _dir and not os.path.isdir(_dir):
+            os.makedirs(_dir)
+        with open(args.baseline, 'w') as fp:
+            fp.write(_json)
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        return 0
+
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)['result']
+
+    regressions = compare(result, baseline, args.tolerance)
+    for case, val in sorted(regressions.items()):
+        sys.stderr.write('REGRESSION {}: {:.2f} -> {:.2f} {}\n'.format(
+            case, val['baseline'], val['result'], unit))
+    return 1 if regressions else 0
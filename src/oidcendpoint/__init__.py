@@ -1,9 +1,6 @@
+import os
 import string
-# Since SystemRandom is not available on all systems
-try:
-    import random.SystemRandom as rnd
-except ImportError:
-    import random as rnd
+import threading
 
 __version__ = '0.5.0'
 
@@ -27,6 +24,54 @@ def sanitize(str):
     return str
 
 
+BASECH = string.ascii_letters + string.digits
+
+# Byte values are mapped onto BASECH. The values at and above _LIMIT are
+# dropped, otherwise the first characters would be more likely than the rest.
+_LIMIT = 256 - 256 % len(BASECH)
+_TABLE = bytes(ord(BASECH[i % len(BASECH)]) for i in range(256))
+_DROP = bytes(range(_LIMIT, 256))
+
+
+class RandomPool(object):
+    """
+    Buffered source of cryptographically secure random bytes. Reads
+    os.urandom in large chunks instead of once per identifier.
+    The buffer is thrown away in a forked child so that processes never
+    share random values.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self._buf = b''
+        self._pos = 0
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def read(self, n):
+        with self._lock:
+            if self._pos + n > len(self._buf) or self._pid != os.getpid():
+                self._buf = os.urandom(max(self.size, n))
+                self._pos = 0
+                self._pid = os.getpid()
+            res = self._buf[self._pos:self._pos + n]
+            self._pos += n
+        return res
+
+
+_pool = RandomPool()
+
+
+def random_bytes(size):
+    """
+    Returns cryptographically secure random bytes
+
+    :param size: Number of bytes
+    :return: bytes
+    """
+    return _pool.read(size)
+
+
 def rndstr(size=16):
     """
     Returns a string of random ascii characters or digits
@@ -34,5 +79,10 @@ def rndstr(size=16):
     :param size: The length of the string
     :return: string
     """
-    _basech = string.ascii_letters + string.digits
-    return "".join([rnd.choice(_basech) for _ in range(size)])
+    res = b''
+    while len(res) < size:
+        _need = size - len(res)
+        # About 3% of the bytes are dropped, ask for a little more
+        _raw = _pool.read(_need + (_need >> 4) + 2)
+        res += _raw.translate(_TABLE, _DROP)
+    return res[:size].decode('ascii')
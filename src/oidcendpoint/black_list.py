@@ -0,0 +1,207 @@
+import hashlib
+import heapq
+import os
+import sqlite3
+import threading
+
+from oidcmsg.time_util import time_sans_frac
+
+__author__ = 'Roland Hedberg'
+
+
+class BlackList(object):
+    """
+    Keeps track of revoked tokens.
+
+    Membership tests are O(1). Every token is stored together with its
+    expiration time and since an expired token is never accepted anyway the
+    entry can be dropped once the token has expired. Expired entries are
+    removed incrementally, at most *sweep* of them per operation, so the
+    size of the list follows the number of live tokens.
+    """
+
+    def __init__(self, tokens=None, sweep=16):
+        self._exp = {}
+        self._heap = []
+        self.sweep = sweep
+        if tokens:
+            for token in tokens:
+                self.add(token)
+
+    def add(self, token, exp=-1):
+        """
+        Add a token to the black list.
+
+        :param token: The token
+        :param exp: When the token expires, -1 means never
+        """
+        self.prune()
+        self._exp[token] = exp
+        if exp >= 0:
+            heapq.heappush(self._heap, (exp, token))
+
+    def add_many(self, items):
+        """
+        Add several tokens.
+
+        :param items: iterable of (token, exp) tuples
+        """
+        for token, exp in items:
+            self.add(token, exp)
+
+    def append(self, token):
+        self.add(token)
+
+    def __contains__(self, token):
+        self.prune()
+        return token in self._exp
+
+    def __len__(self):
+        return len(self._exp)
+
+    def __iter__(self):
+        return iter(list(self._exp.keys()))
+
+    def discard(self, token):
+        try:
+            del self._exp[token]
+        except KeyError:
+            pass
+
+    def prune(self, when=0, limit=None):
+        """
+        Remove entries for tokens that have expired.
+
+        :param when: Point in time to compare with, default is now
+        :param limit: Max number of entries to look at, default is
+            self.sweep. 0 means no limit.
+        :return: Number of entries removed
+        """
+        if not self._heap:
+            return 0
+
+        if not when:
+            when = time_sans_frac()
+        if limit is None:
+            limit = self.sweep
+
+        n = 0
+        while self._heap and self._heap[0][0] < when:
+            exp, token = heapq.heappop(self._heap)
+            # The token may have been re-added with another expiration time
+            if self._exp.get(token) == exp:
+                del self._exp[token]
+            n += 1
+            if limit and n >= limit:
+                break
+        return n
+
+
+class SQLiteBlackList(object):
+    """
+    A black list kept in a SQLite database, so it can be shared by all the
+    worker processes on a host. The database runs in WAL mode which lets
+    readers go on while a token is added.
+
+    Tokens are stored as SHA-256 digests, lookups and inserts use the
+    primary key index. Expired entries are removed every *sweep* inserts.
+    """
+
+    def __init__(self, filename, sweep=1000, timeout=10.0):
+        self.filename = filename
+        self.sweep = sweep
+        self.timeout = timeout
+        self._local = threading.local()
+        self._inserts = 0
+        self._con().executescript(
+            'CREATE TABLE IF NOT EXISTS black_list ('
+            ' token BLOB PRIMARY KEY, exp INTEGER NOT NULL'
+            ') WITHOUT ROWID;'
+            'CREATE INDEX IF NOT EXISTS black_list_exp ON black_list (exp);')
+
+    def _con(self):
+        """
+        One connection per thread and process, a connection must not be
+        used in a forked child.
+        """
+        _pid = os.getpid()
+        if getattr(self._local, 'pid', None) != _pid:
+            con = sqlite3.connect(self.filename, timeout=self.timeout)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            self._local.con = con
+            self._local.pid = _pid
+        return self._local.con
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def add(self, token, exp=-1):
+        """
+        Add a token to the black list.
+
+        :param token: The token
+        :param exp: When the token expires, -1 means never
+        """
+        self.add_many([(token, exp)])
+
+    def add_many(self, items):
+        """
+        Add several tokens in one transaction.
+
+        :param items: iterable of (token, exp) tuples
+        """
+        _rows = [(self._digest(token), exp) for token, exp in items]
+        if not _rows:
+            return
+
+        with self._con() as con:
+            con.executemany(
+                'INSERT OR REPLACE INTO black_list (token, exp) VALUES (?, ?)',
+                _rows)
+
+        self._inserts += len(_rows)
+        if self._inserts >= self.sweep:
+            self._inserts = 0
+            self.prune()
+
+    def append(self, token):
+        self.add(token)
+
+    def __contains__(self, token):
+        _row = self._con().execute(
+            'SELECT 1 FROM black_list WHERE token = ?',
+            (self._digest(token),)).fetchone()
+        return _row is not None
+
+    def __len__(self):
+        return self._con().execute(
+            'SELECT COUNT(*) FROM black_list').fetchone()[0]
+
+    def discard(self, token):
+        with self._con() as con:
+            con.execute('DELETE FROM black_list WHERE token = ?',
+                        (self._digest(token),))
+
+    def prune(self, when=0, limit=None):
+        """
+        Remove entries for tokens that have expired.
+
+        :param when: Point in time to compare with, default is now
+        :param limit: Not used, all expired entries are removed
+        :return: Number of entries removed
+        """
+        if not when:
+            when = time_sans_frac()
+        with self._con() as con:
+            _cur = con.execute(
+                'DELETE FROM black_list WHERE exp >= 0 AND exp < ?', (when,))
+        return _cur.rowcount
+
+    def close(self):
+        try:
+            self._local.con.close()
+        except AttributeError:
+            pass
+        self._local = threading.local()
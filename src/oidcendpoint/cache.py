@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+
+__author__ = 'Roland Hedberg'
+
+
+class LRUCache(object):
+    """
+    A size and time bounded cache. When full the least recently used entry
+    is thrown out. Entries older than *ttl* seconds are never returned.
+    """
+
+    def __init__(self, maxsize=1024, ttl=0):
+        """
+        :param maxsize: Max number of entries in the cache
+        :param ttl: Max age of an entry in seconds, 0 means no limit
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value, timestamp = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if self.ttl and timestamp + self.ttl < time.time():
+            self.delete(key)
+            self.misses += 1
+            return default
+
+        try:
+            self._data.move_to_end(key)
+        except KeyError:  # Removed by someone else
+            pass
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (value, time.time())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            try:
+                self._data.popitem(last=False)
+            except KeyError:
+                break
+
+    def delete(self, key):
+        try:
+            del self._data[key]
+        except KeyError:
+            pass
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """
+        :return: Dictionary with cache statistics
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
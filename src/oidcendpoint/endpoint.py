@@ -1,3 +1,4 @@
+import functools
 import logging
 
 from urllib.parse import urlparse
@@ -36,6 +37,29 @@ do_response
 """
 
 
+def session_unit_of_work(func):
+    """
+    Decorator for Endpoint methods. The method is run within a unit of work
+    on the session database, so sessions are read from the database once
+    and written back once. Afterwards the session garbage collector, if
+    there is one, gets a chance to run.
+    """
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        _sdb = self.endpoint_context.sdb
+        with _sdb.unit_of_work():
+            res = func(self, *args, **kwargs)
+
+        # Once the changes are written, not within an outer unit of work
+        _gc = getattr(_sdb, 'gc', None)
+        if _gc is not None and _sdb.current_unit_of_work() is None:
+            _gc.tick()
+        return res
+
+    return wrapper
+
+
 def set_content_type(headers, content_type):
     if ('Content-type', content_type) in headers:
         return headers
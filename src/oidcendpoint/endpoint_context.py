@@ -16,6 +16,7 @@ from oidcendpoint import rndstr
 from oidcendpoint.client_authn import CLIENT_AUTHN_METHOD
 from oidcendpoint.exception import ConfigurationError
 from oidcendpoint.session import create_session_db
+from oidcendpoint.session_gc import SessionGC
 from oidcendpoint.sso_db import SSODb
 from oidcendpoint.user_authn import user
 from oidcendpoint.user_authn.authn_context import AuthnBroker
@@ -83,12 +84,44 @@ class EndpointContext(object):
         if session_db:
             self.sdb = session_db
         else:
+            # Extra arguments to the token handler factory
+            try:
+                _th_args = dict(conf['token_handler'])
+            except KeyError:
+                _th_args = {}
+
+            # Self-contained access tokens are signed with my keys
+            if 'access_token' in _th_args:
+                _spec = dict(_th_args['access_token'])
+                _kwargs = dict(_spec.get('kwargs', {}))
+                _kwargs.setdefault('keyjar', self.keyjar)
+                _kwargs.setdefault('issuer', conf['issuer'])
+                _spec['kwargs'] = _kwargs
+                _th_args['access_token'] = _spec
+
+            # SSO connections are kept at least as long as a session can be
+            # in use, and longer if the session is, see SSODb.refresh
+            _sso_ttl = max(conf['token_expires_in'], conf['grant_expires_in'],
+                           conf['refresh_token_expires_in'],
+                           conf.get('sso_ttl', 14400))
+
             self.sdb = create_session_db(
                 conf['password'], db=None,
                 token_expires_in=conf['token_expires_in'],
                 grant_expires_in=conf['grant_expires_in'],
                 refresh_token_expires_in=conf['refresh_token_expires_in'],
-                sso_db=SSODb())
+                sso_db=SSODb(ttl=_sso_ttl), **_th_args)
+
+        # Removal of expired and revoked sessions
+        try:
+            _gc_conf = dict(conf['session_gc'])
+        except KeyError:
+            pass
+        else:
+            _background = _gc_conf.pop('background', False)
+            self.sdb.gc = SessionGC(self.sdb, **_gc_conf)
+            if _background:
+                self.sdb.gc.start()
 
         # client database
         self.cdb = client_db or {}
@@ -1,15 +1,300 @@
+import heapq
+import json
+import pickle
+import shelve
+import time
+from collections import OrderedDict
+
+
 class InMemoryDataBase(object):
-    def __init__(self):
+    """
+    A process local key-value store. Values are kept as they are, there is
+    no serialization, which is announced by the *native* attribute.
+
+    A value can be given a time to live. Expired values are never returned
+    and they are removed incrementally, at most *sweep* of them per write,
+    so the size of the store follows the number of live values.
+    """
+    native = True
+    supports_ttl = True
+
+    def __init__(self, sweep=16):
         self.db = {}
+        # key -> expiration time, only for keys with a time to live
+        self._exp = {}
+        self._heap = []
+        self.sweep = sweep
 
-    def set(self, key, value):
+    def set(self, key, value, ttl=0):
+        """
+        :param key: The key
+        :param value: The value
+        :param ttl: Time to live in seconds, 0 means forever
+        """
+        self.prune()
         self.db[key] = value
+        if ttl > 0:
+            _exp = time.time() + ttl
+            self._exp[key] = _exp
+            heapq.heappush(self._heap, (_exp, key))
+            # Values that are set again leave stale entries behind
+            if len(self._heap) > 2 * len(self._exp) + 64:
+                self._heap = [(e, k) for k, e in self._exp.items()]
+                heapq.heapify(self._heap)
+        else:
+            self._exp.pop(key, None)
 
     def get(self, key):
         try:
-            return self.db[key]
+            _val = self.db[key]
         except KeyError:
             return None
 
+        _exp = self._exp.get(key)
+        if _exp is not None and _exp < time.time():
+            self._remove(key)
+            return None
+        return _val
+
+    def get_many(self, keys):
+        """
+        :param keys: The keys
+        :return: Dictionary with the keys that have values and the values
+        """
+        res = {}
+        for key in keys:
+            _val = self.get(key)
+            if _val is not None:
+                res[key] = _val
+        return res
+
+    def set_many(self, items, ttl=0):
+        """
+        :param items: Iterable of (key, value) tuples
+        :param ttl: Time to live in seconds for all of them, 0 means forever
+        """
+        for key, value in items:
+            self.set(key, value, ttl)
+
     def delete(self, key):
         del self.db[key]
+        self._exp.pop(key, None)
+
+    def _remove(self, key):
+        try:
+            del self.db[key]
+        except KeyError:
+            pass
+        self._exp.pop(key, None)
+
+    def __len__(self):
+        return len(self.db)
+
+    def keys(self):
+        """
+        :return: List of the keys of values that have not expired
+        """
+        _now = time.time()
+        return [k for k in list(self.db) if self._exp.get(k, _now) >= _now]
+
+    def ttl(self, key):
+        """
+        :param key: The key
+        :return: Seconds left to live, 0 if the value lives forever
+        """
+        try:
+            return max(self._exp[key] - time.time(), 0)
+        except KeyError:
+            return 0
+
+    def set_fields(self, key, **kwargs):
+        """
+        Change some of the fields of a stored record, the rest of the record
+        is left as it is. So is the time to live.
+
+        :param key: The key of the record
+        :param kwargs: Field names and values
+        """
+        _val = self.db[key]
+        if isinstance(_val, str):  # A JSON document
+            _doc = json.loads(_val)
+            _doc.update(kwargs)
+            self.db[key] = json.dumps(_doc)
+        else:
+            _val.update(kwargs)
+
+    def prune(self, when=0, limit=None):
+        """
+        Remove values that have expired.
+
+        :param when: Point in time to compare with, default is now
+        :param limit: Max number of entries to look at, default is
+            self.sweep. 0 means no limit.
+        :return: Number of entries looked at
+        """
+        if not self._heap:
+            return 0
+
+        if not when:
+            when = time.time()
+        if limit is None:
+            limit = self.sweep
+
+        n = 0
+        while self._heap and self._heap[0][0] < when:
+            _exp, key = heapq.heappop(self._heap)
+            # The value may have been replaced, with another time to live
+            if self._exp.get(key) == _exp:
+                self._remove(key)
+            n += 1
+            if limit and n >= limit:
+                break
+        return n
+
+
+def sizeof(value):
+    """
+    Approximate size of a value in bytes.
+    """
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+class LRUDataBase(InMemoryDataBase):
+    """
+    An InMemoryDataBase with a ceiling on memory use. When there are more
+    than *max_entries* values in memory, or their combined size is above
+    *max_bytes*, the least recently used values are moved to an overflow
+    file. They are moved back into memory the next time they are used.
+
+    The overflow file is private to the instance and thereby to the
+    process, it is emptied when the instance is created.
+    """
+
+    def __init__(self, filename, max_entries=10000, max_bytes=0, sweep=16):
+        """
+        :param filename: Name of the overflow file
+        :param max_entries: Max number of values kept in memory, 0 means no
+            limit
+        :param max_bytes: Max combined size of the values kept in memory,
+            0 means no limit. The size of values other than strings is
+            found by pickling them, which adds to the cost of a write.
+        :param sweep: Max number of expired values removed per write
+        """
+        InMemoryDataBase.__init__(self, sweep=sweep)
+        self.db = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._size = {}
+        self._bytes = 0
+        self._spill = shelve.open(filename, flag='n')
+        self._spilled = set()
+
+    def set(self, key, value, ttl=0):
+        if key in self._spilled:
+            self._unspill(key)
+        InMemoryDataBase.set(self, key, value, ttl)
+        self.db.move_to_end(key)
+        self._account(key)
+        self._evict()
+
+    def get(self, key):
+        if key in self._spilled:
+            if not self._fault_in(key):
+                return None
+        elif key in self.db:
+            self.db.move_to_end(key)
+        return InMemoryDataBase.get(self, key)
+
+    def delete(self, key):
+        if key in self._spilled:
+            self._unspill(key)
+            self._exp.pop(key, None)
+        else:
+            InMemoryDataBase.delete(self, key)
+            self._forget_size(key)
+
+    def set_fields(self, key, **kwargs):
+        if key in self._spilled:
+            self._fault_in(key)
+        InMemoryDataBase.set_fields(self, key, **kwargs)
+        self._account(key)
+        self._evict()
+
+    def __len__(self):
+        return len(self.db) + len(self._spilled)
+
+    def keys(self):
+        _now = time.time()
+        return [k for k in list(self.db) + list(self._spilled)
+                if self._exp.get(k, _now) >= _now]
+
+    def in_memory(self, key):
+        return key in self.db
+
+    def close(self):
+        self._spill.close()
+
+    def _remove(self, key):
+        if key in self._spilled:
+            self._unspill(key)
+        else:
+            self._forget_size(key)
+        InMemoryDataBase._remove(self, key)
+
+    def _account(self, key):
+        """
+        Keep track of the size of a value that is in memory.
+        """
+        if self.max_bytes:
+            self._forget_size(key)
+            self._size[key] = sizeof(self.db[key])
+            self._bytes += self._size[key]
+
+    def _forget_size(self, key):
+        try:
+            self._bytes -= self._size.pop(key)
+        except KeyError:
+            pass
+
+    def _unspill(self, key):
+        self._spilled.discard(key)
+        try:
+            del self._spill[key]
+        except KeyError:
+            pass
+
+    def _fault_in(self, key):
+        """
+        Move a value from the overflow file to memory.
+
+        :return: True if the value was there
+        """
+        try:
+            _value = self._spill[key]
+        except KeyError:
+            self._spilled.discard(key)
+            return False
+
+        self._unspill(key)
+        self.db[key] = _value
+        self._account(key)
+        self._evict()
+        return True
+
+    def _over_budget(self):
+        if self.max_entries and len(self.db) > self.max_entries:
+            return True
+        return bool(self.max_bytes and self._bytes > self.max_bytes)
+
+    def _evict(self):
+        """
+        Move least recently used values to the overflow file until within
+        budget. The most recently used value always stays in memory.
+        """
+        while len(self.db) > 1 and self._over_budget():
+            key, value = self.db.popitem(last=False)
+            self._forget_size(key)
+            self._spill[key] = value
+            self._spilled.add(key)
@@ -22,6 +22,7 @@ from oidcservice.exception import InvalidRequest
 from oidcendpoint import sanitize
 from oidcendpoint.authn_event import create_authn_event
 from oidcendpoint.endpoint import Endpoint
+from oidcendpoint.endpoint import session_unit_of_work
 from oidcendpoint.exception import NoSuchAuthentication
 from oidcendpoint.exception import RedirectURIError
 from oidcendpoint.exception import TamperAllert
@@ -622,6 +623,7 @@ class Authorization(Endpoint):
 
         return response_info
 
+    @session_unit_of_work
     def authz_part2(self, user, authn_event, request, **kwargs):
         """
         After the authentication this is where you should end up
@@ -645,6 +647,7 @@ class Authorization(Endpoint):
 
         return resp_info
 
+    @session_unit_of_work
     def process_request(self, request=None, **kwargs):
         """ The AuthorizationRequest endpoint
 
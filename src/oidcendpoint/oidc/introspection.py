@@ -0,0 +1,142 @@
+import logging
+
+from oidcmsg.message import Message
+from oidcmsg.message import SINGLE_OPTIONAL_INT
+from oidcmsg.message import SINGLE_OPTIONAL_STRING
+from oidcmsg.message import SINGLE_REQUIRED_STRING
+from oidcmsg.oauth2 import ResponseMessage
+
+from oidcendpoint.cache import LRUCache
+from oidcendpoint.endpoint import Endpoint
+from oidcendpoint.endpoint import session_unit_of_work
+from oidcendpoint.token_handler import UnknownToken
+from oidcendpoint.token_handler import is_expired
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+
+class TokenIntrospectionRequest(Message):
+    c_param = {
+        'token': SINGLE_REQUIRED_STRING,
+        'token_type_hint': SINGLE_OPTIONAL_STRING,
+    }
+
+
+class TokenIntrospectionResponse(Message):
+    c_param = {
+        'active': (bool, True, None, None, False),
+        'scope': SINGLE_OPTIONAL_STRING,
+        'client_id': SINGLE_OPTIONAL_STRING,
+        'token_type': SINGLE_OPTIONAL_STRING,
+        'exp': SINGLE_OPTIONAL_INT,
+        'sub': SINGLE_OPTIONAL_STRING,
+        'iss': SINGLE_OPTIONAL_STRING,
+    }
+
+
+class Introspection(Endpoint):
+    """
+    Token introspection as described in RFC 7662.
+
+    If *cache_size* is given the result for an active token is kept in a
+    LRU cache. Expiration time and black listing are checked on every
+    request, a session that is revoked without black listing its tokens
+    may be reported as active for up to *cache_ttl* seconds.
+    """
+    request_cls = TokenIntrospectionRequest
+    response_cls = TokenIntrospectionResponse
+    request_format = 'urlencoded'
+    response_format = 'json'
+    response_placement = 'body'
+    endpoint_name = 'introspection_endpoint'
+
+    def __init__(self, endpoint_context, cache_size=0, cache_ttl=0,
+                 **kwargs):
+        Endpoint.__init__(self, endpoint_context, **kwargs)
+        if cache_size:
+            self.cache = LRUCache(cache_size, cache_ttl)
+        else:
+            self.cache = None
+
+    def _is_active(self, token, info):
+        if is_expired(info['exp']):
+            return False
+        return not self.endpoint_context.sdb.handler.is_black_listed(token)
+
+    def _introspect(self, token):
+        _sdb = self.endpoint_context.sdb
+
+        # Any kind of token is checked by its own handler, RFC 7662
+        # section 2.1, and the session it was issued in
+        try:
+            _tinfo = _sdb.handler.info(token)
+        except KeyError:
+            return None
+
+        _handler = _tinfo['handler']
+        # Codes are for the token endpoint only
+        if _handler is _sdb.handler['code']:
+            return None
+        if is_expired(int(_tinfo['exp'])) or _tinfo['black_listed']:
+            return None
+        try:
+            if _sdb.is_session_revoked(_tinfo['sid']):
+                return None
+        except UnknownToken:
+            return None
+
+        _info = {
+            'active': True,
+            'exp': int(_tinfo['exp']),
+            'token_type': _handler.token_type,
+            'iss': self.endpoint_context.issuer
+        }
+
+        if getattr(_handler, 'self_contained', False):
+            for claim in ['client_id', 'scope']:
+                if claim in _tinfo:
+                    _info[claim] = _tinfo[claim]
+        else:
+            _sinfo = _sdb[_tinfo['sid']]
+            _authn_req = _sinfo['authn_req']
+            _info['client_id'] = _authn_req['client_id']
+            _scope = _sinfo.get('access_token_scope', _authn_req.get('scope'))
+            if _scope:
+                if isinstance(_scope, list):
+                    _scope = ' '.join(_scope)
+                _info['scope'] = _scope
+            if 'sub' in _sinfo:
+                _info['sub'] = _sinfo['sub']
+
+        return _info
+
+    @session_unit_of_work
+    def process_request(self, request=None, **kwargs):
+        """
+
+        :param request: A TokenIntrospectionRequest instance
+        :return: Arguments for the do_response method
+        """
+        if isinstance(request, ResponseMessage) and 'error' in request:
+            return request
+
+        _token = request['token']
+
+        if self.cache is not None:
+            _info = self.cache.get(_token)
+            if _info is not None:
+                if self._is_active(_token, _info):
+                    return {'response_args': dict(_info)}
+                self.cache.delete(_token)
+                return {'response_args': {'active': False}}
+
+        _info = self._introspect(_token)
+        if _info is None:
+            return {'response_args': {'active': False}}
+
+        if self.cache is not None:
+            self.cache.set(_token, _info)
+
+        return {'response_args': dict(_info)}
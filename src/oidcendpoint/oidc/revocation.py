@@ -0,0 +1,88 @@
+import logging
+
+from oidcmsg.message import Message
+from oidcmsg.message import REQUIRED_LIST_OF_STRINGS
+from oidcmsg.message import SINGLE_OPTIONAL_STRING
+from oidcmsg.oauth2 import ResponseMessage
+
+from oidcendpoint.endpoint import Endpoint
+from oidcendpoint.endpoint import session_unit_of_work
+
+__author__ = 'Roland Hedberg'
+
+logger = logging.getLogger(__name__)
+
+
+class TokenRevocationRequest(Message):
+    """
+    RFC 7009 allows one token per request. Here 'token' may be repeated to
+    revoke several tokens in one call.
+    """
+    c_param = {
+        'token': REQUIRED_LIST_OF_STRINGS,
+        'token_type_hint': SINGLE_OPTIONAL_STRING,
+    }
+
+
+class Revocation(Endpoint):
+    """
+    Token revocation as described in RFC 7009. All the tokens in a request
+    are added to the black list in one batch.
+    """
+    request_cls = TokenRevocationRequest
+    response_cls = Message
+    request_format = 'urlencoded'
+    response_format = 'json'
+    response_placement = 'body'
+    endpoint_name = 'revocation_endpoint'
+
+    def _client_id(self, token):
+        """
+        :param token: A token
+        :return: The client the token was issued to or None if the token is
+            unknown.
+        """
+        _sdb = self.endpoint_context.sdb
+        try:
+            _tinfo = _sdb.handler.info(token)
+        except KeyError:
+            return None
+
+        if 'client_id' in _tinfo:
+            return _tinfo['client_id']
+
+        try:
+            return _sdb[_tinfo['sid']]['authn_req']['client_id']
+        except (KeyError, TypeError):
+            return None
+
+    @session_unit_of_work
+    def process_request(self, request=None, **kwargs):
+        """
+
+        :param request: A TokenRevocationRequest instance
+        :return: Arguments for the do_response method
+        """
+        if isinstance(request, ResponseMessage) and 'error' in request:
+            return request
+
+        _client_id = request.get('client_id')
+
+        # A client may only revoke its own tokens. Unknown tokens are
+        # ignored, as the RFC says.
+        _tokens = []
+        for token in request['token']:
+            _owner = self._client_id(token)
+            if _owner is None:
+                continue
+            if _client_id and _owner != _client_id:
+                logger.warning(
+                    '{} tried to revoke a token belonging to {}'.format(
+                        _client_id, _owner))
+                continue
+            _tokens.append(token)
+
+        self.endpoint_context.sdb.revoke_tokens(
+            _tokens, request.get('token_type_hint', ''))
+
+        return {'response_args': {}}
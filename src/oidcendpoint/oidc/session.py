@@ -15,6 +15,7 @@ from oidcmsg.oidc.session import EndSessionRequest
 from oidcendpoint import URL_ENCODED
 from oidcendpoint.client_authn import UnknownOrNoAuthnMethod
 from oidcendpoint.endpoint import Endpoint
+from oidcendpoint.endpoint import session_unit_of_work
 from oidcendpoint.util import OAUTH2_NOCACHE_HEADERS
 
 logger = logging.getLogger(__name__)
@@ -45,6 +46,7 @@ class Session(Endpoint):
 
         return {'response': response_args, 'http_headers': http_headers}
 
+    @session_unit_of_work
     def process_request(self, request=None, cookie=None, **kwargs):
         """
         Perform user logout
@@ -12,6 +12,7 @@ from oidcmsg.oidc import TokenErrorResponse
 from oidcendpoint import sanitize
 from oidcendpoint.client_authn import verify_client
 from oidcendpoint.endpoint import Endpoint
+from oidcendpoint.endpoint import session_unit_of_work
 from oidcendpoint.id_token import sign_encrypt_id_token
 from oidcendpoint.token_handler import AccessCodeUsed
 from oidcendpoint.token_handler import ExpiredToken
@@ -121,6 +122,9 @@ class AccessToken(Endpoint):
             _sdb.revoke_all_tokens(_access_code)
             return self.error_cls(error="access_denied",
                                   error_description="Access Code already used")
+        except ExpiredToken:
+            return self.error_cls(error="invalid_request",
+                                  error_description="Code is expired")
 
         if "openid" in _authn_req["scope"]:
             userinfo = userinfo_in_id_token_claims(_context, _info)
@@ -218,6 +222,7 @@ class AccessToken(Endpoint):
 
         return request
 
+    @session_unit_of_work
     def process_request(self, request=None, **kwargs):
         """
 
@@ -7,6 +7,7 @@ from oidcmsg.message import Message
 from oidcmsg.oauth2 import ResponseMessage
 
 from oidcendpoint.endpoint import Endpoint
+from oidcendpoint.endpoint import session_unit_of_work
 from oidcendpoint.userinfo import collect_user_info
 from oidcendpoint.util import OAUTH2_NOCACHE_HEADERS
 
@@ -67,6 +68,7 @@ class UserInfo(Endpoint):
 
         return {'response': resp, 'http_headers': http_headers}
 
+    @session_unit_of_work
     def process_request(self, request=None, **kwargs):
         _sdb = self.endpoint_context.sdb
 
@@ -1,6 +1,9 @@
 import copy
 import hashlib
+import heapq
 import json
+import threading
+import time
 
 from oidcendpoint.sso_db import SSODb
 
@@ -10,9 +13,12 @@ from oidcmsg.message import OPTIONAL_LIST_OF_STRINGS
 from oidcmsg.message import SINGLE_OPTIONAL_STRING
 from oidcmsg.message import SINGLE_REQUIRED_STRING
 from oidcmsg.oidc import AuthorizationRequest
+from oidcmsg.time_util import time_sans_frac
 
 from oidcendpoint import token_handler
 from oidcendpoint.authn_event import AuthnEvent
+from oidcendpoint.session_codec import JSONCodec
+from oidcendpoint.thread_safe import NO_LOCK
 from oidcendpoint.token_handler import ExpiredToken
 from oidcendpoint.token_handler import is_expired
 from oidcendpoint.token_handler import UnknownToken
@@ -45,6 +51,11 @@ SINGLE_REQUIRED_AUTHN_EVENT = (Message, True, msg_ser,
 
 
 class SessionInfo(Message):
+    """
+    The nested messages in *c_lazy* are kept as dictionaries, as they were
+    read, until they are used. One that is never used is serialized from
+    the dictionary as it is.
+    """
     c_param = {
         'oauth_state': SINGLE_REQUIRED_STRING,
         'code': SINGLE_OPTIONAL_STRING,
@@ -53,6 +64,116 @@ class SessionInfo(Message):
         'authn_event': SINGLE_REQUIRED_AUTHN_EVENT,
         'si_redirects': OPTIONAL_LIST_OF_STRINGS,
         }
+    c_lazy = ('authn_req', 'authn_event')
+    # Rebound, never changed in place, since copies share it
+    _lazy = frozenset()
+
+    def from_dict(self, dictionary, **kwargs):
+        _raw = None
+        for key in self.c_lazy:
+            if type(dictionary.get(key)) is dict:
+                if _raw is None:
+                    _raw = {}
+                _raw[key] = dictionary[key]
+
+        if _raw:
+            dictionary = {k: v for k, v in dictionary.items()
+                          if k not in _raw}
+
+        Message.from_dict(self, dictionary, **kwargs)
+
+        if _raw:
+            self._dict.update(_raw)
+            self._lazy = self._lazy.union(_raw)
+        return self
+
+    def _load(self, key):
+        self._lazy = self._lazy.difference([key])
+        _deser = self.c_param[key][3]
+        self._dict[key] = _deser(self._dict[key], sformat='dict')
+
+    def _load_all(self):
+        for key in self._lazy:
+            self._load(key)
+
+    def _set_lazy(self, key, value):
+        if type(value) is dict:
+            self._lazy = self._lazy.union([key])
+        else:
+            self._lazy = self._lazy.difference([key])
+
+    def __getitem__(self, item):
+        if item in self._lazy:
+            self._load(item)
+        return self._dict[item]
+
+    def __setitem__(self, key, value):
+        if key in self.c_lazy and type(value) is dict:
+            self._dict[key] = value
+        else:
+            Message.__setitem__(self, key, value)
+        if key in self.c_lazy:
+            self._set_lazy(key, value)
+
+    def __delitem__(self, key):
+        del self._dict[key]
+        self._lazy = self._lazy.difference([key])
+
+    def update(self, item, **kwargs):
+        # isinstance on Message, an ABC, is slow for other types
+        if type(item) is not dict:
+            if isinstance(item, Message):
+                item = item._dict
+            elif not isinstance(item, dict):
+                raise ValueError(
+                    "Can't update message using: '%s'" % (item,))
+        self._dict.update(item)
+        for key in self.c_lazy:
+            if key in item:
+                self._set_lazy(key, item[key])
+
+    def items(self):
+        self._load_all()
+        return Message.items(self)
+
+    def values(self):
+        self._load_all()
+        return Message.values(self)
+
+    def __eq__(self, other):
+        if isinstance(other, SessionInfo):
+            other._load_all()
+        self._load_all()
+        return Message.__eq__(self, other)
+
+
+IMMUTABLE = (str, int, float, bool, bytes, type(None))
+
+
+def copy_value(val):
+    """
+    Copy a value, Messages, dictionaries and lists are copied recursively.
+    Much faster than copy.deepcopy since strings and numbers, which is what
+    the containers hold, are immutable and can be shared.
+
+    :param val: The value to copy
+    :return: A copy of the value
+    """
+    _type = type(val)
+    if _type in IMMUTABLE:
+        return val
+    elif _type is list:
+        return [copy_value(v) for v in val]
+    elif _type is dict:
+        return {k: copy_value(v) for k, v in val.items()}
+    elif isinstance(val, Message):
+        # Bypass __init__, attributes other than _dict are shared
+        _msg = _type.__new__(_type)
+        _msg.__dict__.update(val.__dict__)
+        _msg._dict = {k: copy_value(v) for k, v in val._dict.items()}
+        return _msg
+    else:
+        return copy.deepcopy(val)
 
 
 def pairwise_id(sub, sector_identifier, seed):
@@ -95,35 +216,640 @@ def mint_sub(authn_event, client_salt, sector_id="", subject_type="public"):
     return sub
 
 
+class UnitOfWork(object):
+    """
+    Collects the session information read and written while a request is
+    handled. A session is read from the database at most once and changes
+    are written back once, when the unit of work ends. So are the writes
+    that follow from them, to the index, the SSO db and the black lists,
+    but for the black listing of a code that is used.
+    If it ends with an exception the changes are thrown away.
+
+    A session that was read is written back holding the lock of its key,
+    only the fields that were changed are written over what is then in the
+    database. Changes made meanwhile to other fields, a revocation say, are
+    kept.
+
+    Units of work are per thread. A unit of work started while another one
+    is active joins the outer one.
+    """
+
+    def __init__(self, sdb):
+        self.sdb = sdb
+        # Session ID -> SessionInfo instance, None if there is no such session
+        self.sessions = {}
+        # Sessions that must be written back as a whole
+        self.dirty = set()
+        # Changed fields of sessions that have not been read
+        self.patches = {}
+        # Session ID -> the session as it was read, for changed sessions
+        self.read = {}
+        # Session ID -> value read from the database but not yet decoded
+        self.raw = {}
+        # Writes to do after the sessions have been written
+        self.deferred = []
+        # Decoded tokens
+        self.tokens = {}
+        self.owner = False
+
+    def __enter__(self):
+        if self.sdb.current_unit_of_work() is None:
+            self.sdb._local.uow = self
+            self.owner = True
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.owner:
+            return False
+
+        self.sdb._local.uow = None
+        if exc_type is None:
+            self.flush()
+        return False
+
+    def flush(self):
+        """
+        Write the changes to the database. If the database can batch
+        writes, they are done as one batch.
+        """
+        try:
+            _batch = self.sdb._db.batch
+        except AttributeError:
+            self._flush()
+        else:
+            with _batch():
+                self._flush()
+
+    def _flush(self):
+        for sid in self.dirty:
+            _read = self.read.get(sid)
+            if _read is None:  # New or replaced without being read
+                self.sdb._write(sid, self.sessions[sid])
+            else:
+                self.sdb._merge(sid, _read, self.sessions[sid])
+        for sid, patch in self.patches.items():
+            self.sdb._write_fields(sid, patch)
+        for func, args in self.deferred:
+            func(*args)
+        self.dirty = set()
+        self.patches = {}
+        self.read = {}
+        self.deferred = []
+
+    def changing(self, sid):
+        """
+        Called before a session that has been read is changed, the first
+        time it is remembered as it was read.
+
+        :param sid: Session ID
+        """
+        if sid not in self.dirty and self.sessions.get(sid) is not None:
+            self.read[sid] = copy_value(self.sessions[sid])
+
+
 class SessionDB(object):
-    def __init__(self, db, handler, sso_db):
+    """
+    If the database has a true *native* attribute session information is
+    stored as SessionInfo instances, otherwise it is serialized by the
+    codec, JSON unless another codec is given.
+    Either way the caller gets a copy when reading and the database keeps
+    a copy when writing, so changes are only seen after a write.
+
+    Within a unit of work, see :py:meth:`unit_of_work`, reads and writes go
+    to the unit of work and the database is only written when it ends.
+
+    The sessions of a user are indexed on the fields in *index*, so that
+    :py:meth:`match_session` does not have to look at every session of the
+    user. A session is indexed when it is connected to the user, in
+    :py:meth:`do_sub`, and the index follows changes made with
+    :py:meth:`set_fields`/:py:meth:`update` and deletion. Sessions that
+    have expired are removed from the index when match_session meets them.
+
+    The keys derived from a session are listed in a record of their own,
+    which like them lives as long as the session if the database supports
+    a time to live. Sessions that have expired or have been revoked are
+    removed, together with what is derived from them, by
+    :py:meth:`collect`. When a session is written it is put in an expiry
+    index, kept in the process, if there is a garbage collector, see
+    *gc*, or if the database can not let values expire. If the database
+    is not *native*, and so may outlive the process, when a session may be
+    collected is then also kept in the database. The expiry index is
+    loaded from there by the first collect in a process.
+
+    Values that are read, changed and written back, a session when the
+    database can not change some of its fields and the index records, are
+    changed holding the lock of the key if the database has per key locks,
+    see :py:class:`oidcendpoint.thread_safe.ThreadSafeDataBase`.
+    """
+    # How long a revoked session is kept before it may be collected
+    revoked_ttl = 600
+
+    def __init__(self, db, handler, sso_db, codec=None, index=('client_id',)):
         # db must implement the InMemoryStateDataBase interface
         self._db = db
         self.handler = handler
         self.sso_db = sso_db
+        if codec is None:
+            codec = JSONCodec()
+        self.codec = codec
+        self.index = index
+        self._local = threading.local()
+        # Session ID -> when the session may be collected
+        self._expires = {}
+        self._expiry = []
+        self._expiry_lock = threading.Lock()
+        self._persist_expiry = not getattr(db, 'native', False)
+        self._expiry_loaded = False
+        # A SessionGC instance, run when a request has been handled
+        self.gc = None
+        self._key_lock = getattr(db, 'lock', None)
+
+    def _lock(self, key):
+        if self._key_lock is None:
+            return NO_LOCK
+        return self._key_lock(key)
+
+    def unit_of_work(self):
+        """
+        Usage::
 
-    def __getitem__(self, item):
-        _info = self._db.get(item)
+            with sdb.unit_of_work():
+                ...
 
-        if _info is None:
-            sid = self.handler.sid(item)
-            _info = self._db.get(sid)
+        :return: A UnitOfWork instance
+        """
+        return UnitOfWork(self)
 
-        if _info:
-            _si = SessionInfo().from_json(_info)
-            return _si
+    def current_unit_of_work(self):
+        return getattr(self._local, 'uow', None)
+
+    def _defer(self, func, *args):
+        """
+        Within a unit of work call a function when the unit of work ends,
+        if it ends without an exception, otherwise call it now.
+        """
+        _uow = self.current_unit_of_work()
+        if _uow is None:
+            func(*args)
         else:
+            _uow.deferred.append((func, args))
+
+    def _read(self, sid):
+        """
+        Read from the database.
+
+        :param sid: Session ID
+        :return: A SessionInfo instance owned by the caller or None
+        """
+        return self._decode(self._db.get(sid))
+
+    def _decode(self, value):
+        if not value:
             return None
 
-    def __setitem__(self, sid, instance):
+        if isinstance(value, SessionInfo):
+            return copy_value(value)
+        else:
+            return self.codec.decode(value, SessionInfo)
+
+    def _read_many(self, sids):
+        """
+        Read several sessions from the database, in one call if the
+        database has a get_many method.
+
+        :param sids: Session IDs
+        :return: Dictionary with Session ID and SessionInfo instance, for
+            the sessions that were found
+        """
+        try:
+            _values = self._db.get_many(sids)
+        except AttributeError:
+            _values = {sid: self._db.get(sid) for sid in sids}
+
+        res = {}
+        for sid in sids:
+            _info = self._decode(_values.get(sid))
+            if _info is not None:
+                res[sid] = _info
+        return res
+
+    def _set(self, key, value, ttl=0):
+        if ttl and getattr(self._db, 'supports_ttl', False):
+            self._db.set(key, value, ttl=ttl)
+        else:
+            self._db.set(key, value)
+
+    def lifetime(self, info):
+        """
+        How long session information must be kept. As long as any of the
+        tokens issued in the session or the user authentication is valid.
+
+        :param info: A SessionInfo instance
+        :return: Number of seconds, 0 if it must be kept forever
+        """
+        _ttl = 0
+        for typ in ['code', 'access_token', 'refresh_token']:
+            if not info.get(typ):
+                continue
+            try:
+                _lifetime = self.handler[typ].lifetime
+            except KeyError:
+                continue
+            if _lifetime <= 0:  # Never expires
+                return 0
+            _ttl = max(_ttl, _lifetime)
+
+        try:
+            _valid_until = info['authn_event']['valid_until']
+        except KeyError:
+            pass
+        else:
+            _ttl = max(_ttl, _valid_until - time_sans_frac())
+
+        return _ttl
+
+    def _keeps_expiry(self):
+        # Without a garbage collector nothing takes sessions out of the
+        # expiry index, the database has to remove them
+        return self.gc is not None or not getattr(self._db, 'supports_ttl',
+                                                  False)
+
+    def _keep_ttl(self, key, ttl):
+        """
+        :param key: The key of a value that is there and is written again
+        :param ttl: The time to live it needs, 0 means forever
+        :return: A time to live that is not shorter than what the value
+            has left, 0 means forever
+        """
+        if not ttl:
+            return 0
+        try:
+            _left = self._db.ttl(key)
+        except AttributeError:
+            return ttl
+        if not _left:  # The value lives forever
+            return 0
+        return max(ttl, _left)
+
+    def _schedule(self, sid, ttl, revoked=False):
+        """
+        Put a session in the expiry index, if one is kept.
+
+        :param sid: Session ID
+        :param ttl: The lifetime of the session, 0 means forever
+        :param revoked: If the session has been revoked, then it is kept
+            at most *revoked_ttl* seconds
+        :return: When the session may be collected, 0 if never, None if
+            that has not changed
+        """
+        if not self._keeps_expiry():
+            return None
+
+        _now = time.time()
+        with self._expiry_lock:
+            if revoked:
+                _when = _now + self.revoked_ttl
+                _prev = self._expires.get(sid)
+                if _prev is not None and _prev < _when:
+                    return None
+                if 0 < ttl < self.revoked_ttl:
+                    _when = _now + ttl
+            elif ttl > 0:
+                _when = _now + ttl
+            else:
+                self._expires.pop(sid, None)
+                return 0
+
+            self._enqueue(sid, _when)
+        return _when
+
+    def _enqueue(self, sid, when):
+        # Must hold the expiry lock
+        self._expires[sid] = when
+        heapq.heappush(self._expiry, (when, sid))
+        # Sessions that are written again leave stale entries behind
+        if len(self._expiry) > 2 * len(self._expires) + 64:
+            self._expiry = [(w, s) for s, w in self._expires.items()]
+            heapq.heapify(self._expiry)
+
+    @staticmethod
+    def _expires_key(sid):
+        return '__expires__{}__'.format(sid)
+
+    def _store_expiry(self, items):
+        """
+        Keep when sessions may be collected in the database, if it may
+        outlive the process.
+
+        :param items: Iterable of (Session ID, when) tuples, as returned by
+            :py:meth:`_schedule`
+        """
+        if not self._persist_expiry or not self._keeps_expiry():
+            return
+
+        _items = []
+        for sid, when in items:
+            if when is None:
+                continue
+            elif when:
+                _items.append((self._expires_key(sid), json.dumps(when)))
+            elif self._db.get(self._expires_key(sid)) is not None:
+                self._db.delete(self._expires_key(sid))
+
+        if len(_items) == 1:
+            self._db.set(*_items[0])
+        elif _items:
+            try:
+                self._db.set_many(_items)
+            except AttributeError:
+                for key, value in _items:
+                    self._db.set(key, value)
+
+    def _stored_expiry(self, sids):
+        """
+        :param sids: Session IDs
+        :return: Dictionary with Session ID and when the session may be
+            collected, as kept in the database
+        """
+        _keys = {self._expires_key(sid): sid for sid in sids}
         try:
-            _info = instance.to_json()
-        except ValueError:
-            _info = json.dumps(instance)
-        self._db.set(sid, _info)
+            _values = self._db.get_many(list(_keys))
+        except AttributeError:
+            _values = {k: self._db.get(k) for k in _keys}
+        return {_keys[k]: json.loads(v) for k, v in _values.items() if v}
+
+    def _load_expiry(self):
+        """
+        Put the sessions whose expiry is kept in the database, written by
+        this or another process, in the expiry index.
+        """
+        self._expiry_loaded = True
+        _prefix = self._expires_key('')[:-2]
+        _sids = [k[len(_prefix):-2] for k in self._db.keys()
+                 if k.startswith(_prefix)]
+        _stored = self._stored_expiry(_sids)
+        with self._expiry_lock:
+            for sid, when in _stored.items():
+                if sid not in self._expires:
+                    self._enqueue(sid, when)
+
+    def _due(self, when, limit):
+        """
+        Take sessions that are due out of the expiry index.
+
+        :param when: Point in time to compare with
+        :param limit: Max number of sessions
+        :return: List of Session IDs
+        """
+        res = []
+        with self._expiry_lock:
+            while self._expiry and self._expiry[0][0] < when:
+                _when, sid = heapq.heappop(self._expiry)
+                if self._expires.get(sid) != _when:
+                    continue
+                del self._expires[sid]
+                res.append(sid)
+                if len(res) >= limit:
+                    break
+        return res
+
+    def _write(self, sid, info):
+        if getattr(self._db, 'native', False):
+            _value = copy_value(info)
+        else:
+            _value = self.codec.encode(info)
+
+        _lifetime = self.lifetime(info)
+        if getattr(self._db, 'supports_ttl', False):
+            self._db.set(sid, _value, ttl=_lifetime)
+        else:
+            self._db.set(sid, _value)
+        _when = self._schedule(sid, _lifetime, info.get('revoked', False))
+        self._store_expiry([(sid, _when)])
+        self._extend(sid, _lifetime)
+        if info.get('sub'):
+            self.sso_db.refresh(sid, _lifetime)
+
+    def _write_many(self, infos):
+        """
+        Write several sessions, in one call per time to live if the
+        database has a set_many method.
+
+        :param infos: Dictionary with Session ID and SessionInfo instance
+        """
+        try:
+            _set_many = self._db.set_many
+        except AttributeError:
+            for sid, info in infos.items():
+                self._write(sid, info)
+            return
+
+        _native = getattr(self._db, 'native', False)
+        _ttl = getattr(self._db, 'supports_ttl', False)
+        _groups = {}
+        _expiry = []
+        for sid, info in infos.items():
+            if _native:
+                _value = copy_value(info)
+            else:
+                _value = self.codec.encode(info)
+            _lifetime = self.lifetime(info)
+            _expiry.append((sid, self._schedule(sid, _lifetime,
+                                                info.get('revoked', False))))
+            self._extend(sid, _lifetime)
+            if info.get('sub'):
+                self.sso_db.refresh(sid, _lifetime)
+            if not _ttl:
+                _lifetime = 0
+            _groups.setdefault(_lifetime, []).append((sid, _value))
+
+        for ttl, items in _groups.items():
+            if ttl:
+                _set_many(items, ttl=ttl)
+            else:
+                _set_many(items)
+        self._store_expiry(_expiry)
+
+    def _write_fields(self, sid, patch):
+        """
+        Write some fields of the session information.
+
+        :param sid: Session ID
+        :param patch: SessionInfo instance with the changed fields
+        """
+        _native = getattr(self._db, 'native', False)
+        _set_fields = getattr(self._db, 'set_fields', None)
+        if _set_fields is None or not (_native or self.codec.patchable):
+            with self._lock(sid):
+                item = self._read(sid)
+                item.update(patch._dict)
+                self._write(sid, item)
+            return
+
+        if _native:
+            _set_fields(sid, **copy_value(patch._dict))
+        else:
+            _set_fields(sid, **patch.to_dict())
+        if patch.get('revoked'):
+            self._store_expiry([(sid, self._schedule(sid, 0, revoked=True))])
+
+    def _merge(self, sid, read, info):
+        """
+        Write the fields of a session that have been changed since it was
+        read, over what is in the database now.
+
+        :param sid: Session ID
+        :param read: SessionInfo instance, the session as it was read
+        :param info: SessionInfo instance, the session as it is now
+        """
+        _old = read._dict
+        _new = info._dict
+        _changed = {k: v for k, v in _new.items()
+                    if k not in _old or _old[k] != v}
+        _deleted = [k for k in _old if k not in _new]
+        if not _changed and not _deleted:
+            return
+
+        with self._lock(sid):
+            _info = self._read(sid)
+            if _info is None:  # Removed meanwhile
+                return
+            _info.update(_changed)
+            for key in _deleted:
+                if key in _info:
+                    del _info[key]
+            self._write(sid, _info)
+
+    def _fetch(self, sid):
+        _uow = self.current_unit_of_work()
+        if _uow is None:
+            return self._read(sid)
+
+        try:
+            _info = _uow.sessions[sid]
+        except KeyError:
+            try:
+                _info = self._decode(_uow.raw.pop(sid))
+            except KeyError:
+                _info = self._read(sid)
+            _uow.sessions[sid] = _info
+            if _info is not None and sid in _uow.patches:
+                _uow.changing(sid)
+                _info.update(_uow.patches.pop(sid)._dict)
+                _uow.dirty.add(sid)
+
+        if _info is None:
+            return None
+        return copy_value(_info)
+
+    def _fetch_many(self, sids):
+        """
+        As :py:meth:`_fetch` but for several sessions, those that are not
+        in the unit of work are read in one go.
+
+        :param sids: Session IDs
+        :return: Dictionary with Session ID and SessionInfo instance, for
+            the sessions that were found
+        """
+        _uow = self.current_unit_of_work()
+        if _uow is None:
+            return self._read_many(sids)
+
+        _missing = [sid for sid in sids if sid not in _uow.sessions]
+        if _missing:
+            _read = self._read_many(_missing)
+            for sid in _missing:
+                _info = _read.get(sid)
+                _uow.sessions[sid] = _info
+                if _info is not None and sid in _uow.patches:
+                    _uow.changing(sid)
+                    _info.update(_uow.patches.pop(sid)._dict)
+                    _uow.dirty.add(sid)
+
+        res = {}
+        for sid in sids:
+            _info = _uow.sessions[sid]
+            if _info is not None:
+                res[sid] = copy_value(_info)
+        return res
+
+    def _token_info(self, token, order=None, typ=''):
+        """
+        Decode a token, within a unit of work a token is only decoded once.
+
+        :param token: The token
+        :param order: Token handlers to try, as for TokenHandler.info
+        :param typ: Use this token handler and no other
+        :return: Token information
+        """
+        if typ:
+            _handler = self.handler[typ]
+        else:
+            _handler = self.handler
+
+        _uow = self.current_unit_of_work()
+        if _uow is None:
+            if typ:
+                return _handler.info(token)
+            return _handler.info(token, order)
+
+        _key = (token, typ, tuple(order or []))
+        try:
+            _res = dict(_uow.tokens[_key])
+        except KeyError:
+            if typ:
+                _res = _handler.info(token)
+            else:
+                _res = _handler.info(token, order)
+            _uow.tokens[_key] = dict(_res)
+        else:
+            # May have changed since the token was decoded
+            _res['black_listed'] = _res['handler'].is_black_listed(token)
+        return _res
+
+    def __getitem__(self, item):
+        # Session IDs never contain a '.', tokens most often do
+        if '.' in item:
+            try:
+                return self._fetch(self._token_info(item)['sid'])
+            except KeyError:
+                pass
+
+        _info = self._fetch(item)
+        if _info is None:
+            _info = self._fetch(self._token_info(item)['sid'])
+        return _info
+
+    def __setitem__(self, sid, instance):
+        if isinstance(instance, SessionInfo):
+            _info = instance
+        else:
+            _info = SessionInfo(**copy_value(instance))
+
+        _uow = self.current_unit_of_work()
+        if _uow is None:
+            self._write(sid, _info)
+        else:
+            if sid not in _uow.dirty and _uow.sessions.get(sid) is not None:
+                # Replaced, not changed in place
+                _uow.read[sid] = _uow.sessions[sid]
+            _uow.sessions[sid] = copy_value(_info)
+            _uow.dirty.add(sid)
+            _uow.patches.pop(sid, None)
 
     def __delitem__(self, key):
-        self._db.delete(key)
+        _uow = self.current_unit_of_work()
+        if _uow is None:
+            if not self._remove(key):
+                raise KeyError(key)
+            return
+
+        if self._fetch(key) is None:
+            raise KeyError(key)
+        _uow.sessions[key] = None
+        _uow.dirty.discard(key)
+        _uow.read.pop(key, None)
+        self._defer(self._remove, key)
 
     def create_authz_session(self, authn_event, areq, client_id='', **kwargs):
 
@@ -142,9 +868,80 @@ class SessionDB(object):
             _info.update(kwargs)
 
         self[sid] = _info
-        self.map_kv2sid('state', areq['state'], sid)
+        self.map_kv2sid('state', areq['state'], sid, self.lifetime(_info))
         return sid
 
+    def set_fields(self, sid, **kwargs):
+        """
+        Change some fields of the session information. If the database has
+        a set_fields method only the changed fields are written, otherwise
+        the whole session is read and written back.
+
+        :param sid: Session ID
+        :param kwargs: Field names and values
+        """
+        # Values are converted the same way as when a whole session is stored
+        _patch = SessionInfo(**kwargs)
+
+        if self.index and not set(kwargs).isdisjoint(self.index):
+            self._reindex(sid, _patch)
+
+        _uow = self.current_unit_of_work()
+        if _uow is None:
+            self._write_fields(sid, _patch)
+            return
+
+        _fields = copy_value(_patch._dict)
+        _info = _uow.sessions.get(sid)
+        if _info is not None:
+            _uow.changing(sid)
+            _info.update(_fields)
+            _uow.dirty.add(sid)
+        elif sid in _uow.patches:
+            _uow.patches[sid].update(_fields)
+        else:
+            _uow.patches[sid] = SessionInfo(**_fields)
+
+    def _set_fields_many(self, sids, **kwargs):
+        """
+        Change the same fields in several sessions, those that exist. The
+        sessions are read with one call to the database. If the database
+        can change fields, the writes are done as one batch. Otherwise the
+        sessions are written back with a few calls.
+
+        :param sids: Session IDs
+        :param kwargs: Field names and values
+        """
+        _native = getattr(self._db, 'native', False)
+        if hasattr(self._db, 'set_fields') and (
+                _native or self.codec.patchable):
+            try:
+                _found = self._db.get_many(sids)
+            except AttributeError:
+                _found = [sid for sid in sids if self._db.get(sid)]
+
+            _patch = SessionInfo(**kwargs)
+            try:
+                _batch = self._db.batch
+            except AttributeError:
+                for sid in _found:
+                    self._write_fields(sid, _patch)
+            else:
+                with _batch():
+                    for sid in _found:
+                        self._write_fields(sid, _patch)
+            return
+
+        try:
+            _held = self._db.lock_many(sids)
+        except AttributeError:
+            _held = NO_LOCK
+        with _held:
+            _infos = self._read_many(sids)
+            for info in _infos.values():
+                info.update(kwargs)
+            self._write_many(_infos)
+
     def update(self, sid, **kwargs):
         """
         Add attribute value assertion to a special session
@@ -152,10 +949,7 @@ class SessionDB(object):
         :param sid: Session ID
         :param kwargs:
         """
-        item = self[sid]
-        for attribute, value in kwargs.items():
-            item[attribute] = value
-        self[sid] = item
+        self.set_fields(sid, **kwargs)
 
     def update_by_token(self, token, **kwargs):
         """
@@ -164,15 +958,252 @@ class SessionDB(object):
         :param token: code/access token/refresh token/...
         :param kwargs: Key word arguements
         """
-        _sid = self.handler.sid(token)
+        _sid = self._token_info(token)['sid']
         return self.update(_sid, **kwargs)
 
-    def map_kv2sid(self, key, value, sid):
-        self._db.set('__{}__{}__'.format(key, value), sid)
+    def map_kv2sid(self, key, value, sid, ttl=0):
+        self._defer(self._map_kv2sid, key, value, sid, ttl)
+
+    def _map_kv2sid(self, key, value, sid, ttl):
+        _key = '__{}__{}__'.format(key, value)
+        self._set(_key, sid, ttl)
+        self._derive(sid, _key, ttl)
 
     def get_sid_by_kv(self, key, value):
         return self._db.get('__{}__{}__'.format(key, value))
 
+    @staticmethod
+    def _derived_key(sid):
+        return '__derived__{}__'.format(sid)
+
+    def _derive(self, sid, key, ttl=0):
+        """
+        Remember a key that is derived from a session, so that it is removed
+        together with the session.
+
+        :param sid: Session ID
+        :param key: The derived key
+        :param ttl: The lifetime of the session, 0 means forever
+        """
+        # Twice the lifetime, so that it need not be written again every
+        # time the session is
+        ttl *= 2
+        _dkey = self._derived_key(sid)
+        with self._lock(_dkey):
+            _keys = self._indexed(_dkey)
+            if key not in _keys:
+                if _keys:
+                    ttl = self._keep_ttl(_dkey, ttl)
+                _keys.append(key)
+                self._set(_dkey, json.dumps(_keys), ttl)
+
+    def _extend(self, sid, ttl):
+        """
+        Make what is derived from a session live at least as long as the
+        session. Nothing is written unless it would otherwise go first.
+
+        :param sid: Session ID
+        :param ttl: The lifetime of the session, 0 means forever
+        """
+        if not getattr(self._db, 'supports_ttl', False):
+            return
+        _dkey = self._derived_key(sid)
+        try:
+            _left = self._db.ttl(_dkey)
+        except AttributeError:
+            return
+        if 0 < ttl <= _left:
+            return
+
+        with self._lock(_dkey):
+            _keys = self._indexed(_dkey)
+            if _keys:
+                self._set(_dkey, json.dumps(_keys),
+                          self._keep_ttl(_dkey, 2 * ttl))
+        # The index records the session is in must live as long
+        for key in _keys:
+            if key.startswith('__index__'):
+                with self._lock(key):
+                    _sids = self._indexed(key)
+                    if sid in _sids:
+                        self._set(key, json.dumps(_sids),
+                                  self._keep_ttl(key, 2 * ttl))
+
+    def _rewrite(self, key, value):
+        """
+        Write a value again, keeping what it has left of its time to live.
+
+        :param key: The key of a value that is there
+        :param value: The new value
+        """
+        try:
+            _left = self._db.ttl(key)
+        except AttributeError:
+            _left = 0
+        self._set(key, value, _left)
+
+    def _remove(self, sid, sso=True, info=None):
+        """
+        Remove a session and everything derived from it: the key-value
+        mappings, the index entries and the connections in the SSO db.
+
+        :param sid: Session ID
+        :param sso: Whether to remove the connections in the SSO db
+        :param info: The session information if it has already been read
+        :return: True if the session was there
+        """
+        if info is None:
+            info = self._read(sid)
+        _unindexed = set()
+        if info and self.index:
+            # The index entries can be found even if the record of derived
+            # keys has gone
+            self._unindex(sid, info)
+            _uid = info.get('authn_event', {}).get('uid')
+            _unindexed = {self._index_key(_uid, field, info.get(field))
+                          for field in self.index}
+
+        _dkey = self._derived_key(sid)
+        for key in self._indexed(_dkey):
+            if key in _unindexed:
+                continue
+            if key.startswith('__index__'):
+                self._unindex_key(sid, key)
+            elif self._db.get(key) == sid:
+                self._db.delete(key)
+        if self._db.get(_dkey) is not None:
+            self._db.delete(_dkey)
+        self._store_expiry([(sid, 0)])
+
+        if sso:
+            self.sso_db.remove_session_id(sid)
+        with self._expiry_lock:
+            self._expires.pop(sid, None)
+
+        try:
+            self._db.delete(sid)
+        except KeyError:
+            return False
+        return True
+
+    def _remove_session(self, sid, info=None):
+        return self._remove(sid, sso=False, info=info)
+
+    @staticmethod
+    def _index_key(uid, field, value):
+        return '__index__{}__{}__{}__'.format(field, value, uid)
+
+    def _indexed(self, key):
+        _sids = self._db.get(key)
+        if not _sids:
+            return []
+        return json.loads(_sids)
+
+    def _index(self, sid, uid, info, ttl=0):
+        """
+        Add a session to the index.
+
+        :param sid: Session ID
+        :param uid: User ID
+        :param info: The session information, or the fields to index on
+        :param ttl: The lifetime of the session, 0 means forever
+        """
+        for field in self.index:
+            _value = info.get(field)
+            if not isinstance(_value, str):
+                continue
+            _key = self._index_key(uid, field, _value)
+            with self._lock(_key):
+                _sids = self._indexed(_key)
+                if sid in _sids:
+                    continue
+                # Lives as long as the longest lived session in it, twice
+                # as long as they like the record of derived keys
+                _ttl = self._keep_ttl(_key, 2 * ttl) if _sids else 2 * ttl
+                _sids.append(sid)
+                self._set(_key, json.dumps(_sids), _ttl)
+            self._derive(sid, _key, ttl)
+
+    def _unindex_key(self, sid, key):
+        with self._lock(key):
+            _sids = self._indexed(key)
+            if sid in _sids:
+                _sids.remove(sid)
+                if _sids:
+                    self._rewrite(key, json.dumps(_sids))
+                else:
+                    self._db.delete(key)
+
+    def _trim_index(self, key, sids):
+        """
+        Remove several sessions from an index record.
+
+        :param key: The key of the index record
+        :param sids: Session IDs
+        """
+        sids = set(sids)
+        with self._lock(key):
+            _sids = self._indexed(key)
+            _keep = [sid for sid in _sids if sid not in sids]
+            if len(_keep) == len(_sids):
+                return
+            if _keep:
+                self._rewrite(key, json.dumps(_keep))
+            else:
+                self._db.delete(key)
+
+    def _unindex(self, sid, info, fields=None):
+        """
+        Remove a session from the index.
+
+        :param sid: Session ID
+        :param info: The session information
+        :param fields: The fields to remove it from, default all
+        """
+        try:
+            uid = info['authn_event']['uid']
+        except KeyError:
+            return
+
+        for field in fields or self.index:
+            _value = info.get(field)
+            if not isinstance(_value, str):
+                continue
+            self._unindex_key(sid, self._index_key(uid, field, _value))
+
+    def _reindex(self, sid, patch):
+        """
+        Move a session in the index when indexed fields are changed.
+        """
+        _info = self._fetch(sid)
+        try:
+            _uid = _info['authn_event']['uid']
+        except (KeyError, TypeError):
+            return
+        if sid not in (self.sso_db.get_sids_by_uid(_uid) or []):
+            return  # Not indexed yet, done by do_sub
+
+        _fields = [f for f in self.index if f in patch]
+        self._defer(self._unindex, sid, _info, _fields)
+        self._defer(self._index, sid, _uid, patch, self.lifetime(_info))
+
+    def _indexed_sids(self, uid, kwargs):
+        """
+        Sessions of a user with the given values of indexed fields.
+
+        :return: List of session IDs or None if the index can not be used
+        """
+        _res = None
+        for field, value in kwargs.items():
+            if field not in self.index or not isinstance(value, str):
+                return None
+            _sids = self._indexed(self._index_key(uid, field, value))
+            if _res is None:
+                _res = _sids
+            else:
+                _res = [sid for sid in _res if sid in _sids]
+        return _res
+
     def get_token(self, sid):
         _sess_info = self[sid]
 
@@ -182,21 +1213,46 @@ class SessionDB(object):
             return _sess_info["access_token"]
 
     def do_sub(self, sid, client_salt, sector_id='', subject_type='public'):
-        authn_event = self[sid]['authn_event']
+        _info = self[sid]
+        authn_event = _info['authn_event']
         sub = mint_sub(authn_event, client_salt, sector_id, subject_type)
 
-        self.sso_db.map_sid2uid(sid, authn_event['uid'])
         self.update(sid, sub=sub)
-        self.sso_db.map_sid2sub(sid, sub)
-
+        _uow = self.current_unit_of_work()
+        if _uow is None:
+            self._connect(sid, sub, _info)
+        else:
+            # Indexed as the session is when the unit of work ends
+            self._defer(self._connect_when_written, sid, sub, _uow)
         return sub
 
+    def _connect(self, sid, sub, info):
+        """
+        Connect a session to its user in the SSO db and the index.
+        """
+        _uid = info['authn_event']['uid']
+        self.sso_db.map_sid(sid, uid=_uid, sub=sub)
+        self.sso_db.refresh(sid, self.lifetime(info))
+        if self.index:
+            self._index(sid, _uid, info, self.lifetime(info))
+
+    def _connect_when_written(self, sid, sub, uow):
+        _info = uow.sessions.get(sid)
+        if _info is not None:
+            self._connect(sid, sub, _info)
+
     def is_valid(self, item):
         try:
-            return not self.handler.is_black_listed(item)
+            _tinfo = self._token_info(item)
         except KeyError:
             return False
 
+        # Black listed tokens are forgotten once they have expired
+        if is_expired(int(_tinfo['exp'])):
+            return False
+
+        return not _tinfo['black_listed']
+
     def get_sids_by_sub(self, sub):
         return self.sso_db.get_sids_by_sub(sub)
 
@@ -217,7 +1273,8 @@ class SessionDB(object):
         else:
             # blacklist the old is there is one
             try:
-                self.handler[token_type].black_list(sinfo[token_type])
+                self._defer(self.handler[token_type].black_list,
+                            sinfo[token_type])
             except KeyError:
                 pass
 
@@ -237,11 +1294,14 @@ class SessionDB(object):
         :return: The session information as a SessionInfo instance
         """
         if grant:
-            _tinfo = self.handler['code'].info(grant)
+            _tinfo = self._token_info(grant, typ='code')
 
             session_info = self[_tinfo['sid']]
 
-            if self.handler['code'].is_black_listed(grant):
+            if is_expired(int(_tinfo['exp'])):
+                raise ExpiredToken(grant)
+
+            if _tinfo['black_listed']:
                 # invalidate the released access token and refresh token
                 for item in ['access_token', 'refresh_token']:
                     try:
@@ -254,7 +1314,8 @@ class SessionDB(object):
             _at = self.handler['access_token'](sid=_tinfo['sid'],
                                                sinfo=session_info)
 
-            # make sure the code can't be used again
+            # make sure the code can't be used again, at once since that is
+            # what keeps a code from being used twice at the same time
             self.handler['code'].black_list(grant)
             key = _tinfo['sid']
         else:
@@ -294,7 +1355,7 @@ class SessionDB(object):
         """
 
         try:
-            _tinfo = self.handler['refresh_token'].info(token)
+            _tinfo = self._token_info(token, typ='refresh_token')
         except KeyError:
             return False
 
@@ -323,13 +1384,18 @@ class SessionDB(object):
         """
 
         try:
-            _tinfo = self.handler.info(token)
+            _tinfo = self._token_info(token)
         except KeyError:
             return False
 
         if is_expired(int(_tinfo['exp'])) or _tinfo['black_listed']:
             return False
 
+        # A self-contained token needs no session state, only a check that
+        # the session hasn't been revoked.
+        if getattr(_tinfo['handler'], 'self_contained', False):
+            return self._revoked(_tinfo['sid']) is False
+
         # Dependent on what state the session is in.
         session_info = self[_tinfo['sid']]
 
@@ -349,9 +1415,24 @@ class SessionDB(object):
         :param token: access token
         """
         if token_type:
-            self.handler[token_type].black_list(token)
+            self._defer(self.handler[token_type].black_list, token)
         else:
-            self.handler.black_list(token)
+            self._defer(self.handler.black_list, token)
+
+    def revoke_tokens(self, tokens, token_type=''):
+        """
+        Revokes several tokens in one go.
+
+        :param tokens: list of tokens
+        :param token_type: Where to look first, the other token types are
+            tried if a token is not of this type.
+        :return: Number of tokens revoked
+        """
+        order = list(self.handler.handler_order)
+        if token_type in order:
+            order.remove(token_type)
+            order.insert(0, token_type)
+        return self.handler.black_list_many(tokens, order=order)
 
     def revoke_all_tokens(self, token):
         _sinfo = self[token]
@@ -370,13 +1451,14 @@ class SessionDB(object):
         """
         if not sid:
             if token:
-                sid = self.handler.sid(token)
+                sid = self._token_info(token)['sid']
             else:
                 raise ValueError('Need one of "sid" or "token"')
 
+        _sinfo = self[sid]
         for typ in ['access_token', 'refresh_token', 'code']:
             try:
-                self.revoke_token(self[sid][typ], typ)
+                self.revoke_token(_sinfo[typ], typ)
             except KeyError:  # If no such token has been issued
                 pass
 
@@ -387,15 +1469,17 @@ class SessionDB(object):
 
     def get_active_client_ids_for_uid(self, uid):
         res = []
-        for sid in self.sso_db.get_sids_by_uid(uid):
-            if 'revoked' not in self[sid]:
-                res.append(self[sid]["client_id"])
+        _sids = self.sso_db.get_sids_by_uid(uid) or []
+        # Expired sessions are not returned
+        for session_info in self._fetch_many(_sids).values():
+            if 'revoked' not in session_info:
+                res.append(session_info["client_id"])
         return res
 
     def get_verified_logout(self, uid):
         res = {}
-        for sid in self.sso_db.get_sids_by_uid(uid):
-            session_info = self[sid]
+        _sids = self.sso_db.get_sids_by_uid(uid) or []
+        for session_info in self._fetch_many(_sids).values():
             try:
                 res[session_info['client_id']] = session_info['verified_logout']
             except KeyError:
@@ -403,11 +1487,33 @@ class SessionDB(object):
         return res
 
     def match_session(self, uid, **kwargs):
-        for sid in self.sso_db.get_sids_by_uid(uid):
-            session_info = self[sid]
+        _sids = self.sso_db.get_sids_by_uid(uid)
+        # Sessions in the index that are gone, expired or no longer
+        # connected to the user. They are removed from the index when met.
+        _stale = []
+        _indexed = None
+        if kwargs and self.index:
+            _indexed = self._indexed_sids(uid, kwargs)
+            if _indexed is not None:
+                _known = set(_sids or [])
+                _sids = [sid for sid in _indexed if sid in _known]
+                _stale = [sid for sid in _indexed if sid not in _known]
+
+        _match = None
+        for sid in _sids or []:
+            session_info = self._fetch(sid)
+            if session_info is None:  # expired
+                _stale.append(sid)
+                continue
             if dict_match(kwargs, session_info):
-                return sid
-        return None
+                _match = sid
+                break
+
+        if _indexed is not None and _stale:
+            for field, value in kwargs.items():
+                self._defer(self._trim_index,
+                            self._index_key(uid, field, value), _stale)
+        return _match
 
     def set_verify_logout(self, uid, client_id):
         sid = self.match_session(uid, client_id=client_id)
@@ -417,24 +1523,166 @@ class SessionDB(object):
         sid = self.match_session(uid, client_id=client_id)
         return self[sid]['id_token']
 
+    def _revoked(self, sid):
+        """
+        Whether a session has been revoked, the session is not decoded if
+        that can be avoided. Within a unit of work what is read is kept, so
+        the session is not read again if it is used later.
+
+        :param sid: Session ID
+        :return: True or False, None if there is no such session
+        """
+        _uow = self.current_unit_of_work()
+        if _uow is not None and sid in _uow.sessions:
+            _info = _uow.sessions[sid]
+            if _info is None:
+                return None
+            return bool(_info.get('revoked'))
+
+        _value = self._db.get(sid)
+        if not _value:
+            return None
+        if isinstance(_value, SessionInfo):
+            _revoked = _value.get('revoked')
+        else:
+            try:
+                _field = self.codec.field
+            except AttributeError:
+                _revoked = self.codec.decode(_value, SessionInfo).get(
+                    'revoked')
+            else:
+                _revoked = _field(_value, 'revoked')
+
+        if _uow is not None:
+            _uow.raw[sid] = _value
+            _patch = _uow.patches.get(sid)
+            if _patch is not None and 'revoked' in _patch:
+                _revoked = _patch['revoked']
+        return bool(_revoked)
+
     def is_session_revoked(self, key):
         try:
             session_info = self[key]
         except Exception:
             raise UnknownToken(key)
 
+        if session_info is None:
+            raise UnknownToken(key)
+
         try:
             return session_info['revoked']
         except KeyError:
             return False
 
     def revoke_uid(self, uid):
-        # Revoke all sessions
-        for sid in self.sso_db.get_sids_by_uid(uid):
-            self.update(sid, revoked=True)
+        self.revoke_uids([uid])
+
+    def revoke_uids(self, uids):
+        """
+        Revoke all the sessions of a number of users and remove the users
+        from the SSO db. Outside a unit of work the sessions are read and
+        written with a few calls to the database, not a few per session.
+
+        :param uids: User IDs
+        """
+        _sids = []
+        for sids in self.sso_db.get_sessions_for_uids(uids).values():
+            _sids.extend(sids)
+
+        if self.current_unit_of_work() is None:
+            self._set_fields_many(_sids, revoked=True)
+        else:
+            for sid in self._fetch_many(_sids):
+                self.update(sid, revoked=True)
+
+        # Remove the users from the SSO db
+        self._defer(self.sso_db.remove_uids, uids)
+
+    def collect(self, limit=1000, when=0):
+        """
+        Remove sessions that have expired or have been revoked, found in
+        the expiry index, together with what is derived from them. Tokens
+        issued in a revoked session are black listed, since the session can
+        no longer tell that they are revoked, and black list entries for
+        tokens that have expired are removed.
+
+        The expiry index is kept in the process, a process collects the
+        sessions it has written. If the database is not *native* the first
+        collect in a process also loads what is kept in the database, so
+        sessions written before a restart or by other processes are
+        collected too.
+
+        :param limit: Max number of sessions to look at
+        :param when: Point in time to compare with, default is now
+        :return: Number of sessions removed
+        """
+        if not when:
+            when = time.time()
+        if self._persist_expiry and not self._expiry_loaded:
+            self._load_expiry()
+
+        _sids = self._due(when, limit)
+        _infos = self._read_many(_sids) if _sids else {}
+        _ttl = getattr(self._db, 'supports_ttl', False)
+        if self._persist_expiry and _sids and not _ttl:
+            _stored = self._stored_expiry(_sids)
+        else:
+            _stored = {}
+
+        _dead = []
+        _tokens = []
+        for sid in _sids:
+            _info = _infos.get(sid)
+            if _info is None:
+                _dead.append(sid)
+            elif _info.get('revoked'):
+                for typ in ['code', 'access_token', 'refresh_token']:
+                    if _info.get(typ):
+                        _tokens.append(_info[typ])
+                _dead.append(sid)
+            elif _ttl:
+                # Written again by another process, the store knows when
+                # it expires
+                self._schedule(sid, self.lifetime(_info))
+            elif _stored.get(sid, 0) > when:
+                # Written again by another process
+                with self._expiry_lock:
+                    if sid not in self._expires:
+                        self._enqueue(sid, _stored[sid])
+            else:
+                _dead.append(sid)
+
+        if _tokens:
+            self.handler.black_list_many(_tokens)
+
+        def _remove_session(sid):
+            # An empty dict if the session is gone, it need not be read again
+            return self._remove_session(sid, _infos.get(sid, {}))
+
+        # One batch per store, the stores may be in the same database
+        # where only one writer at a time is allowed
+        for _store, _func in [(self.sso_db, self.sso_db.remove_session_id),
+                              (self._db, _remove_session)]:
+            try:
+                _batch = _store.batch
+            except AttributeError:
+                for sid in _dead:
+                    _func(sid)
+            else:
+                with _batch():
+                    for sid in _dead:
+                        _func(sid)
+
+        # The token handlers may share a black list
+        _blists = {}
+        for _handler in getattr(self.handler, 'handler', {}).values():
+            _blist = getattr(_handler, 'blist', None)
+            if _blist is not None:
+                _blists[id(_blist)] = _blist
+        for _blist in _blists.values():
+            _blist.prune(limit=0)
 
-        # Remove the uid from the SSO db
-        self.sso_db.remove_uid(uid)
+        return len(_dead)
 
     def duplicate(self, sinfo):
         session_info = copy.copy(sinfo)
@@ -453,13 +1701,13 @@ class SessionDB(object):
                 pass
 
         self[sid] = session_info
-        self.sso_db.map_sid2sub(sid, session_info["sub"])
+        self._defer(self.sso_db.map_sid2sub, sid, session_info["sub"])
         return sid
 
     def read(self, token):
         try:
-            _tinfo = self.handler['access_token'].info(token)
-        except WrongTokenType:
+            _tinfo = self._token_info(token, order=['access_token'])
+        except (KeyError, WrongTokenType):
             return {}
         else:
             return self[_tinfo['sid']]
@@ -479,11 +1727,12 @@ class SessionDB(object):
 
 def create_session_db(password, token_expires_in=3600,
                       grant_expires_in=600, refresh_token_expires_in=86400,
-                      db=None, sso_db=SSODb()):
+                      db=None, sso_db=SSODb(), codec=None, **kwargs):
     _token_handler = token_handler.factory(
-        password, token_expires_in, grant_expires_in, refresh_token_expires_in)
+        password, token_expires_in, grant_expires_in, refresh_token_expires_in,
+        **kwargs)
 
     if not db:
         db = InMemoryDataBase()
 
-    return SessionDB(db, _token_handler, sso_db)
+    return SessionDB(db, _token_handler, sso_db, codec)
@@ -0,0 +1,372 @@
+"""
+Serialization of session information for stores that do not keep Python
+objects, see the *native* attribute of the stores.
+"""
+import base64
+import binascii
+import hashlib
+import json
+import struct
+
+from oidcendpoint.in_memory_db import InMemoryDataBase
+
+__author__ = 'Roland Hedberg'
+
+
+class JSONCodec(object):
+    """
+    Session information as JSON documents. Stores with a *set_fields*
+    method can update some of the fields of a stored document.
+    """
+    patchable = True
+
+    def encode(self, info):
+        return info.to_json()
+
+    def decode(self, value, cls):
+        return cls().from_json(value)
+
+    def field(self, value, name):
+        """
+        The value of one field, no Message is created.
+
+        :param value: What encode returned
+        :param name: Field name
+        :return: The value, None if the field is not there
+        """
+        return json.loads(value).get(name)
+
+
+# Field names that are written as a number. Names may be added at the end,
+# never removed or reordered, since that would change the meaning of
+# stored records.
+NAMES = (
+    # SessionInfo
+    'oauth_state', 'code', 'authn_req', 'client_id', 'authn_event',
+    'si_redirects', 'sub', 'access_token', 'refresh_token', 'token_type',
+    'expires_in', 'access_token_scope', 'revoked', 'verified_logout',
+    'id_token', 'oidreq',
+    # AuthorizationRequest
+    'response_type', 'scope', 'redirect_uri', 'state', 'nonce', 'display',
+    'prompt', 'max_age', 'ui_locales', 'claims_locales', 'id_token_hint',
+    'login_hint', 'acr_values', 'claims', 'registration', 'request',
+    'request_uri', 'response_mode', 'code_challenge',
+    'code_challenge_method',
+    # AuthnEvent
+    'uid', 'salt', 'authn_info', 'authn_time', 'valid_until',
+)
+
+# Values of these fields are the same in many sessions, typically all the
+# sessions of a client, and are stored once and referred to. Stored values
+# are never removed, so fields whose values most often differ between
+# authorizations, like request and claims, must not be here.
+SHARED = ('redirect_uri', 'scope', 'response_type', 'acr_values',
+          'authn_info')
+
+# Tokens, type.key_id.payload, where the payload is base64 encoded, often
+# more than once. The payload is stored decoded.
+TOKENS = ('code', 'access_token', 'refresh_token')
+
+NONE = b'\x00'
+TRUE = b'\x01'
+FALSE = b'\x02'
+INT = b'\x03'
+FLOAT = b'\x04'
+STR = b'\x05'
+LIST = b'\x06'
+DICT = b'\x07'
+REF = b'\x08'
+TOKEN = b'\x09'
+
+REF_SIZE = 12
+_DOUBLE = struct.Struct('>d')
+
+
+def _varint(n):
+    _buf = bytearray()
+    while n > 0x7f:
+        _buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    _buf.append(n)
+    return bytes(_buf)
+
+
+def _read_varint(buf, pos):
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+class CompactCodec(object):
+    """
+    Session information in a compact binary format.
+
+    Every value is a type byte followed by the value, lengths and integers
+    are variable length. Field names in :py:data:`NAMES` are written as
+    their index. Values of the fields in :py:data:`SHARED` are stored once,
+    in the *refs* store, and the record holds a digest of the value. Tokens,
+    see :py:data:`TOKENS`, are stored with their payload base64 decoded.
+
+    The refs store is any key-value store. If the session store is shared
+    between processes so must the refs store be. Reference values are
+    never removed, the number of them follows the number of clients.
+    """
+    patchable = False
+
+    def __init__(self, refs=None, names=NAMES, shared=SHARED, tokens=TOKENS):
+        """
+        :param refs: Store for values that are referred to
+        :param names: Field names written as numbers
+        :param shared: Fields whose values are referred to
+        :param tokens: Fields whose values are tokens
+        """
+        if refs is None:
+            refs = InMemoryDataBase()
+        self.refs = refs
+        self.names = names
+        self._name_index = {n: i for i, n in enumerate(names)}
+        self.shared = set(shared)
+        self.tokens = set(tokens)
+        # digest -> encoded value, what is known to be in the refs store
+        self._known = {}
+
+    def encode(self, info):
+        """
+        :param info: A Message instance
+        :return: bytes
+        """
+        _buf = bytearray()
+        self._encode(info.to_dict(), _buf)
+        return bytes(_buf)
+
+    def decode(self, value, cls):
+        """
+        :param value: What encode returned
+        :param cls: The Message class to create
+        :return: A cls instance
+        """
+        _val, _ = self._decode(value, 0)
+        return cls().from_dict(_val)
+
+    def field(self, value, name):
+        """
+        The value of one field, the other fields are skipped, not decoded.
+
+        :param value: What encode returned
+        :param name: Field name
+        :return: The value, None if the field is not there
+        """
+        if value[0:1] != DICT:
+            raise ValueError('Not a record')
+        _len, pos = _read_varint(value, 1)
+        for _ in range(_len):
+            n, pos = _read_varint(value, pos)
+            if n & 1:
+                _key = bytes(value[pos:pos + (n >> 1)]).decode('utf-8')
+                pos += n >> 1
+            else:
+                _key = self.names[n >> 1]
+            if _key == name:
+                return self._decode(value, pos)[0]
+            pos = self._skip(value, pos)
+        return None
+
+    def _encode(self, val, buf):
+        if val is None:
+            buf += NONE
+        elif val is True:
+            buf += TRUE
+        elif val is False:
+            buf += FALSE
+        elif isinstance(val, int):
+            buf += INT
+            # zigzag, small negative numbers are small too
+            buf += _varint(val << 1 if val >= 0 else (-val << 1) - 1)
+        elif isinstance(val, float):
+            buf += FLOAT
+            buf += _DOUBLE.pack(val)
+        elif isinstance(val, str):
+            _bytes = val.encode('utf-8')
+            buf += STR
+            buf += _varint(len(_bytes))
+            buf += _bytes
+        elif isinstance(val, (list, tuple)):
+            buf += LIST
+            buf += _varint(len(val))
+            for item in val:
+                self._encode(item, buf)
+        elif isinstance(val, dict):
+            buf += DICT
+            buf += _varint(len(val))
+            for key, item in val.items():
+                try:
+                    buf += _varint(self._name_index[key] << 1)
+                except KeyError:
+                    _bytes = key.encode('utf-8')
+                    buf += _varint(len(_bytes) << 1 | 1)
+                    buf += _bytes
+                if key in self.shared:
+                    self._encode_shared(item, buf)
+                elif key in self.tokens and isinstance(item, str):
+                    self._encode_token(item, buf)
+                else:
+                    self._encode(item, buf)
+        else:
+            raise ValueError('Can not encode {}'.format(type(val)))
+
+    def _encode_shared(self, val, buf):
+        _value = bytearray()
+        self._encode(val, _value)
+        if len(_value) <= REF_SIZE + 1:
+            buf += _value
+            return
+
+        _value = bytes(_value)
+        _digest = hashlib.sha256(_value).digest()[:REF_SIZE]
+        if _digest not in self._known:
+            # The same value always gets the same key, so concurrent
+            # writers can not conflict.
+            self.refs.set(_digest.hex(), _value)
+            self._known[_digest] = _value
+        buf += REF
+        buf += _digest
+
+    def _encode_token(self, val, buf):
+        _prefix = val[:val.rfind('.') + 1]
+        try:
+            _raw = val[len(_prefix):].encode('ascii')
+        except UnicodeEncodeError:
+            _raw = b''
+
+        # Only if encoding gives back exactly the same payload
+        depth = 0
+        while _raw and depth < 3:
+            try:
+                _decoded = base64.urlsafe_b64decode(_raw)
+            except (binascii.Error, ValueError):
+                break
+            if base64.urlsafe_b64encode(_decoded) != _raw:
+                break
+            _raw = _decoded
+            depth += 1
+
+        if not depth:
+            self._encode(val, buf)
+            return
+
+        _bytes = _prefix.encode('utf-8')
+        buf += TOKEN
+        buf += _varint(len(_bytes))
+        buf += _bytes
+        buf.append(depth)
+        buf += _varint(len(_raw))
+        buf += _raw
+
+    def _decode_token(self, buf, pos):
+        _len, pos = _read_varint(buf, pos)
+        _prefix = bytes(buf[pos:pos + _len]).decode('utf-8')
+        pos += _len
+        depth = buf[pos]
+        _len, pos = _read_varint(buf, pos + 1)
+        _raw = bytes(buf[pos:pos + _len])
+        for _ in range(depth):
+            _raw = base64.urlsafe_b64encode(_raw)
+        return _prefix + _raw.decode('ascii'), pos + _len
+
+    def _decode(self, buf, pos):
+        typ = buf[pos:pos + 1]
+        pos += 1
+        if typ == STR:
+            _len, pos = _read_varint(buf, pos)
+            return bytes(buf[pos:pos + _len]).decode('utf-8'), pos + _len
+        elif typ == DICT:
+            _len, pos = _read_varint(buf, pos)
+            _dict = {}
+            for _ in range(_len):
+                n, pos = _read_varint(buf, pos)
+                if n & 1:
+                    _key = bytes(buf[pos:pos + (n >> 1)]).decode('utf-8')
+                    pos += n >> 1
+                else:
+                    _key = self.names[n >> 1]
+                _dict[_key], pos = self._decode(buf, pos)
+            return _dict, pos
+        elif typ == INT:
+            n, pos = _read_varint(buf, pos)
+            return (n >> 1 if not n & 1 else -((n + 1) >> 1)), pos
+        elif typ == LIST:
+            _len, pos = _read_varint(buf, pos)
+            _list = []
+            for _ in range(_len):
+                _item, pos = self._decode(buf, pos)
+                _list.append(_item)
+            return _list, pos
+        elif typ == TOKEN:
+            return self._decode_token(buf, pos)
+        elif typ == REF:
+            _digest = bytes(buf[pos:pos + REF_SIZE])
+            _val, _ = self._decode(self._shared_value(_digest), 0)
+            return _val, pos + REF_SIZE
+        elif typ == NONE:
+            return None, pos
+        elif typ == TRUE:
+            return True, pos
+        elif typ == FALSE:
+            return False, pos
+        elif typ == FLOAT:
+            return _DOUBLE.unpack_from(buf, pos)[0], pos + _DOUBLE.size
+        else:
+            raise ValueError('Unknown type {!r} at {}'.format(typ, pos - 1))
+
+    def _skip(self, buf, pos):
+        """
+        :return: The position after the value at *pos*
+        """
+        typ = buf[pos:pos + 1]
+        pos += 1
+        if typ in (STR, INT):
+            n, pos = _read_varint(buf, pos)
+            return pos + n if typ == STR else pos
+        elif typ == DICT:
+            _len, pos = _read_varint(buf, pos)
+            for _ in range(_len):
+                n, pos = _read_varint(buf, pos)
+                if n & 1:
+                    pos += n >> 1
+                pos = self._skip(buf, pos)
+            return pos
+        elif typ == LIST:
+            _len, pos = _read_varint(buf, pos)
+            for _ in range(_len):
+                pos = self._skip(buf, pos)
+            return pos
+        elif typ == TOKEN:
+            _len, pos = _read_varint(buf, pos)
+            _len, pos = _read_varint(buf, pos + _len + 1)
+            return pos + _len
+        elif typ == REF:
+            return pos + REF_SIZE
+        elif typ in (NONE, TRUE, FALSE):
+            return pos
+        elif typ == FLOAT:
+            return pos + _DOUBLE.size
+        else:
+            raise ValueError('Unknown type {!r} at {}'.format(typ, pos - 1))
+
+    def _shared_value(self, digest):
+        try:
+            return self._known[digest]
+        except KeyError:
+            pass
+
+        _value = self.refs.get(digest.hex())
+        if _value is None:
+            raise KeyError('Missing shared value {}'.format(digest.hex()))
+        self._known[digest] = _value
+        return _value
@@ -0,0 +1,84 @@
+"""
+Removal of expired and revoked sessions, a little at a time. See
+:py:meth:`oidcendpoint.session.SessionDB.collect`.
+"""
+import threading
+import time
+
+__author__ = 'Roland Hedberg'
+
+
+class SessionGC(object):
+    """
+    Runs the session garbage collector of a SessionDB, either from a
+    thread of its own, see :py:meth:`start`, or from :py:meth:`tick` which
+    is called when a request has been handled. Either way at most *limit*
+    sessions are looked at every *interval* seconds.
+
+    It becomes the SessionDB's *gc*. It should be created before sessions
+    are written, a SessionDB whose database can let values expire only
+    keeps an expiry index if it has a garbage collector.
+    """
+
+    def __init__(self, sdb, interval=60, limit=1000):
+        """
+        :param sdb: A SessionDB instance
+        :param interval: Seconds between runs
+        :param limit: Max number of sessions to look at per run
+        """
+        self.sdb = sdb
+        sdb.gc = self
+        self.interval = interval
+        self.limit = limit
+        self._last = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run(self, when=0):
+        """
+        Run the garbage collector once, unless it is already running.
+
+        :param when: Point in time to compare with, default is now
+        :return: Number of sessions removed
+        """
+        if not self._lock.acquire(blocking=False):
+            return 0
+        try:
+            self._last = time.time()
+            return self.sdb.collect(self.limit, when)
+        finally:
+            self._lock.release()
+
+    def tick(self):
+        """
+        Run the garbage collector if it is time to.
+
+        :return: Number of sessions removed
+        """
+        if time.time() - self._last < self.interval:
+            return 0
+        return self.run()
+
+    def start(self):
+        """
+        Run the garbage collector every *interval* seconds in a daemon
+        thread.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop,
+                                        name='session-gc', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.run()
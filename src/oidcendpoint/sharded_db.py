@@ -0,0 +1,311 @@
+"""
+A key-value store that spreads the keys over several stores, shards, so
+that no single store is a point of contention.
+"""
+import bisect
+import contextlib
+import hashlib
+
+__author__ = 'Roland Hedberg'
+
+
+def _hash(text):
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.md5(text.encode('utf-8')).digest()[:8],
+                          'big')
+
+
+class HashRing(object):
+    """
+    Consistent hashing. Every node has *replicas* points on a ring and a
+    key belongs to the node of the first point after the key's hash. When
+    a node is added only the keys that move to it change node, about
+    1/N of them.
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        """
+        :param nodes: Names of the nodes
+        :param replicas: Number of points per node
+        """
+        self.replicas = replicas
+        self._points = []
+        self._nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            _point = _hash('{}#{}'.format(node, i))
+            _pos = bisect.bisect(self._points, _point)
+            self._points.insert(_pos, _point)
+            self._nodes.insert(_pos, node)
+
+    def remove(self, node):
+        _keep = [(p, n) for p, n in zip(self._points, self._nodes)
+                 if n != node]
+        self._points = [p for p, _ in _keep]
+        self._nodes = [n for _, n in _keep]
+
+    def node(self, key):
+        """
+        :param key: A key
+        :return: The name of the node the key belongs to
+        """
+        _pos = bisect.bisect(self._points, _hash(key))
+        if _pos == len(self._points):
+            _pos = 0
+        return self._nodes[_pos]
+
+
+class ShardedDataBase(object):
+    """
+    Routes every key to one of a number of stores, by consistent hashing
+    of the key, and has the interface of those stores, see
+    InMemoryDataBase. The stores can be of different kinds, for instance
+    in-memory, shelve and SQLite.
+
+    Values are kept as they are (*native*) only if every store does so,
+    and have a time to live only if every store supports it. The optional
+    methods (set_fields, prune, batch, ttl, lock and lock_many) are there
+    only if every store has them. get_many and set_many do one call per
+    store.
+
+    Keys are moved to a store that is added, see :py:meth:`add_shard`.
+    Until the move is done, keys that are not found in the store they
+    belong to are looked for in the store they belonged to before.
+    """
+
+    def __init__(self, shards, replicas=64):
+        """
+        :param shards: Dictionary of shard name and store. The names decide
+            where keys go and must be the same every time.
+        :param replicas: Number of points per shard on the hash ring
+        """
+        self.shards = dict(shards)
+        self.ring = HashRing(self.shards, replicas)
+        self._previous = None
+        self._capabilities()
+
+    def _capabilities(self):
+        _shards = list(self.shards.values())
+        self.native = all(getattr(s, 'native', False) for s in _shards)
+        self.supports_ttl = all(getattr(s, 'supports_ttl', False)
+                                for s in _shards)
+        for name in ['set_fields', 'prune', 'batch', 'ttl', 'lock',
+                     'lock_many']:
+            if all(hasattr(s, name) for s in _shards):
+                setattr(self, name, getattr(self, '_' + name))
+            else:
+                self.__dict__.pop(name, None)
+
+    def shard(self, key):
+        """
+        :param key: A key
+        :return: The store the key belongs to
+        """
+        return self.shards[self.ring.node(key)]
+
+    def _group(self, keys):
+        _groups = {}
+        for key in keys:
+            _groups.setdefault(self.ring.node(key), []).append(key)
+        return _groups
+
+    def get(self, key):
+        _val = self.shard(key).get(key)
+        if _val is None and self._previous is not None:
+            return self.shards[self._previous.node(key)].get(key)
+        return _val
+
+    def set(self, key, value, ttl=0):
+        _shard = self.shard(key)
+        if ttl and getattr(_shard, 'supports_ttl', False):
+            _shard.set(key, value, ttl=ttl)
+        else:
+            _shard.set(key, value)
+
+    def delete(self, key):
+        _shard = self.shard(key)
+        if self._previous is None:
+            _shard.delete(key)
+            return
+
+        # It may still be where it was
+        _found = False
+        for _store in {_shard, self.shards[self._previous.node(key)]}:
+            try:
+                _store.delete(key)
+            except KeyError:
+                pass
+            else:
+                _found = True
+        if not _found:
+            raise KeyError(key)
+
+    def get_many(self, keys):
+        """
+        :param keys: The keys
+        :return: Dictionary with the keys that have values and the values
+        """
+        res = {}
+        for node, _keys in self._group(keys).items():
+            _shard = self.shards[node]
+            try:
+                res.update(_shard.get_many(_keys))
+            except AttributeError:
+                for key in _keys:
+                    _val = _shard.get(key)
+                    if _val is not None:
+                        res[key] = _val
+
+        if self._previous is not None:
+            _missing = [key for key in keys if key not in res]
+            for key in _missing:
+                _val = self.get(key)
+                if _val is not None:
+                    res[key] = _val
+        return res
+
+    def set_many(self, items, ttl=0):
+        """
+        :param items: Iterable of (key, value) tuples
+        :param ttl: Time to live in seconds for all of them, 0 means forever
+        """
+        _groups = {}
+        for key, value in items:
+            _groups.setdefault(self.ring.node(key), []).append((key, value))
+
+        for node, _items in _groups.items():
+            _shard = self.shards[node]
+            try:
+                _set_many = _shard.set_many
+            except AttributeError:
+                for key, value in _items:
+                    self.set(key, value, ttl)
+                continue
+            if ttl and getattr(_shard, 'supports_ttl', False):
+                _set_many(_items, ttl=ttl)
+            else:
+                _set_many(_items)
+
+    def _set_fields(self, key, **kwargs):
+        try:
+            self.shard(key).set_fields(key, **kwargs)
+        except KeyError:
+            if self._previous is None:
+                raise
+            self._move(key, self.shards[self._previous.node(key)],
+                       self.shard(key))
+            self.shard(key).set_fields(key, **kwargs)
+
+    def _prune(self, when=0):
+        """
+        :return: Total of what the stores' prune methods returned
+        """
+        return sum(s.prune(when) for s in self.shards.values())
+
+    def _ttl(self, key):
+        """
+        :param key: The key
+        :return: Seconds left to live, 0 if the value lives forever
+        """
+        _shard = self.shard(key)
+        if self._previous is not None and _shard.get(key) is None:
+            _shard = self.shards[self._previous.node(key)]
+        return _shard.ttl(key)
+
+    def _lock(self, key):
+        """
+        :param key: A key
+        :return: The lock of the key, in the store the key belongs to
+        """
+        return self.shard(key).lock(key)
+
+    @contextlib.contextmanager
+    def _lock_many(self, keys):
+        """
+        Holds the locks of the keys in every store they belong to. The
+        stores are taken in name order, so there can be no deadlock.
+        """
+        _groups = self._group(keys)
+        with contextlib.ExitStack() as stack:
+            for node in sorted(_groups):
+                stack.enter_context(self.shards[node].lock_many(_groups[node]))
+            yield self
+
+    @contextlib.contextmanager
+    def _batch(self):
+        """
+        A batch in every store, each store commits its own.
+        """
+        with contextlib.ExitStack() as stack:
+            for _shard in self.shards.values():
+                stack.enter_context(_shard.batch())
+            yield self
+
+    def __len__(self):
+        return sum(len(s) for s in self.shards.values())
+
+    def keys(self):
+        res = []
+        for _shard in self.shards.values():
+            res.extend(_shard.keys())
+        return res
+
+    @staticmethod
+    def _move(key, src, dst):
+        """
+        Move a value between stores, with what is left of its time to
+        live. A value already in the destination is newer and is kept.
+
+        :return: True if the value was moved
+        """
+        _val = src.get(key)
+        if _val is None:
+            return False
+
+        if dst.get(key) is None:
+            _ttl = src.ttl(key) if hasattr(src, 'ttl') else 0
+            if _ttl and getattr(dst, 'supports_ttl', False):
+                dst.set(key, _val, ttl=_ttl)
+            else:
+                dst.set(key, _val)
+        src.delete(key)
+        return True
+
+    def add_shard(self, name, store, rebalance=True):
+        """
+        Add a store. The keys that now belong to it are moved from the
+        other stores, which must be able to list their keys. Meanwhile all
+        keys can be read and written.
+
+        :param name: Name of the shard
+        :param store: The store
+        :param rebalance: Whether to move the keys now, otherwise call
+            :py:meth:`rebalance`
+        :return: Number of keys moved
+        """
+        self._previous = HashRing(self.shards, self.ring.replicas)
+        self.shards[name] = store
+        self.ring.add(name)
+        self._capabilities()
+        if rebalance:
+            return self.rebalance()
+        return 0
+
+    def rebalance(self):
+        """
+        Move keys to the stores they belong to.
+
+        :return: Number of keys moved
+        """
+        n = 0
+        for node, _shard in list(self.shards.items()):
+            for key in _shard.keys():
+                _owner = self.ring.node(key)
+                if _owner != node and self._move(key, _shard,
+                                                 self.shards[_owner]):
+                    n += 1
+        self._previous = None
+        return n
@@ -1,48 +1,119 @@
+import os
 import shelve
+import threading
 
 __author__ = 'danielevertsson'
 
 
 class ShelfWrapper(object):
-    def __init__(self, filename):
+    """
+    A dictionary like interface to a shelf.
+
+    The shelf is opened on first use and then kept open, one handle per
+    process. Changes are written to disk by :py:meth:`sync`, which is also
+    done after every *sync_every* writes, and by :py:meth:`close`.
+    A *sync_every* of 0 means only on explicit sync and close.
+
+    Several processes may read the shelf but only one should write to it,
+    other handles do not see the changes and may overwrite them.
+
+    It can also be used as a key-value store, with set and delete. Values
+    are pickled, copies are stored, and there is no time to live.
+    """
+    native = False
+    supports_ttl = False
+
+    def __init__(self, filename, sync_every=1):
         self.filename = filename
+        self.sync_every = sync_every
+        self._db = None
+        self._inherited = None
+        self._pid = None
+        self._writes = 0
+        self._lock = threading.RLock()
+
+    def _shelf(self):
+        _pid = os.getpid()
+        if self._db is None or self._pid != _pid:
+            # A handle inherited from the parent process is not used, nor
+            # closed since that would write the parent's index.
+            self._inherited = self._db
+            self._db = shelve.open(self.filename)
+            self._pid = _pid
+            self._writes = 0
+        return self._db
 
     def keys(self):
-        db = self._reopen_database()
-        return db.keys()
+        with self._lock:
+            return list(self._shelf().keys())
 
     def __len__(self):
-        db = self._reopen_database()
-        return db.__len__()
+        with self._lock:
+            return len(self._shelf())
 
     def has_key(self, key):
         return key in self
 
     def __contains__(self, key):
-        db = self._reopen_database()
-        return db.__contains__(key)
+        with self._lock:
+            return key in self._shelf()
 
     def get(self, key, default=None):
-        db = self._reopen_database()
-        return db.get(key, default)
+        with self._lock:
+            return self._shelf().get(key, default)
 
     def __getitem__(self, key):
-        db = self._reopen_database()
-        return db.__getitem__(key)
+        with self._lock:
+            return self._shelf()[key]
 
     def __setitem__(self, key, value):
-        db = self._reopen_database()
-        db.__setitem__(key, value)
+        with self._lock:
+            self._shelf()[key] = value
+            self._written()
 
     def __delitem__(self, key):
-        db = self._reopen_database()
-        db.__delitem__(key)
-
-    def _reopen_database(self):
-        return shelve.open(self.filename, writeback=True)
-
-
-def open(filename):
+        with self._lock:
+            del self._shelf()[key]
+            self._written()
+
+    def set(self, key, value, ttl=0):
+        """
+        :param key: The key
+        :param value: The value
+        :param ttl: Not used, values are kept until deleted
+        """
+        self[key] = value
+
+    def delete(self, key):
+        del self[key]
+
+    def _written(self):
+        self._writes += 1
+        if self.sync_every and self._writes >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        """
+        Write all changes to disk.
+        """
+        with self._lock:
+            if self._db is not None and self._pid == os.getpid():
+                self._db.sync()
+            self._writes = 0
+
+    def close(self):
+        """
+        Write all changes to disk and close the shelf. It is opened again
+        if used after this.
+        """
+        with self._lock:
+            if self._db is not None and self._pid == os.getpid():
+                self._db.close()
+            self._db = None
+            self._writes = 0
+
+
+def open(filename, sync_every=1):
     """Open a persistent dictionary for reading and writing.
 
     The filename parameter is the base filename for the underlying
@@ -52,7 +123,10 @@ def open(filename):
     anydbm.open(). The optional protocol parameter specifies the
     version of the pickle protocol (0, 1, or 2).
 
+    Changes are written to disk after every *sync_every* writes, 0 means
+    only when sync() or close() is called.
+
     See the module's __doc__ string for an overview of the interface.
     """
 
-    return ShelfWrapper(filename)
+    return ShelfWrapper(filename, sync_every)
@@ -0,0 +1,384 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from oidcendpoint.sso_db import SSODb
+
+__author__ = 'Roland Hedberg'
+
+# Max number of values in an IN clause
+MAX_PARAMS = 500
+
+
+class Batch(object):
+    """
+    Writes done within a batch are committed together when the outermost
+    batch ends, or rolled back if it ends with an exception.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        self.store._con()
+        self.store._local.batch += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local = self.store._local
+        _local.batch -= 1
+        if _local.batch == 0:
+            if exc_type is None:
+                _local.con.commit()
+            else:
+                _local.con.rollback()
+        return False
+
+
+class SQLiteBase(object):
+    """
+    Connection handling shared by the SQLite stores. There is one
+    connection per thread and process, a connection must not be used in a
+    forked child. The database runs in WAL mode which lets readers, also
+    in other processes, go on while there is a writer.
+    """
+    schema = ''
+
+    def __init__(self, filename, timeout=10.0):
+        self.filename = filename
+        self.timeout = timeout
+        self._local = threading.local()
+        with self._con() as con:
+            con.executescript(self.schema)
+
+    def _con(self):
+        _pid = os.getpid()
+        if getattr(self._local, 'pid', None) != _pid:
+            con = sqlite3.connect(self.filename, timeout=self.timeout)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            self._local.con = con
+            self._local.pid = _pid
+            self._local.batch = 0
+        return self._local.con
+
+    def _read(self, sql, args=()):
+        return self._con().execute(sql, args)
+
+    def _write(self, sql, args=()):
+        con = self._con()
+        if self._local.batch:
+            return con.execute(sql, args)
+        with con:
+            return con.execute(sql, args)
+
+    def _write_many(self, sql, rows):
+        con = self._con()
+        if self._local.batch:
+            return con.executemany(sql, rows)
+        with con:
+            return con.executemany(sql, rows)
+
+    def _read_in(self, sql, values, args=()):
+        """
+        Run a query with an IN clause, in chunks to stay below the limit
+        on the number of parameters.
+
+        :param sql: The query with {} where the placeholders go
+        :param values: The values for the IN clause
+        :param args: Arguments after the IN clause
+        :return: The rows
+        """
+        values = list(values)
+        _rows = []
+        for i in range(0, len(values), MAX_PARAMS):
+            _chunk = values[i:i + MAX_PARAMS]
+            _sql = sql.format(', '.join('?' * len(_chunk)))
+            _rows.extend(self._read(_sql, _chunk + list(args)).fetchall())
+        return _rows
+
+    def batch(self):
+        """
+        Usage::
+
+            with store.batch():
+                store.set(...)
+                store.set(...)
+
+        :return: A Batch instance
+        """
+        return Batch(self)
+
+    def close(self):
+        try:
+            self._local.con.close()
+        except AttributeError:
+            pass
+        self._local = threading.local()
+
+
+class SQLiteDataBase(SQLiteBase):
+    """
+    A key-value store in a SQLite database, with the same interface as
+    InMemoryDataBase. It can be shared by all the worker processes on a
+    host.
+
+    Values are strings or bytes, what the SessionDB codec produces. Expired
+    values are never returned and are removed every *sweep* writes.
+    """
+    native = False
+    supports_ttl = True
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS {table} ('
+        ' key TEXT PRIMARY KEY, value TEXT NOT NULL, exp REAL'
+        ') WITHOUT ROWID;'
+        'CREATE INDEX IF NOT EXISTS {table}_exp ON {table} (exp);')
+
+    def __init__(self, filename, table='session', sweep=1000, timeout=10.0):
+        self.table = table
+        self.schema = self.schema.format(table=table)
+        self.sweep = sweep
+        self._writes = 0
+        SQLiteBase.__init__(self, filename, timeout)
+
+    def set(self, key, value, ttl=0):
+        """
+        :param key: The key
+        :param value: The value, a string or bytes
+        :param ttl: Time to live in seconds, 0 means forever
+        """
+        _exp = time.time() + ttl if ttl > 0 else None
+        self._write(
+            'INSERT OR REPLACE INTO {} (key, value, exp)'
+            ' VALUES (?, ?, ?)'.format(self.table), (key, value, _exp))
+
+        self._writes += 1
+        if self._writes >= self.sweep:
+            self._writes = 0
+            self.prune()
+
+    def get(self, key):
+        _row = self._read(
+            'SELECT value FROM {} WHERE key = ?'
+            ' AND (exp IS NULL OR exp > ?)'.format(self.table),
+            (key, time.time())).fetchone()
+        if _row is None:
+            return None
+        return _row[0]
+
+    def get_many(self, keys):
+        """
+        :param keys: The keys
+        :return: Dictionary with the keys that have values and the values
+        """
+        _rows = self._read_in(
+            'SELECT key, value FROM {} WHERE key IN ({{}})'
+            ' AND (exp IS NULL OR exp > ?)'.format(self.table), keys,
+            (time.time(),))
+        return dict(_rows)
+
+    def set_many(self, items, ttl=0):
+        """
+        Set several values in one transaction.
+
+        :param items: Iterable of (key, value) tuples
+        :param ttl: Time to live in seconds for all of them, 0 means forever
+        """
+        _exp = time.time() + ttl if ttl > 0 else None
+        _rows = [(key, value, _exp) for key, value in items]
+        self._write_many(
+            'INSERT OR REPLACE INTO {} (key, value, exp)'
+            ' VALUES (?, ?, ?)'.format(self.table), _rows)
+
+        self._writes += len(_rows)
+        if self._writes >= self.sweep:
+            self._writes = 0
+            self.prune()
+
+    def delete(self, key):
+        _cur = self._write('DELETE FROM {} WHERE key = ?'.format(self.table),
+                           (key,))
+        if _cur.rowcount == 0:
+            raise KeyError(key)
+
+    def set_fields(self, key, **kwargs):
+        """
+        Change some of the fields of a stored JSON document. The update is
+        done in the database, the document is not read. Values that are
+        not JSON documents can not be changed this way.
+
+        :param key: The key of the record
+        :param kwargs: Field names and values
+        """
+        if not kwargs:
+            return
+
+        _paths = []
+        _args = []
+        for field, value in kwargs.items():
+            _paths.append("'$.\"{}\"', json(?)".format(field))
+            _args.append(json.dumps(value))
+        _args.append(key)
+
+        _cur = self._write(
+            'UPDATE {} SET value = json_set(value, {}) WHERE key = ?'.format(
+                self.table, ', '.join(_paths)), _args)
+        if _cur.rowcount == 0:
+            raise KeyError(key)
+
+    def prune(self, when=0):
+        """
+        Remove values that have expired.
+
+        :param when: Point in time to compare with, default is now
+        :return: Number of values removed
+        """
+        if not when:
+            when = time.time()
+        return self._write('DELETE FROM {} WHERE exp < ?'.format(self.table),
+                           (when,)).rowcount
+
+    def __len__(self):
+        return self._read(
+            'SELECT COUNT(*) FROM {} WHERE exp IS NULL OR exp > ?'.format(
+                self.table), (time.time(),)).fetchone()[0]
+
+    def keys(self):
+        """
+        :return: List of the keys of values that have not expired
+        """
+        return [r[0] for r in self._read(
+            'SELECT key FROM {} WHERE exp IS NULL OR exp > ?'.format(
+                self.table), (time.time(),)).fetchall()]
+
+    def ttl(self, key):
+        """
+        :param key: The key
+        :return: Seconds left to live, 0 if the value lives forever
+        """
+        _row = self._read('SELECT exp FROM {} WHERE key = ?'.format(
+            self.table), (key,)).fetchone()
+        if _row is None or _row[0] is None:
+            return 0
+        return max(_row[0] - time.time(), 0)
+
+
+class SQLiteSSODb(SQLiteBase, SSODb):
+    """
+    A SSODb kept in a SQLite database. The connections between session IDs
+    and user IDs and between session IDs and subject IDs are rows in two
+    tables, with indexes on every column, so every lookup is an index
+    seek. The label based interface of SSODb is mapped onto the tables.
+    """
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS sso_uid ('
+        ' sid TEXT NOT NULL, uid TEXT NOT NULL, UNIQUE (uid, sid));'
+        'CREATE INDEX IF NOT EXISTS sso_uid_sid ON sso_uid (sid);'
+        'CREATE TABLE IF NOT EXISTS sso_sub ('
+        ' sid TEXT NOT NULL, sub TEXT NOT NULL, UNIQUE (sub, sid));'
+        'CREATE INDEX IF NOT EXISTS sso_sub_sid ON sso_sub (sid);')
+
+    # label -> table, key column, value column
+    LABEL = {
+        'uid2sid': ('sso_uid', 'uid', 'sid'),
+        'sid2uid': ('sso_uid', 'sid', 'uid'),
+        'sub2sid': ('sso_sub', 'sub', 'sid'),
+        'sid2sub': ('sso_sub', 'sid', 'sub'),
+    }
+
+    def __init__(self, filename, timeout=10.0):
+        SQLiteBase.__init__(self, filename, timeout)
+        self.ttl = 0
+
+    def set(self, label, key, value):
+        _table, _kcol, _vcol = self.LABEL[label]
+        self._write(
+            'INSERT OR IGNORE INTO {} ({}, {}) VALUES (?, ?)'.format(
+                _table, _kcol, _vcol), (key, value))
+
+    def get(self, label, key):
+        _table, _kcol, _vcol = self.LABEL[label]
+        _rows = self._read(
+            'SELECT {} FROM {} WHERE {} = ? ORDER BY rowid'.format(
+                _vcol, _table, _kcol), (key,)).fetchall()
+        if not _rows:
+            return None
+        return [r[0] for r in _rows]
+
+    def delete(self, label, key):
+        _table, _kcol, _vcol = self.LABEL[label]
+        self._write('DELETE FROM {} WHERE {} = ?'.format(_table, _kcol),
+                    (key,))
+
+    def remove(self, label, key, value):
+        _table, _kcol, _vcol = self.LABEL[label]
+        self._write(
+            'DELETE FROM {} WHERE {} = ? AND {} = ?'.format(_table, _kcol,
+                                                            _vcol),
+            (key, value))
+
+    # A row is both directions, one write is enough
+
+    def map_sid2uid(self, sid, uid):
+        self.set('sid2uid', sid, uid)
+
+    def map_sid2sub(self, sid, sub):
+        self.set('sid2sub', sid, sub)
+
+    def map_sid(self, sid, uid=None, sub=None):
+        with self.batch():
+            if uid is not None:
+                self.map_sid2uid(sid, uid)
+            if sub is not None:
+                self.map_sid2sub(sid, sub)
+
+    def remove_sid2uid(self, sid, uid):
+        self.remove('sid2uid', sid, uid)
+
+    def remove_sid2sub(self, sid, sub):
+        self.remove('sid2sub', sid, sub)
+
+    def remove_session_id(self, sid):
+        with self.batch():
+            self.delete('sid2uid', sid)
+            self.delete('sid2sub', sid)
+
+    def remove_uid(self, uid):
+        self.delete('uid2sid', uid)
+
+    def remove_uids(self, uids):
+        uids = list(uids)
+        with self.batch():
+            for i in range(0, len(uids), MAX_PARAMS):
+                _chunk = uids[i:i + MAX_PARAMS]
+                self._write('DELETE FROM sso_uid WHERE uid IN ({})'.format(
+                    ', '.join('?' * len(_chunk))), _chunk)
+
+    def remove_sub(self, sub):
+        self.delete('sub2sid', sub)
+
+    def get_subs_by_uid(self, uid):
+        _rows = self._read(
+            'SELECT DISTINCT s.sub FROM sso_uid u JOIN sso_sub s'
+            ' ON u.sid = s.sid WHERE u.uid = ?', (uid,)).fetchall()
+        return {r[0] for r in _rows}
+
+    def get_sessions_for_uids(self, uids):
+        res = {}
+        for uid, sid in self._read_in(
+                'SELECT uid, sid FROM sso_uid WHERE uid IN ({})'
+                ' ORDER BY rowid', uids):
+            res.setdefault(uid, []).append(sid)
+        return res
+
+    def get_subs_by_uids(self, uids):
+        res = {}
+        for uid, sub in self._read_in(
+                'SELECT DISTINCT u.uid, s.sub FROM sso_uid u JOIN sso_sub s'
+                ' ON u.sid = s.sid WHERE u.uid IN ({})', uids):
+            res.setdefault(uid, set()).add(sub)
+        return res
@@ -1,3 +1,6 @@
+import json
+import threading
+
 from oidcendpoint.in_memory_db import InMemoryDataBase
 
 KEY_FORMAT = '__{}__{}'
@@ -11,23 +14,99 @@ class SSODb(object):
     can appear in more the one session.
     So, we have chains like this:
         session id->subject id->user id
+
+    The values connected to a key are kept in a dictionary used as an
+    ordered set, so adding and removing one is O(1). If the store keeps
+    values as they are (the store's *native* attribute) the set is changed
+    in place, otherwise it is written back, as a JSON list since such a
+    store may only take strings.
+
+    A set is read, changed and written back holding a lock. The lock of the
+    key if the store has per key locks, see
+    :py:class:`oidcendpoint.thread_safe.ThreadSafeDataBase`, otherwise one
+    lock for the whole SSODb.
     """
 
-    def __init__(self, db=None):
-        self._db = db or InMemoryDataBase()
+    def __init__(self, db=None, ttl=0):
+        """
+        :param db: The key-value store to use
+        :param ttl: How long, in seconds, a connection is kept after it
+            was last changed, at least. A connection is kept as long as the
+            session, see :py:meth:`refresh`. 0 means forever. Only used if
+            the store supports it.
+        """
+        if db is None:
+            db = InMemoryDataBase()
+        self._db = db
+        self.ttl = ttl
+        self._in_place = getattr(db, 'native', False)
+        self._lock = threading.RLock()
+        self._key_lock = getattr(db, 'lock', None)
+
+    def _lock_for(self, key):
+        if self._key_lock is None:
+            return self._lock
+        return self._key_lock(key)
+
+    def _get(self, key):
+        _values = self._db.get(key)
+        if _values and not self._in_place:
+            return dict.fromkeys(json.loads(_values))
+        return _values
+
+    def _set(self, key, values, ttl=None):
+        if not self._in_place:
+            values = json.dumps(list(values))
+        if ttl is None:
+            ttl = self.ttl
+        if ttl and getattr(self._db, 'supports_ttl', False):
+            self._db.set(key, values, ttl=ttl)
+        else:
+            self._db.set(key, values)
+
+    def _keep_ttl(self, key, ttl):
+        """
+        :return: A time to live that is not shorter than what the value
+            has left, 0 means forever
+        """
+        if not ttl:
+            return 0
+        try:
+            _left = self._db.ttl(key)
+        except AttributeError:
+            return ttl
+        if not _left:  # The value is there and lives forever
+            return 0
+        return max(ttl, _left)
+
+    def _changed(self, key, values):
+        # Written back to update the time to live or if it is a copy
+        if self.ttl:
+            self._set(key, values, self._keep_ttl(key, self.ttl))
+        elif not self._in_place:
+            self._set(key, values)
+
+    def _values(self, label, key):
+        return self._get(KEY_FORMAT.format(label, key)) or {}
 
     def set(self, label, key, value):
         _key = KEY_FORMAT.format(label, key)
-        _values = self._db.get(_key)
-        if not _values:
-            self._db.set(_key, [value])
-        else:
-            _values.append(value)
-            self._db.set(_key, _values)
+        with self._lock_for(_key):
+            _values = self._get(_key)
+            if not _values:
+                self._set(_key, {value: None})
+            elif value not in _values:
+                _values[value] = None
+                self._changed(_key, _values)
 
     def get(self, label, key):
-        _key = KEY_FORMAT.format(label, key)
-        return self._db.get(_key)
+        """
+        :return: A list of values or None if there are none
+        """
+        _values = self._get(KEY_FORMAT.format(label, key))
+        if not _values:
+            return None
+        return list(_values)
 
     def delete(self, label, key):
         _key = KEY_FORMAT.format(label, key)
@@ -35,18 +114,112 @@ class SSODb(object):
 
     def remove(self, label, key, value):
         _key = KEY_FORMAT.format(label, key)
-        _values = self._db.get(_key)
-        if _values:
-            try:
-                _values.remove(value)
-            except ValueError:
-                pass
-            else:
+        with self._lock_for(_key):
+            _values = self._get(_key)
+            if _values and value in _values:
+                del _values[value]
                 if _values:
-                    self._db.set(_key, _values)
+                    self._changed(_key, _values)
                 else:
                     self._db.delete(_key)
 
+    def _get_many(self, label, keys):
+        """
+        Values for several keys, with one call to the store if it has a
+        get_many method.
+
+        :return: Dictionary with the keys that have values and the values
+        """
+        _keys = {KEY_FORMAT.format(label, key): key for key in keys}
+        try:
+            _values = self._db.get_many(list(_keys))
+        except AttributeError:
+            _values = {k: self._db.get(k) for k in _keys}
+        if not self._in_place:
+            return {_keys[k]: dict.fromkeys(json.loads(v))
+                    for k, v in _values.items() if v}
+        return {_keys[k]: v for k, v in _values.items() if v}
+
+    def _lock_many(self, keys):
+        if self._key_lock is None:
+            return self._lock
+        return self._db.lock_many(keys)
+
+    def map_sid(self, sid, uid=None, sub=None):
+        """
+        Store the connections between a Session ID and a User ID and/or a
+        subject ID, in both directions. The sets are read and written
+        together, holding the locks of all of them, with one call each if
+        the store has get_many and set_many methods.
+
+        :param sid: Session ID
+        :param uid: User ID
+        :param sub: Subject ID
+        """
+        _add = []
+        if uid is not None:
+            _add.extend([('sid2uid', sid, uid), ('uid2sid', uid, sid)])
+        if sub is not None:
+            _add.extend([('sid2sub', sid, sub), ('sub2sid', sub, sid)])
+        if not _add:
+            return
+
+        _keys = [KEY_FORMAT.format(label, key) for label, key, _ in _add]
+        with self._lock_many(_keys):
+            try:
+                _stored = self._db.get_many(_keys)
+            except AttributeError:
+                _stored = {k: self._db.get(k) for k in _keys}
+
+            # time to live -> [(key, values)]
+            _writes = {}
+            for _key, (_, _, value) in zip(_keys, _add):
+                _values = _stored.get(_key)
+                if not _values:
+                    _writes.setdefault(self.ttl, []).append(
+                        (_key, {value: None}))
+                    continue
+                if not self._in_place:
+                    _values = dict.fromkeys(json.loads(_values))
+                if value in _values:
+                    continue
+                _values[value] = None
+                if self.ttl:
+                    _writes.setdefault(self._keep_ttl(_key, self.ttl),
+                                       []).append((_key, _values))
+                elif not self._in_place:
+                    _writes.setdefault(0, []).append((_key, _values))
+
+            try:
+                _batch = self._db.batch
+            except AttributeError:
+                self._set_many(_writes)
+            else:
+                with _batch():
+                    self._set_many(_writes)
+
+    def _set_many(self, writes):
+        """
+        :param writes: Dictionary with time to live and list of key and
+            set tuples
+        """
+        try:
+            _set_many = self._db.set_many
+        except AttributeError:
+            for ttl, items in writes.items():
+                for key, values in items:
+                    self._set(key, values, ttl)
+            return
+
+        _ttl = getattr(self._db, 'supports_ttl', False)
+        for ttl, items in writes.items():
+            if not self._in_place:
+                items = [(k, json.dumps(list(v))) for k, v in items]
+            if ttl and _ttl:
+                _set_many(items, ttl=ttl)
+            else:
+                _set_many(items)
+
     def map_sid2uid(self, sid, uid):
         """
         Store the connection between a Session ID and a User ID
@@ -67,6 +240,42 @@ class SSODb(object):
         self.set('sid2sub', sid, sub)
         self.set('sub2sid', sub, sid)
 
+    def refresh(self, sid, ttl):
+        """
+        Keep the connections of a session at least as long as the session,
+        if they have a time to live. Nothing is written unless they would
+        otherwise go before the session.
+
+        :param sid: Session ID
+        :param ttl: The lifetime of the session, 0 means forever
+        """
+        if not self.ttl or not getattr(self._db, 'supports_ttl', False):
+            return
+
+        try:
+            _left = self._db.ttl(KEY_FORMAT.format('sid2uid', sid))
+        except AttributeError:
+            pass
+        else:
+            if 0 < ttl <= _left:
+                return
+
+        if ttl > 0:
+            ttl = max(ttl, self.ttl)
+        for label, reverse in [('sid2uid', 'uid2sid'), ('sid2sub', 'sub2sid')]:
+            _key = KEY_FORMAT.format(label, sid)
+            with self._lock_for(_key):
+                _values = self._get(_key)
+                if not _values:
+                    continue
+                self._set(_key, _values, ttl)
+            for value in _values:
+                _rkey = KEY_FORMAT.format(reverse, value)
+                with self._lock_for(_rkey):
+                    _rvalues = self._get(_rkey)
+                    if _rvalues:
+                        self._set(_rkey, _rvalues, self._keep_ttl(_rkey, ttl))
+
     def get_sids_by_uid(self, uid):
         """
         Return a list of session IDs that this user is connected to.
@@ -107,8 +316,39 @@ class SSODb(object):
         :return: A set of subject identifiers
         """
         res = set()
-        for sid in self.get('uid2sid', uid):
-            res |= set(self.get('sid2sub', sid))
+        for sid in self._values('uid2sid', uid):
+            res.update(self._values('sid2sub', sid))
+        return res
+
+    def get_sessions_for_uids(self, uids):
+        """
+        Find the session IDs of a number of users.
+
+        :param uids: User IDs
+        :return: Dictionary with User ID and list of session IDs, users
+            without sessions are left out
+        """
+        return {uid: list(sids)
+                for uid, sids in self._get_many('uid2sid', uids).items()}
+
+    def get_subs_by_uids(self, uids):
+        """
+        Find the subject identifiers of a number of users.
+
+        :param uids: User IDs
+        :return: Dictionary with User ID and set of subject identifiers,
+            users without any are left out
+        """
+        _sids = self._get_many('uid2sid', uids)
+        _all = {sid for sids in _sids.values() for sid in sids}
+        _subs = self._get_many('sid2sub', _all)
+        res = {}
+        for uid, sids in _sids.items():
+            _uid_subs = set()
+            for sid in sids:
+                _uid_subs.update(_subs.get(sid, ()))
+            if _uid_subs:
+                res[uid] = _uid_subs
         return res
 
     def remove_sid2sub(self, sid, sub):
@@ -137,13 +377,15 @@ class SSODb(object):
 
         :param sid: A Session ID
         """
-        for uid in self.get('sid2uid', sid):
-            self.remove('uid2sid', uid, sid)
-        self.delete('sid2uid', sid)
+        _uids = self.get('sid2uid', sid)
+        if _uids:
+            for uid in _uids:
+                self.remove_sid2uid(sid, uid)
 
-        for sub in self.get('sid2sub', sid):
-            self.remove('sub2sid', sub, sid)
-        self.delete('sid2uid', sid)
+        _subs = self.get('sid2sub', sid)
+        if _subs:
+            for sub in _subs:
+                self.remove_sid2sub(sid, sub)
 
     def remove_uid(self, uid):
         """
@@ -155,6 +397,16 @@ class SSODb(object):
             self.remove('sid2uid', sid, uid)
         self.delete('uid2sid', uid)
 
+    def remove_uids(self, uids):
+        """
+        Remove all references to a number of User IDs
+
+        :param uids: User IDs
+        """
+        for uid in uids:
+            if self.get('uid2sid', uid):
+                self.remove_uid(uid)
+
     def remove_sub(self, sub):
         """
         Remove all references to a specific Subject ID
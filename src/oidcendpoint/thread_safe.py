@@ -0,0 +1,148 @@
+"""
+Locking for stores used by threads. Keys are spread over a fixed number of
+locks, stripes, by their hash, so threads working on different keys seldom
+wait for each other while those working on the same key take turns.
+"""
+import threading
+
+__author__ = 'Roland Hedberg'
+
+
+class NoLock(object):
+    """
+    A lock that does nothing, for stores that need no locking.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NO_LOCK = NoLock()
+
+
+class StripedLocks(object):
+    """
+    Re-entrant locks, one per stripe. A thread holding the lock of one key
+    must not ask for the lock of another key, except through
+    :py:meth:`many`, since two threads could then wait for each other.
+    """
+
+    def __init__(self, stripes=64):
+        """
+        :param stripes: Number of locks
+        """
+        self._locks = [threading.RLock() for _ in range(stripes)]
+
+    def __call__(self, key):
+        """
+        :param key: A key
+        :return: The lock of the key
+        """
+        return self._locks[hash(key) % len(self._locks)]
+
+    def many(self, keys):
+        """
+        :param keys: Keys
+        :return: A context manager holding the locks of all the keys
+        """
+        _n = len(self._locks)
+        _stripes = sorted({hash(key) % _n for key in keys})
+        return _Held([self._locks[i] for i in _stripes])
+
+
+class _Held(object):
+    # Locks are always taken in stripe order, so there can be no deadlock
+
+    def __init__(self, locks):
+        self.locks = locks
+
+    def __enter__(self):
+        for lock in self.locks:
+            lock.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for lock in reversed(self.locks):
+            lock.release()
+        return False
+
+
+class ThreadSafeDataBase(object):
+    """
+    Wraps a key-value store so that it can be used by several threads.
+    Every operation on a key holds the lock of the key. SessionDB and SSODb
+    also hold it, through :py:meth:`lock`, while they read, change and
+    write back a value, so concurrent changes of a value are not lost.
+
+    Everything else is passed on to the wrapped store. The optional
+    methods, set_fields, get_many and set_many, are only there if the
+    wrapped store has them.
+    """
+
+    def __init__(self, db, stripes=64):
+        """
+        :param db: The store to wrap
+        :param stripes: Number of locks
+        """
+        self.db = db
+        self._locks = StripedLocks(stripes)
+        for name in ['set_fields', 'get_many', 'set_many']:
+            if hasattr(db, name):
+                setattr(self, name, getattr(self, '_' + name))
+
+    def __getattr__(self, item):
+        if item == 'db':  # Not set yet
+            raise AttributeError(item)
+        return getattr(self.db, item)
+
+    def lock(self, key):
+        """
+        :param key: A key
+        :return: The lock of the key, re-entrant
+        """
+        return self._locks(key)
+
+    def lock_many(self, keys):
+        """
+        :param keys: Keys
+        :return: A context manager holding the locks of all the keys
+        """
+        return self._locks.many(keys)
+
+    def get(self, key):
+        with self._locks(key):
+            return self.db.get(key)
+
+    def set(self, key, value, ttl=0):
+        with self._locks(key):
+            if ttl:
+                self.db.set(key, value, ttl=ttl)
+            else:
+                self.db.set(key, value)
+
+    def delete(self, key):
+        with self._locks(key):
+            self.db.delete(key)
+
+    def _set_fields(self, key, **kwargs):
+        with self._locks(key):
+            self.db.set_fields(key, **kwargs)
+
+    def _get_many(self, keys):
+        keys = list(keys)
+        with self._locks.many(keys):
+            return self.db.get_many(keys)
+
+    def _set_many(self, items, ttl=0):
+        items = list(items)
+        with self._locks.many([key for key, _ in items]):
+            if ttl:
+                self.db.set_many(items, ttl=ttl)
+            else:
+                self.db.set_many(items)
+
+    def __len__(self):
+        return len(self.db)
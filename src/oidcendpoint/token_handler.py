@@ -1,16 +1,28 @@
 import base64
+import binascii
 import hashlib
+import json
 import logging
+import os
+import struct
 
+from cryptography.exceptions import InvalidTag
 from cryptography.fernet import Fernet
 from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
+from cryptojwt.exception import JWKESTException
+from cryptojwt.jws.jws import JWS
+from cryptojwt.jwt import JWT
 from cryptojwt.utils import as_bytes
 from cryptojwt.utils import as_unicode
 
 from oidcmsg.time_util import time_sans_frac
 
+from oidcendpoint import random_bytes
 from oidcendpoint import rndstr
+from oidcendpoint.black_list import BlackList
+from oidcendpoint.cache import LRUCache
 
 __author__ = 'Roland Hedberg'
 
@@ -34,6 +46,68 @@ def lv_unpack(txt):
     return res
 
 
+def lv_pack_bytes(*args):
+    """
+    Binary version of lv_pack. Every item is preceded by its length as a
+    2 byte unsigned integer.
+
+    :param args: byte strings
+    :return: byte string
+    """
+    return b''.join(struct.pack('>H', len(a)) + a for a in args)
+
+
+def lv_unpack_bytes(data):
+    res = []
+    i = 0
+    while i < len(data):
+        l, = struct.unpack_from('>H', data, i)
+        i += 2
+        if i + l > len(data):
+            raise ValueError('Truncated item')
+        res.append(data[i:i + l])
+        i += l
+    return res
+
+
+def b64u_encode(data):
+    return as_unicode(base64.urlsafe_b64encode(data).rstrip(b'='))
+
+
+def b64u_decode(txt):
+    txt = as_bytes(txt)
+    return base64.urlsafe_b64decode(txt + b'=' * (-len(txt) % 4))
+
+
+def pack_envelope(typ, kid, payload):
+    """
+    Prefix a token payload with the token type and the id of the key that
+    was used to protect it. The prefix is sent in the clear but it is
+    bound to the payload, the type is repeated inside the encrypted part
+    and the key id must point to the key that decrypts the payload.
+
+    :param typ: Token type
+    :param kid: Key id
+    :param payload: The protected part of the token
+    :return: A token
+    """
+    return '{}.{}.{}'.format(typ, kid, payload)
+
+
+def unpack_envelope(token):
+    """
+    Split a token into type, key id and payload.
+
+    :param token: A token
+    :return: tuple of type, key id and payload. For tokens without an
+        envelope type and key id are empty strings.
+    """
+    _part = token.split('.', 2)
+    if len(_part) == 3:
+        return _part
+    return '', '', token
+
+
 class ExpiredToken(Exception):
     pass
 
@@ -68,6 +142,7 @@ class Crypt(object):
         self.key = base64.urlsafe_b64encode(
             hashlib.sha256(password.encode("utf-8")).digest())
         self.core = Fernet(self.key)
+        self.kid = hashlib.sha256(self.key).hexdigest()[:8]
 
     def encrypt(self, text):
         # Padding to blocksize of AES
@@ -82,6 +157,102 @@ class Crypt(object):
         return as_unicode(dec_text)
 
 
+class AEADCrypt(object):
+    """
+    Authenticated encryption using AES-GCM with a key derived from a
+    password.
+    """
+    nonce_size = 12
+
+    def __init__(self, password):
+        self.key = hashlib.sha256(
+            b'AES-GCM:' + password.encode("utf-8")).digest()
+        self.core = AESGCM(self.key)
+        self.kid = hashlib.sha256(self.key).hexdigest()[:8]
+
+    def encrypt(self, data, aad=None):
+        nonce = os.urandom(self.nonce_size)
+        return nonce + self.core.encrypt(nonce, as_bytes(data), aad)
+
+    def decrypt(self, ciphertext, aad=None):
+        return self.core.decrypt(ciphertext[:self.nonce_size],
+                                 ciphertext[self.nonce_size:], aad)
+
+
+class KeyRing(object):
+    """
+    The keys used to protect tokens. New tokens are protected with the
+    newest key, the key needed for an existing token is picked by the key
+    id in the token. A key that has been replaced is kept *max_age*
+    seconds, long enough for the tokens it protects to expire, and is then
+    forgotten.
+    """
+
+    def __init__(self, crypt_cls, passwords, max_age=-1):
+        """
+        :param crypt_cls: The class used to wrap a key, Crypt or AEADCrypt
+        :param passwords: A password or a list of passwords, oldest first
+        :param max_age: How long a replaced key is kept, -1 means for ever
+        """
+        self.crypt_cls = crypt_cls
+        self.max_age = max_age
+        self.active = None
+        self._crypt = {}
+        self._retired = {}
+
+        if isinstance(passwords, str):
+            passwords = [passwords]
+        for password in passwords:
+            self.add(password)
+
+    def add(self, password):
+        """
+        Add a key and make it the one used for new tokens.
+
+        :param password: The password the key is derived from
+        :return: The key id
+        """
+        _crypt = self.crypt_cls(password)
+        if self.active is not None and self.active.kid != _crypt.kid:
+            self._retired[self.active.kid] = time_sans_frac()
+        self._crypt[_crypt.kid] = _crypt
+        self._retired.pop(_crypt.kid, None)
+        self.active = _crypt
+        return _crypt.kid
+
+    def prune(self, when=0):
+        """
+        Forget replaced keys that are older than max_age.
+
+        :param when: Point in time to compare with, default is now
+        """
+        if self.max_age < 0 or not self._retired:
+            return
+
+        if not when:
+            when = time_sans_frac()
+        for kid, retired_at in list(self._retired.items()):
+            if retired_at + self.max_age < when:
+                del self._retired[kid]
+                del self._crypt[kid]
+
+    def get(self, kid):
+        self.prune()
+        return self._crypt.get(kid)
+
+    def kids(self):
+        self.prune()
+        return list(self._crypt.keys())
+
+    def __iter__(self):
+        self.prune()
+        # Newest first
+        yield self.active
+        for kid, crypt in list(self._crypt.items()):
+            if crypt is not self.active:
+                yield crypt
+
+
 class Token(object):
     def __init__(self, typ, lifetime=300, **kwargs):
         self.type = typ
@@ -115,12 +286,25 @@ class Token(object):
 
 
 class DefaultToken(Token):
+    crypt_class = Crypt
+
     def __init__(self, password, typ='', black_list=None, token_type='Bearer',
                  **kwargs):
+        """
+        :param password: A password or a list of passwords, oldest first.
+            The newest is used for new tokens.
+        """
         Token.__init__(self, typ, **kwargs)
-        self.crypt = Crypt(password)
+        self.keyring = KeyRing(self.crypt_class, password,
+                               max_age=self.lifetime)
+        self.crypt = self.keyring.active
         self.token_type = token_type
-        self.blist = [] if black_list is None else black_list
+        if black_list is None:
+            self.blist = BlackList()
+        elif isinstance(black_list, (list, set)):
+            self.blist = BlackList(black_list)
+        else:
+            self.blist = black_list
 
     def __call__(self, sid='', ttype='', **kwargs):
         """
@@ -146,9 +330,10 @@ class DefaultToken(Token):
         while rnd == tmp:  # Don't use the same random value again
             rnd = rndstr(32)  # Ultimate length multiple of 16
 
-        return base64.b64encode(
+        _payload = base64.b64encode(
             self.crypt.encrypt(lv_pack(rnd, ttype, sid, exp).encode())).decode(
             "utf-8")
+        return pack_envelope(ttype, self.crypt.kid, _payload)
 
     def key(self, user="", areq=None):
         """
@@ -158,17 +343,23 @@ class DefaultToken(Token):
         :param areq: The authorization request
         :return: An ID
         """
-        csum = hashlib.new('sha224')
-        csum.update(rndstr(32).encode('utf-8'))
-        return csum.hexdigest()  # 56 bytes long, 224 bits
+        # 56 bytes long, 224 bits
+        return as_unicode(binascii.hexlify(random_bytes(28)))
+
+    def add_key(self, password):
+        """
+        Start using a new key. Tokens protected by older keys are accepted
+        until they have expired.
+
+        :param password: The password the new key is derived from
+        :return: key id
+        """
+        kid = self.keyring.add(password)
+        self.crypt = self.keyring.active
+        return kid
 
     def split_token(self, token):
-        try:
-            plain = self.crypt.decrypt(base64.b64decode(token))
-        except Exception:
-            raise UnknownToken(token)
-        # order: rnd, type, sid
-        return lv_unpack(plain)
+        return split_fernet_token(self.keyring, token)
 
     def info(self, token):
         """
@@ -177,6 +368,10 @@ class DefaultToken(Token):
         :param token: A token
         :return: dictionary with info about the token
         """
+        _typ = unpack_envelope(token)[0]
+        if _typ and _typ != self.type:
+            raise WrongTokenType(_typ)
+
         _res = dict(zip(['_id', 'type', 'sid', 'exp'],
                         self.split_token(token)))
         if _res['type'] != self.type:
@@ -194,17 +389,271 @@ class DefaultToken(Token):
             exp = int(_exp)
         return is_expired(exp, when)
 
+    def black_list_entry(self, token):
+        """
+        :param token: A token
+        :return: A (token, exp) tuple or None if the token is not one of
+            mine, in which case it will never be accepted anyway.
+        """
+        if not token:
+            return None
+        try:
+            _exp = int(self.split_token(token)[3])
+        except (IndexError, ValueError):
+            _exp = -1
+        except UnknownToken:
+            return None
+        return token, _exp
+
+    def black_list(self, token):
+        _entry = self.black_list_entry(token)
+        if _entry:
+            self.blist.add(*_entry)
+
+    def is_black_listed(self, token):
+        return token in self.blist
+
+
+def split_fernet_token(keyring, token):
+    """
+    Decrypt and split a token created by DefaultToken.
+
+    :param keyring: A KeyRing instance
+    :param token: The token
+    :return: list of rnd, type, sid and exp
+    """
+    _typ, _kid, _payload = unpack_envelope(token)
+    if _kid:
+        _crypt = keyring.get(_kid)
+        if _crypt is None:
+            raise UnknownToken(token)
+        _crypts = [_crypt]
+    else:  # Minted before tokens carried a key id
+        _crypts = list(keyring)
+
+    for _crypt in _crypts:
+        try:
+            plain = _crypt.decrypt(base64.b64decode(_payload))
+        except Exception:
+            pass
+        else:
+            break
+    else:
+        raise UnknownToken(token)
+    # order: rnd, type, sid, exp
+    _part = lv_unpack(plain)
+
+    # The type in the envelope must match the protected one
+    if _typ and (len(_part) < 2 or _part[1] != _typ):
+        raise UnknownToken(token)
+    return _part
+
+
+class AEADToken(DefaultToken):
+    """
+    A compact token. The payload is a binary length-value structure
+    encrypted with AES-GCM, the envelope is used as additional
+    authenticated data and the result is base64url encoded once.
+
+    Tokens minted by DefaultToken with the same password can still be
+    decoded unless *legacy* is False.
+    """
+
+    crypt_class = AEADCrypt
+
+    def __init__(self, password, typ='', black_list=None, token_type='Bearer',
+                 legacy=True, **kwargs):
+        DefaultToken.__init__(self, password, typ=typ, black_list=black_list,
+                              token_type=token_type, **kwargs)
+        if legacy:
+            self.legacy_keyring = KeyRing(Crypt, password,
+                                          max_age=self.lifetime)
+        else:
+            self.legacy_keyring = None
+
+    def __call__(self, sid='', ttype='', **kwargs):
+        """
+        Return a token.
+
+        :param ttype: Type of token
+        :param sid: Session id
+        :return:
+        """
+        if not ttype and self.type:
+            ttype = self.type
+        else:
+            ttype = 'A'
+
+        if self.lifetime >= 0:
+            exp = time_sans_frac() + self.lifetime
+        else:
+            exp = -1  # Live for ever
+
+        _aad = '{}.{}'.format(ttype, self.crypt.kid)
+        _payload = lv_pack_bytes(random_bytes(16), as_bytes(ttype),
+                                 as_bytes(sid), struct.pack('>q', exp))
+        return pack_envelope(
+            ttype, self.crypt.kid,
+            b64u_encode(self.crypt.encrypt(_payload, as_bytes(_aad))))
+
+    def split_token(self, token):
+        _typ, _kid, _payload = unpack_envelope(token)
+        _crypt = self.keyring.get(_kid) if _kid else None
+        if _crypt is None:
+            if self.legacy_keyring:
+                return split_fernet_token(self.legacy_keyring, token)
+            raise UnknownToken(token)
+
+        _aad = '{}.{}'.format(_typ, _kid)
+        try:
+            plain = _crypt.decrypt(b64u_decode(_payload), as_bytes(_aad))
+            rnd, typ, sid, exp = lv_unpack_bytes(plain)
+        except (InvalidTag, ValueError, binascii.Error, struct.error):
+            raise UnknownToken(token)
+
+        return [as_unicode(binascii.hexlify(rnd)), as_unicode(typ),
+                as_unicode(sid), str(struct.unpack('>q', exp)[0])]
+
+
+class JWTToken(Token):
+    """
+    A self-contained access token, a JWT signed with the keys in the
+    endpoint's key jar. It carries session ID, client ID, scope and
+    expiration time so it can be verified without a session lookup.
+    Revocation is still handled through the black list.
+    """
+    # Valid without consulting the session database
+    self_contained = True
+
+    def __init__(self, typ='T', keyjar=None, issuer='', lifetime=300,
+                 sign_alg='RS256', black_list=None, token_type='Bearer',
+                 **kwargs):
+        Token.__init__(self, typ, lifetime=lifetime, **kwargs)
+        self.keyjar = keyjar
+        self.issuer = issuer
+        self.sign_alg = sign_alg
+        self.token_type = token_type
+        if black_list is None:
+            self.blist = BlackList()
+        elif isinstance(black_list, (list, set)):
+            self.blist = BlackList(black_list)
+        else:
+            self.blist = black_list
+
+    def __call__(self, sid='', ttype='', sinfo=None, **kwargs):
+        """
+        Return a signed JWT.
+
+        :param sid: Session id
+        :param ttype: Type of token
+        :param sinfo: Session information
+        :return:
+        """
+        payload = {'sid': sid, 'ttype': ttype or self.type}
+
+        if sinfo:
+            try:
+                payload['client_id'] = sinfo['client_id']
+            except KeyError:
+                pass
+
+            try:
+                _scope = sinfo['access_token_scope']
+            except KeyError:
+                try:
+                    _scope = sinfo['authn_req']['scope']
+                except KeyError:
+                    _scope = None
+            if _scope:
+                if isinstance(_scope, list):
+                    _scope = ' '.join(_scope)
+                payload['scope'] = _scope
+
+        _jwt = JWT(self.keyjar, iss=self.issuer, sign_alg=self.sign_alg,
+                   lifetime=self.lifetime if self.lifetime > 0 else 0)
+        _jwt.with_jti = True
+        return _jwt.pack(payload)
+
+    def verify_keys(self):
+        """
+        Keys usable for verifying a token. Mine and, if this instance is
+        used by someone else, those of the issuer.
+        """
+        _keys = self.keyjar.get('sig', owner='')
+        if self.issuer:
+            _keys.extend(self.keyjar.get('sig', owner=self.issuer))
+        return _keys
+
+    def split_token(self, token):
+        try:
+            _msg = JWS(alg=self.sign_alg).verify_compact(
+                token, self.verify_keys(), sigalg=self.sign_alg)
+        except (JWKESTException, ValueError, KeyError, TypeError):
+            raise UnknownToken(token)
+
+        if isinstance(_msg, str):
+            _msg = json.loads(_msg)
+
+        if _msg.get('iss') != self.issuer:
+            raise UnknownToken(token)
+        return _msg
+
+    def info(self, token):
+        """
+        Return token information.
+
+        :param token: A token
+        :return: dictionary with info about the token
+        """
+        _msg = self.split_token(token)
+        if _msg.get('ttype') != self.type:
+            raise WrongTokenType(_msg.get('ttype'))
+
+        _res = {
+            '_id': _msg.get('jti', ''),
+            'type': _msg['ttype'],
+            'sid': _msg['sid'],
+            'exp': str(_msg.get('exp', -1)),
+            'handler': self,
+            'black_listed': self.is_black_listed(token)
+        }
+        for claim in ['client_id', 'scope']:
+            if claim in _msg:
+                _res[claim] = _msg[claim]
+        return _res
+
+    def black_list_entry(self, token):
+        """
+        :param token: A token
+        :return: A (token, exp) tuple or None if the token is not one of
+            mine, in which case it will never be accepted anyway.
+        """
+        if not token:
+            return None
+        try:
+            _exp = int(self.split_token(token).get('exp', -1))
+        except UnknownToken:
+            return None
+        return token, _exp
+
     def black_list(self, token):
-        if token:
-            self.blist.append(token)
+        _entry = self.black_list_entry(token)
+        if _entry:
+            self.blist.add(*_entry)
 
     def is_black_listed(self, token):
         return token in self.blist
 
 
+TOKEN_FORMAT = {
+    'fernet': DefaultToken,
+    'aead': AEADToken
+}
+
+
 class TokenHandler(object):
     def __init__(self, access_token_handler=None, code_handler=None,
-                 refresh_token_handler=None):
+                 refresh_token_handler=None, cache_size=0, cache_ttl=0):
 
         self.handler = {
             'code': code_handler,
@@ -217,6 +666,13 @@ class TokenHandler(object):
             self.handler['refresh_token'] = refresh_token_handler
             self.handler_order.append('refresh_token')
 
+        # Cache of decoded token information. The black list status is
+        # never cached.
+        if cache_size:
+            self.cache = LRUCache(cache_size, cache_ttl)
+        else:
+            self.cache = None
+
         # self.lifetime_policy = {}
         # self.token_policy = {}
         # for handler in self.handler_order:
@@ -229,15 +685,51 @@ class TokenHandler(object):
     def __contains__(self, item):
         return item in self.handler
 
+    def _tagged_handler(self, token, order):
+        """
+        Find the handler for a token that carries a type tag.
+
+        :param token: A token
+        :param order: The handlers to consider
+        :return: handler name or None if the token is not tagged with any of
+            the known token types.
+        """
+        _typ = unpack_envelope(token)[0]
+        if not _typ:
+            return None
+
+        for name in order:
+            try:
+                if self.handler[name].type == _typ:
+                    return name
+            except (KeyError, AttributeError):
+                pass
+        return None
+
     def info(self, item, order=None):
         if order is None:
             order = self.handler_order
 
+        if self.cache is not None:
+            _cached = self.cache.get(item)
+            if _cached and _cached[0] in order:
+                _res = dict(_cached[1])
+                _res['black_listed'] = _res['handler'].is_black_listed(item)
+                return _res
+
+        _name = self._tagged_handler(item, order)
+        if _name:
+            order = [_name]
+
         for typ in order:
             try:
-                return self.handler[typ].info(item)
+                _res = self.handler[typ].info(item)
             except (KeyError, WrongTokenType, InvalidToken, UnknownToken):
                 pass
+            else:
+                if self.cache is not None:
+                    self.cache.set(item, (typ, dict(_res)))
+                return _res
 
         logger.info("Unknown token format")
         raise KeyError(item)
@@ -256,44 +748,104 @@ class TokenHandler(object):
         if order is None:
             order = self.handler_order
 
-        for typ in order:
-            try:
-                self.handler[typ].info(token)
-            except (KeyError, WrongTokenType, InvalidToken, UnknownToken):
-                pass
-            else:
-                return self.handler[typ]
+        _name = self._tagged_handler(token, order)
+        if _name:
+            return self.handler[_name]
 
-        return None
+        try:
+            return self.info(token, order)['handler']
+        except KeyError:
+            return None
 
     def black_list(self, token, order=None):
         _handler = self.get_handler(token, order)
         _handler.black_list(token)
 
+    def black_list_many(self, tokens, order=None):
+        """
+        Black list several tokens. Entries that go into the same black list
+        are added in one batch.
+
+        :param tokens: iterable of tokens
+        :param order: The handlers to consider
+        :return: Number of tokens black listed, unknown tokens are skipped
+        """
+        _batch = {}
+        for token in tokens:
+            _handler = self.get_handler(token, order)
+            if _handler is None:
+                continue
+            _entry = _handler.black_list_entry(token)
+            if _entry is None:
+                continue
+            try:
+                _batch[id(_handler.blist)][1].append(_entry)
+            except KeyError:
+                _batch[id(_handler.blist)] = (_handler.blist, [_entry])
+
+        n = 0
+        for blist, entries in _batch.values():
+            blist.add_many(entries)
+            n += len(entries)
+        return n
+
+    def add_key(self, password):
+        """
+        Rotate keys. New tokens of all types are protected with a key
+        derived from the password, older keys are retired when the
+        tokens they protect have expired.
+
+        :param password: The password the new key is derived from
+        """
+        for _handler in self.handler.values():
+            try:
+                _handler.add_key(password)
+            except AttributeError:  # Not a handler using a key ring
+                pass
+
     def keys(self):
         return self.handler.keys()
 
 
 def factory(password, token_expires_in=3600, grant_expires_in=600,
-            refresh_token_expires_in=86400):
+            refresh_token_expires_in=86400, cache_size=0, cache_ttl=0,
+            token_format='fernet', access_token=None, black_list=None):
     """
     Create a token handler
 
-    :param password:
+    :param password: A password or a list of passwords, oldest first. The
+        newest is used when minting tokens.
     :param token_expires_in:
     :param grant_expires_in:
     :param refresh_token_expires_in:
+    :param cache_size: Number of decoded tokens to keep, 0 means no cache
+    :param cache_ttl: How long, in seconds, a decoded token is kept
+    :param token_format: One of the keys in TOKEN_FORMAT
+    :param access_token: Specification of an alternative access token
+        handler, a dictionary with the keys 'class' and 'kwargs'.
+    :param black_list: A black list shared by all the token handlers, for
+        instance a SQLiteBlackList shared by several processes.
     :return:
     """
-    code_handler = DefaultToken(password, typ='A',
-                                lifetime=grant_expires_in)
-    access_token_handler = DefaultToken(password, typ='T',
-                                        lifetime=token_expires_in)
-    refresh_token_handler = DefaultToken(password, typ='R',
-                                         lifetime=refresh_token_expires_in)
+    _cls = TOKEN_FORMAT[token_format]
+    code_handler = _cls(password, typ='A', lifetime=grant_expires_in,
+                        black_list=black_list)
+    if access_token:
+        _kwargs = dict(access_token.get('kwargs', {}))
+        _kwargs.setdefault('lifetime', token_expires_in)
+        _kwargs.setdefault('black_list', black_list)
+        access_token_handler = access_token['class'](typ='T', **_kwargs)
+    else:
+        access_token_handler = _cls(password, typ='T',
+                                    lifetime=token_expires_in,
+                                    black_list=black_list)
+    refresh_token_handler = _cls(password, typ='R',
+                                 lifetime=refresh_token_expires_in,
+                                 black_list=black_list)
 
     return TokenHandler(
         code_handler=code_handler,
         access_token_handler=access_token_handler,
         refresh_token_handler=refresh_token_handler,
+        cache_size=cache_size, cache_ttl=cache_ttl
     )
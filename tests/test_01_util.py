@@ -4,6 +4,10 @@ from cryptojwt.exception import UnknownAlgorithm
 
 from oidcmsg.oidc import RegistrationResponse
 
+from oidcendpoint import BASECH
+from oidcendpoint import RandomPool
+from oidcendpoint import random_bytes
+from oidcendpoint import rndstr
 from oidcendpoint.oidc.authorization import Authorization
 from oidcendpoint.oidc.provider_config import ProviderConfiguration
 from oidcendpoint.oidc.registration import Registration
@@ -112,3 +116,28 @@ def test_get_sign_algorithm_4():
                                            sign=True)
     # default signing alg
     assert algs == {'sign': True, 'encrypt': False, 'sign_alg': 'RS512'}
+
+
+def test_rndstr():
+    for size in [0, 1, 16, 32, 100, 5000]:
+        _str = rndstr(size)
+        assert len(_str) == size
+        assert set(_str) <= set(BASECH)
+
+    assert rndstr(32) != rndstr(32)
+
+
+def test_rndstr_uses_all_characters():
+    assert set(rndstr(20000)) == set(BASECH)
+
+
+def test_random_bytes():
+    assert len(random_bytes(28)) == 28
+    assert random_bytes(28) != random_bytes(28)
+
+
+def test_random_pool_refill():
+    pool = RandomPool(size=8)
+    _bytes = [pool.read(3) for _ in range(10)]
+    assert all(len(b) == 3 for b in _bytes)
+    assert len(pool.read(20)) == 20
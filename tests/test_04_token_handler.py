@@ -5,10 +5,21 @@ import pytest
 import random
 import time
 
+from cryptojwt.key_jar import KeyJar
+from cryptojwt.key_jar import build_keyjar
+
+from oidcendpoint.cache import LRUCache
+from oidcendpoint.token_handler import AEADToken
 from oidcendpoint.token_handler import Crypt
 from oidcendpoint.token_handler import DefaultToken
+from oidcendpoint.token_handler import JWTToken
 from oidcendpoint.token_handler import TokenHandler
+from oidcendpoint.token_handler import UnknownToken
+from oidcendpoint.token_handler import WrongTokenType
+from oidcendpoint.token_handler import factory
 from oidcendpoint.token_handler import is_expired
+from oidcendpoint.token_handler import lv_pack
+from oidcendpoint.token_handler import unpack_envelope
 
 
 def test_is_expired():
@@ -97,6 +108,36 @@ class TestDefaultToken(object):
         _info = self.th.info(_token)
         assert _info['black_listed'] is True
 
+    def test_envelope(self):
+        _token = self.th('session_id')
+        typ, kid, payload = unpack_envelope(_token)
+        assert typ == 'A'
+        assert kid == self.th.crypt.kid
+
+    def test_envelope_wrong_type(self):
+        _token = self.th('session_id')
+        typ, kid, payload = unpack_envelope(_token)
+        with pytest.raises(WrongTokenType):
+            self.th.info('T.{}.{}'.format(kid, payload))
+
+    def test_envelope_tampered_type(self):
+        th = DefaultToken(
+            "The longer the better. Is this close to enough ?", typ='T')
+        typ, kid, payload = unpack_envelope(th('session_id'))
+        with pytest.raises(UnknownToken):
+            self.th.info('A.{}.{}'.format(kid, payload))
+
+    def test_envelope_unknown_kid(self):
+        typ, kid, payload = unpack_envelope(self.th('session_id'))
+        with pytest.raises(UnknownToken):
+            self.th.info('A.{}.{}'.format('00000000', payload))
+
+    def test_legacy_token(self):
+        _token = base64.b64encode(self.th.crypt.encrypt(
+            lv_pack('rnd', 'A', 'session_id', '-1'))).decode('utf-8')
+        _info = self.th.info(_token)
+        assert _info['sid'] == 'session_id'
+
 
 class TestTokenHandler(object):
     @pytest.fixture(autouse=True)
@@ -159,6 +200,254 @@ class TestTokenHandler(object):
         _info = self.handler.info(_token)
         assert _info['black_listed']
 
+    def test_info_dispatch_by_type(self):
+        _token = self.handler['refresh_token']('another_id')
+        # Would fail if any other handler was tried first
+        self.handler['code'].keyring = None
+        self.handler['access_token'].keyring = None
+        _info = self.handler.info(_token)
+        assert _info['type'] == 'R'
+        assert self.handler.get_handler(_token).type == 'R'
+
+    def test_info_order(self):
+        _token = self.handler['refresh_token']('another_id')
+        with pytest.raises(KeyError):
+            self.handler.info(_token, order=['code', 'access_token'])
+
     def test_keys(self):
         assert set(self.handler.keys()) == {'access_token', 'code',
                                             'refresh_token'}
+
+
+class TestTokenHandlerCache(object):
+    @pytest.fixture(autouse=True)
+    def setup_token_handler(self):
+        password = "The longer the better. Is this close to enough ?"
+        self.handler = TokenHandler(
+            code_handler=DefaultToken(password, typ='A', lifetime=600),
+            access_token_handler=DefaultToken(password, typ='T',
+                                              lifetime=900),
+            refresh_token_handler=DefaultToken(password, typ='R',
+                                               lifetime=86400),
+            cache_size=2)
+
+    def test_hit_miss(self):
+        _token = self.handler['access_token']('another_id')
+        assert self.handler.sid(_token) == 'another_id'
+        assert self.handler.sid(_token) == 'another_id'
+        assert self.handler.cache.hits == 1
+        assert self.handler.cache.misses == 1
+
+    def test_black_list_checked_live(self):
+        _token = self.handler['access_token']('another_id')
+        assert self.handler.info(_token)['black_listed'] is False
+        self.handler.black_list(_token)
+        assert self.handler.info(_token)['black_listed'] is True
+        assert self.handler.cache.hits == 1
+
+    def test_order_respected(self):
+        _token = self.handler['access_token']('another_id')
+        self.handler.info(_token)
+        with pytest.raises(KeyError):
+            self.handler.info(_token, order=['code'])
+
+    def test_bounded(self):
+        for i in range(5):
+            self.handler.info(self.handler['code']('sid{}'.format(i)))
+        assert len(self.handler.cache) == 2
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(10, ttl=60)
+    cache.set('key', 'value')
+    assert cache.get('key') == 'value'
+    cache._data['key'] = ('value', time.time() - 120)
+    assert cache.get('key') is None
+    assert cache.stats() == {'hits': 1, 'misses': 1, 'size': 0,
+                             'maxsize': 10}
+
+
+def test_lru_cache_eviction_order():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert 'a' in cache
+    assert 'b' not in cache
+
+
+class TestKeyRotation(object):
+    def test_old_tokens_accepted(self):
+        th = DefaultToken('first password', typ='A', lifetime=600)
+        _old = th('session_id')
+        th.add_key('second password')
+        _new = th('session_id')
+
+        assert unpack_envelope(_old)[1] != unpack_envelope(_new)[1]
+        assert th.info(_old)['sid'] == 'session_id'
+        assert th.info(_new)['sid'] == 'session_id'
+
+    def test_retired_key_ages_out(self):
+        th = DefaultToken('first password', typ='A', lifetime=600)
+        _old = th('session_id')
+        _kid = th.crypt.kid
+        th.add_key('second password')
+
+        th.keyring.prune(when=time.time() + 601)
+        assert _kid not in th.keyring.kids()
+        with pytest.raises(UnknownToken):
+            th.info(_old)
+
+    def test_password_list(self):
+        th = DefaultToken(['first password', 'second password'], typ='A')
+        assert th.crypt.kid == Crypt('second password').kid
+        _token = DefaultToken('first password', typ='A')('session_id')
+        assert th.info(_token)['sid'] == 'session_id'
+
+    def test_lookup_by_kid(self):
+        th = DefaultToken(['first password', 'second password'], typ='A')
+        _token = th('session_id')
+        # Only the key named in the token is used
+        th.keyring._crypt[Crypt('first password').kid] = None
+        assert th.info(_token)['sid'] == 'session_id'
+
+    def test_legacy_token_any_key(self):
+        _token = base64.b64encode(Crypt('first password').encrypt(
+            lv_pack('rnd', 'A', 'session_id', '-1'))).decode('utf-8')
+        th = DefaultToken(['first password', 'second password'], typ='A')
+        assert th.info(_token)['sid'] == 'session_id'
+
+    def test_aead(self):
+        th = AEADToken('first password', typ='T', lifetime=600)
+        _old = th('session_id')
+        th.add_key('second password')
+        assert th.info(_old)['sid'] == 'session_id'
+        assert th.info(th('session_id'))['sid'] == 'session_id'
+
+    def test_token_handler_add_key(self):
+        handler = factory('first password')
+        _old = handler['refresh_token']('session_id')
+        handler.add_key('second password')
+        assert handler.sid(_old) == 'session_id'
+        _new = handler['refresh_token']('session_id')
+        assert unpack_envelope(_new)[1] == Crypt('second password').kid
+
+
+class TestAEADToken(object):
+    @pytest.fixture(autouse=True)
+    def setup_token_handler(self):
+        self.password = "The longer the better. Is this close to enough ?"
+        self.th = AEADToken(self.password, typ='T', lifetime=900)
+
+    def test_info(self):
+        _token = self.th('session_id')
+        _info = self.th.info(_token)
+        assert _info['type'] == 'T'
+        assert _info['sid'] == 'session_id'
+        assert int(_info['exp']) > time.time()
+        assert _info['black_listed'] is False
+
+    def test_url_safe(self):
+        _token = self.th('session_id')
+        assert _token.startswith('T.{}.'.format(self.th.crypt.kid))
+        assert not set(_token) & set('+/= ')
+
+    def test_smaller_than_fernet(self):
+        _fernet = DefaultToken(self.password, typ='T', lifetime=900)
+        assert len(self.th('session_id')) < len(_fernet('session_id')) / 2
+
+    def test_envelope_authenticated(self):
+        typ, kid, payload = unpack_envelope(self.th('session_id'))
+        th = AEADToken(self.password, typ='R', lifetime=900)
+        with pytest.raises(UnknownToken):
+            th.split_token('R.{}.{}'.format(kid, payload))
+
+    def test_tampered(self):
+        _token = self.th('session_id')
+        _tampered = _token[:-2] + ('AA' if _token[-2:] != 'AA' else 'BB')
+        with pytest.raises(UnknownToken):
+            self.th.info(_tampered)
+
+    def test_legacy_fernet_token(self):
+        _fernet = DefaultToken(self.password, typ='T', lifetime=900)
+        _info = self.th.info(_fernet('session_id'))
+        assert _info['sid'] == 'session_id'
+
+        th = AEADToken(self.password, typ='T', legacy=False)
+        with pytest.raises(UnknownToken):
+            th.info(_fernet('session_id'))
+
+    def test_black_list(self):
+        _token = self.th('session_id')
+        self.th.black_list(_token)
+        assert self.th.info(_token)['black_listed'] is True
+
+
+def test_factory_token_format():
+    handler = factory('password', token_format='aead')
+    _token = handler['refresh_token']('session_id')
+    assert isinstance(handler['refresh_token'], AEADToken)
+    assert handler.sid(_token) == 'session_id'
+
+
+KEYDEFS = [
+    {"type": "RSA", "key": '', "use": ["sig"]},
+    {"type": "EC", "crv": "P-256", "use": ["sig"]}
+    ]
+
+KEYJAR = build_keyjar(KEYDEFS)
+
+ISSUER = 'https://example.com/op'
+
+
+class TestJWTToken(object):
+    @pytest.fixture(autouse=True)
+    def setup_token_handler(self):
+        self.th = JWTToken('T', keyjar=KEYJAR, issuer=ISSUER, lifetime=900)
+
+    def test_info(self):
+        _token = self.th('session_id',
+                         sinfo={'client_id': 'client_1',
+                                'authn_req': {'scope': ['openid', 'email']}})
+        _info = self.th.info(_token)
+        assert _info['sid'] == 'session_id'
+        assert _info['type'] == 'T'
+        assert _info['client_id'] == 'client_1'
+        assert _info['scope'] == 'openid email'
+        assert int(_info['exp']) > time.time()
+        assert _info['black_listed'] is False
+
+    def test_verify_by_resource_server(self):
+        _token = self.th('session_id')
+        _keyjar = KeyJar()
+        _keyjar.import_jwks(KEYJAR.export_jwks(), ISSUER)
+        th = JWTToken('T', keyjar=_keyjar, issuer=ISSUER)
+        assert th.info(_token)['sid'] == 'session_id'
+
+    def test_wrong_issuer(self):
+        _token = self.th('session_id')
+        th = JWTToken('T', keyjar=KEYJAR, issuer='https://example.org')
+        with pytest.raises(UnknownToken):
+            th.info(_token)
+
+    def test_wrong_type(self):
+        th = JWTToken('R', keyjar=KEYJAR, issuer=ISSUER)
+        with pytest.raises(WrongTokenType):
+            th.info(self.th('session_id'))
+
+    def test_black_list(self):
+        _token = self.th('session_id')
+        self.th.black_list(_token)
+        assert self.th.info(_token)['black_listed'] is True
+
+    def test_token_handler(self):
+        handler = factory(
+            'password',
+            access_token={'class': JWTToken,
+                          'kwargs': {'keyjar': KEYJAR, 'issuer': ISSUER}})
+        _token = handler['access_token']('session_id')
+        assert handler.sid(_token) == 'session_id'
+        assert handler.get_handler(_token) is handler['access_token']
+        _code = handler['code']('session_id')
+        assert handler.type(_code) == 'A'
@@ -1,11 +1,24 @@
+import threading
+import time
+
 import pytest
+from oidcendpoint.in_memory_db import InMemoryDataBase
+from oidcendpoint.sqlite_db import SQLiteDataBase
+from oidcendpoint.sqlite_db import SQLiteSSODb
 from oidcendpoint.sso_db import SSODb
+from oidcendpoint.thread_safe import ThreadSafeDataBase
 
 
 class TestSessionDB(object):
-    @pytest.fixture(autouse=True)
-    def create_sdb(self):
-        self.sso_db = SSODb()
+    @pytest.fixture(autouse=True, params=['memory', 'sqlite', 'store'])
+    def create_sdb(self, request, tmpdir):
+        if request.param == 'sqlite':
+            self.sso_db = SQLiteSSODb(str(tmpdir.join('sso.db')))
+        elif request.param == 'store':
+            # A store that only takes strings
+            self.sso_db = SSODb(SQLiteDataBase(str(tmpdir.join('sso.db'))))
+        else:
+            self.sso_db = SSODb()
 
     def test_map_sid2uid(self):
         self.sso_db.map_sid2uid('session id 1', 'Lizz')
@@ -104,4 +117,164 @@ class TestSessionDB(object):
 
         res = self.sso_db.get_subs_by_uid('Lizz')
 
-        assert set(res) == {'abcdefgh', '012346789'}
\ No newline at end of file
+        assert set(res) == {'abcdefgh', '012346789'}
+
+    def test_map_sid(self):
+        self.sso_db.map_sid('session id 1', uid='Lizz', sub='abcdefgh')
+        assert self.sso_db.get_uid_by_sid('session id 1') == 'Lizz'
+        assert self.sso_db.get_sids_by_uid('Lizz') == ['session id 1']
+        assert self.sso_db.get_sub_by_sid('session id 1') == 'abcdefgh'
+        assert self.sso_db.get_sids_by_sub('abcdefgh') == ['session id 1']
+
+    def test_map_twice(self):
+        self.sso_db.map_sid2uid('session id 1', 'Lizz')
+        self.sso_db.map_sid2uid('session id 2', 'Lizz')
+        self.sso_db.map_sid2uid('session id 1', 'Lizz')
+        assert self.sso_db.get_sids_by_uid('Lizz') == ['session id 1',
+                                                       'session id 2']
+
+    def test_remove_unknown(self):
+        self.sso_db.map_sid2uid('session id 1', 'Lizz')
+        self.sso_db.remove_sid2uid('session id 2', 'Lizz')
+        self.sso_db.remove_sid2uid('session id 1', 'Diana')
+        assert self.sso_db.get_sids_by_uid('Lizz') == ['session id 1']
+
+    def test_remove_session_id(self):
+        self.sso_db.map_sid('session id 1', uid='Lizz', sub='abcdefgh')
+        self.sso_db.map_sid('session id 2', uid='Lizz', sub='abcdefgh')
+
+        self.sso_db.remove_session_id('session id 1')
+        assert self.sso_db.get_uid_by_sid('session id 1') is None
+        assert self.sso_db.get_sub_by_sid('session id 1') is None
+        assert self.sso_db.get_sids_by_uid('Lizz') == ['session id 2']
+        assert self.sso_db.get_sids_by_sub('abcdefgh') == ['session id 2']
+        # Unknown session IDs are ignored
+        self.sso_db.remove_session_id('session id 1')
+
+    def test_get_subs_by_unknown_uid(self):
+        assert not self.sso_db.get_subs_by_uid('Lizz')
+
+    def test_get_sessions_for_uids(self):
+        self.sso_db.map_sid('session id 1', uid='Lizz', sub='abcdefgh')
+        self.sso_db.map_sid('session id 2', uid='Lizz', sub='012346789')
+        self.sso_db.map_sid('session id 3', uid='Diana', sub='abcdefgh')
+
+        assert self.sso_db.get_sessions_for_uids(['Lizz', 'Diana', 'Ann']) == {
+            'Lizz': ['session id 1', 'session id 2'],
+            'Diana': ['session id 3']}
+        assert self.sso_db.get_subs_by_uids(['Lizz', 'Diana', 'Ann']) == {
+            'Lizz': {'abcdefgh', '012346789'}, 'Diana': {'abcdefgh'}}
+
+    def test_remove_uids(self):
+        self.sso_db.map_sid('session id 1', uid='Lizz')
+        self.sso_db.map_sid('session id 2', uid='Diana')
+        self.sso_db.map_sid('session id 3', uid='Ann')
+        self.sso_db.remove_uids(['Lizz', 'Diana', 'Unknown'])
+        assert self.sso_db.get_sessions_for_uids(['Lizz', 'Diana', 'Ann']) == {
+            'Ann': ['session id 3']}
+        assert self.sso_db.get_uid_by_sid('session id 1') is None
+
+
+def test_changed_in_place():
+    db = InMemoryDataBase()
+    sso_db = SSODb(db)
+    sso_db.map_sid2uid('session id 1', 'Lizz')
+    _values = db.get('__uid2sid__Lizz')
+    sso_db.map_sid2uid('session id 2', 'Lizz')
+    assert list(_values) == ['session id 1', 'session id 2']
+
+
+def test_ttl_refreshed():
+    db = InMemoryDataBase()
+    sso_db = SSODb(db, ttl=60)
+    sso_db.map_sid2uid('session id 1', 'Lizz')
+    db._exp['__uid2sid__Lizz'] = 0
+    sso_db.map_sid2uid('session id 2', 'Lizz')
+    assert db._exp['__uid2sid__Lizz'] > time.time()
+
+
+def test_threads():
+    sso_db = SSODb()
+
+    def add(n):
+        for i in range(200):
+            sso_db.map_sid2uid('session {} {}'.format(n, i), 'Lizz')
+
+    _threads = [threading.Thread(target=add, args=(n,)) for n in range(8)]
+    for thread in _threads:
+        thread.start()
+    for thread in _threads:
+        thread.join()
+    assert len(sso_db.get_sids_by_uid('Lizz')) == 1600
+
+
+class CountingDataBase(InMemoryDataBase):
+    native = False
+
+    def __init__(self):
+        InMemoryDataBase.__init__(self)
+        self.calls = []
+
+    def get_many(self, keys):
+        self.calls.append('get_many')
+        return {k: self.get(k) for k in keys}
+
+    def set_many(self, items, ttl=0):
+        self.calls.append('set_many')
+        InMemoryDataBase.set_many(self, items, ttl)
+
+
+def test_map_sid_together():
+    db = CountingDataBase()
+    sso_db = SSODb(db, ttl=60)
+    sso_db.map_sid('session id 1', uid='Lizz', sub='abcdefgh')
+    sso_db.map_sid('session id 2', uid='Lizz', sub='abcdefgh')
+    assert db.calls == ['get_many', 'set_many'] * 2
+    assert sso_db.get_sids_by_uid('Lizz') == ['session id 1', 'session id 2']
+    assert sso_db.get_sids_by_sub('abcdefgh') == ['session id 1',
+                                                  'session id 2']
+    assert 0 < db.ttl('__sid2uid__session id 2') <= 60
+
+    # Not made shorter
+    sso_db.refresh('session id 2', 600)
+    sso_db.map_sid('session id 3', uid='Lizz')
+    assert db.ttl('__uid2sid__Lizz') > 590
+
+
+def test_map_sid_threads():
+    sso_db = SSODb(ThreadSafeDataBase(CountingDataBase()))
+
+    def add(n):
+        for i in range(100):
+            sso_db.map_sid('session {} {}'.format(n, i), uid='Lizz',
+                           sub='abcdefgh')
+
+    _threads = [threading.Thread(target=add, args=(n,)) for n in range(8)]
+    for thread in _threads:
+        thread.start()
+    for thread in _threads:
+        thread.join()
+    assert len(sso_db.get_sids_by_uid('Lizz')) == 800
+    assert len(sso_db.get_sids_by_sub('abcdefgh')) == 800
+
+
+def test_refresh():
+    db = InMemoryDataBase()
+    sso_db = SSODb(db, ttl=60)
+    sso_db.map_sid('session id 1', uid='Lizz', sub='abcdefgh')
+    _keys = ['__sid2uid__session id 1', '__uid2sid__Lizz',
+             '__sid2sub__session id 1', '__sub2sid__abcdefgh']
+
+    # Kept long enough already
+    sso_db.refresh('session id 1', 30)
+    assert all(db.ttl(key) <= 60 for key in _keys)
+
+    sso_db.refresh('session id 1', 600)
+    assert all(590 < db.ttl(key) <= 600 for key in _keys)
+    # Not made shorter by a later change
+    sso_db.map_sid2uid('session id 2', 'Lizz')
+    assert db.ttl('__uid2sid__Lizz') > 590
+
+    sso_db.refresh('session id 1', 0)
+    assert db.ttl('__sid2uid__session id 1') == 0
+    assert db.get('__sid2uid__session id 1')
@@ -0,0 +1,184 @@
+import os
+import time
+
+import pytest
+
+from oidcendpoint.black_list import BlackList
+from oidcendpoint.black_list import SQLiteBlackList
+from oidcendpoint.token_handler import DefaultToken
+from oidcendpoint.token_handler import factory
+
+
+def test_add_contains():
+    blist = BlackList()
+    blist.add('token', int(time.time()) + 60)
+    assert 'token' in blist
+    assert 'other' not in blist
+    assert len(blist) == 1
+
+
+def test_never_expires():
+    blist = BlackList()
+    blist.add('token')
+    assert blist.prune(when=time.time() + 86400 * 365) == 0
+    assert 'token' in blist
+
+
+def test_prune():
+    blist = BlackList()
+    now = int(time.time())
+    blist.add('expired', now + 10)
+    blist.add('live', now + 60)
+    assert blist.prune(when=now + 30) == 1
+    assert 'expired' not in blist
+    assert 'live' in blist
+
+
+def test_expired_removed_on_access():
+    blist = BlackList()
+    blist.add('expired', int(time.time()) - 10)
+    assert 'expired' not in blist
+    assert len(blist) == 0
+
+
+def test_prune_bounded():
+    blist = BlackList()
+    _exp = int(time.time()) + 60
+    for i in range(10):
+        blist.add('token{}'.format(i), _exp)
+
+    assert blist.prune(when=_exp + 1, limit=4) == 4
+    assert len(blist) == 6
+    assert blist.prune(when=_exp + 1, limit=0) == 6
+    assert len(blist) == 0
+
+
+def test_readd_without_exp():
+    blist = BlackList()
+    now = int(time.time())
+    blist.add('token', now + 60)
+    blist.add('token')
+    blist.prune(when=now + 120, limit=0)
+    assert 'token' in blist
+
+
+def test_init_from_list():
+    blist = BlackList(['a', 'b'])
+    assert 'a' in blist
+    assert 'b' in blist
+
+
+class TestDefaultTokenBlackList(object):
+    def test_black_list_uses_token_exp(self):
+        blist = BlackList()
+        th = DefaultToken('password', typ='A', lifetime=600, black_list=blist)
+        _token = th('session_id')
+        th.black_list(_token)
+        assert th.is_black_listed(_token)
+
+        # Gone when the token has expired
+        assert blist.prune(when=time.time() + 601) == 1
+        assert not th.is_black_listed(_token)
+
+    def test_list_argument(self):
+        th = DefaultToken('password', typ='A', lifetime=600, black_list=[])
+        _token = th('session_id')
+        th.black_list(_token)
+        assert th.info(_token)['black_listed'] is True
+
+
+class TestSQLiteBlackList(object):
+    @pytest.fixture(autouse=True)
+    def create_black_list(self, tmpdir):
+        self.filename = str(tmpdir.join('black_list.db'))
+        self.blist = SQLiteBlackList(self.filename)
+
+    def test_add_contains(self):
+        self.blist.add('token', int(time.time()) + 60)
+        assert 'token' in self.blist
+        assert 'other' not in self.blist
+        assert len(self.blist) == 1
+
+    def test_add_many(self):
+        _exp = int(time.time()) + 60
+        self.blist.add_many([('token{}'.format(i), _exp) for i in range(100)])
+        assert len(self.blist) == 100
+        assert 'token42' in self.blist
+
+    def test_prune(self):
+        now = int(time.time())
+        self.blist.add('expired', now + 10)
+        self.blist.add('live', now + 60)
+        self.blist.add('forever')
+        assert self.blist.prune(when=now + 30) == 1
+        assert 'expired' not in self.blist
+        assert 'live' in self.blist
+        assert 'forever' in self.blist
+
+    def test_discard(self):
+        self.blist.add('token')
+        self.blist.discard('token')
+        assert 'token' not in self.blist
+
+    def test_shared(self):
+        other = SQLiteBlackList(self.filename)
+        self.blist.add('token', int(time.time()) + 60)
+        assert 'token' in other
+
+    def test_shared_between_processes(self):
+        _exp = int(time.time()) + 60
+        self.blist.add('before fork', _exp)
+
+        pid = os.fork()
+        if pid == 0:  # child
+            try:
+                ok = 'before fork' in self.blist
+                self.blist.add('from child', _exp)
+            finally:
+                os._exit(0 if ok else 1)
+
+        _, status = os.waitpid(pid, 0)
+        assert status == 0
+        assert 'from child' in self.blist
+
+    def test_default_token(self):
+        th = DefaultToken('password', typ='A', lifetime=600,
+                          black_list=self.blist)
+        _token = th('session_id')
+        th.black_list(_token)
+
+        other = DefaultToken('password', typ='A', lifetime=600,
+                             black_list=SQLiteBlackList(self.filename))
+        assert other.info(_token)['black_listed'] is True
+
+
+def test_factory_shared_black_list(tmpdir):
+    _filename = str(tmpdir.join('black_list.db'))
+    handler = factory('password', black_list=SQLiteBlackList(_filename))
+    _code = handler['code']('session_id')
+    handler.black_list(_code)
+
+    other = factory('password', black_list=SQLiteBlackList(_filename))
+    assert other.is_black_listed(_code)
+
+
+class CountingBlackList(BlackList):
+    def __init__(self):
+        BlackList.__init__(self)
+        self.batches = 0
+
+    def add_many(self, items):
+        self.batches += 1
+        BlackList.add_many(self, items)
+
+
+def test_black_list_many_one_batch():
+    blist = CountingBlackList()
+    handler = factory('password', black_list=blist)
+    _tokens = [handler['code']('sid'), handler['access_token']('sid'),
+               handler['refresh_token']('sid'), 'no such token']
+
+    assert handler.black_list_many(_tokens) == 3
+    assert blist.batches == 1
+    for token in _tokens[:3]:
+        assert handler.is_black_listed(token)
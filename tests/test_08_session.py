@@ -1,15 +1,25 @@
+import json
 import time
+
 import pytest
 
+from cryptojwt.key_jar import build_keyjar
+
 from oidcendpoint import token_handler
 from oidcendpoint.authn_event import create_authn_event
 from oidcendpoint.in_memory_db import InMemoryDataBase
 from oidcendpoint.session import SessionDB
+from oidcendpoint.session import SessionInfo
+from oidcendpoint.session import copy_value
+from oidcendpoint.session_codec import CompactCodec
+from oidcendpoint.sqlite_db import SQLiteDataBase
 from oidcendpoint.sso_db import SSODb
 from oidcendpoint.token_handler import AccessCodeUsed
 from oidcendpoint.token_handler import ExpiredToken
+from oidcendpoint.token_handler import JWTToken
 from oidcendpoint.token_handler import WrongTokenType
 
+from oidcmsg.message import Message
 from oidcmsg.oidc import AuthorizationRequest
 from oidcmsg.oidc import OpenIDRequest
 
@@ -289,3 +299,543 @@ class TestSessionDB(object):
         info2 = self.sdb[sid]
         assert info2["sub"] == \
                '62fb630e29f0d41b88e049ac0ef49a9c3ac5418c029d6e4f5417df7e9443976b'
+
+
+KEYJAR = build_keyjar([{"type": "RSA", "key": '', "use": ["sig"]}])
+
+
+class TestSessionDBJWTAccessToken(object):
+    @pytest.fixture(autouse=True)
+    def create_sdb(self):
+        _token_handler = token_handler.factory(
+            'losenord',
+            access_token={'class': JWTToken,
+                          'kwargs': {'keyjar': KEYJAR,
+                                     'issuer': 'https://example.com/'}})
+        self.sdb = SessionDB(InMemoryDataBase(), _token_handler, SSODb())
+
+    def test_is_token_valid(self):
+        ae = create_authn_event("uid", "salt")
+        sid = self.sdb.create_authz_session(ae, AREQ, client_id='client_id')
+        self.sdb.do_sub(sid, "client_salt")
+        grant = self.sdb[sid]["code"]
+        _info = self.sdb.upgrade_to_token(grant)
+        access_token = _info['access_token']
+
+        assert self.sdb.is_token_valid(access_token)
+        assert self.sdb.read(access_token)['client_id'] == 'client_id'
+
+        self.sdb.revoke_uid('uid')
+        assert not self.sdb.is_token_valid(access_token)
+
+    @pytest.mark.parametrize('codec', [None, CompactCodec()])
+    def test_is_token_valid_then_read(self, codec):
+        self.sdb._db = CountingDataBase()
+        if codec is not None:
+            self.sdb._db.native = False
+            self.sdb.codec = codec
+        ae = create_authn_event("uid", "salt")
+        sid = self.sdb.create_authz_session(ae, AREQ, client_id='client_id')
+        access_token = self.sdb.upgrade_to_token(
+            self.sdb[sid]["code"])['access_token']
+
+        _decoded = []
+        _decode = self.sdb._decode
+        self.sdb._decode = lambda value: _decoded.append(1) or _decode(value)
+        self.sdb._db.calls = 0
+        with self.sdb.unit_of_work():
+            assert self.sdb.is_token_valid(access_token)
+            # The session is not decoded to find out if it is revoked
+            assert _decoded == []
+            assert self.sdb.read(access_token)['client_id'] == 'client_id'
+        assert self.sdb._db.calls == 1
+        assert _decoded == [1]
+
+        self.sdb.update(sid, revoked=True)
+        assert not self.sdb.is_token_valid(access_token)
+        del self.sdb[sid]
+        assert not self.sdb.is_token_valid(access_token)
+
+    def test_revoke_token(self):
+        ae = create_authn_event("uid", "salt")
+        sid = self.sdb.create_authz_session(ae, AREQ, client_id='client_id')
+        grant = self.sdb[sid]["code"]
+        access_token = self.sdb.upgrade_to_token(grant)['access_token']
+
+        self.sdb.revoke_token(access_token)
+        assert not self.sdb.is_token_valid(access_token)
+
+
+class JSONDataBase(InMemoryDataBase):
+    native = False
+
+
+class TestSessionDBStorage(object):
+    @pytest.fixture(autouse=True,
+                    params=['native', 'json', 'sqlite', 'compact'])
+    def create_sdb(self, request, tmpdir):
+        _codec = None
+        if request.param == 'native':
+            self.db = InMemoryDataBase()
+        elif request.param == 'sqlite':
+            self.db = SQLiteDataBase(str(tmpdir.join('session.db')))
+        else:
+            self.db = JSONDataBase()
+            if request.param == 'compact':
+                _codec = CompactCodec()
+        self.sdb = SessionDB(self.db, token_handler.factory('losenord'),
+                             SSODb(), codec=_codec)
+
+    def test_stored_format(self):
+        ae = create_authn_event("uid", "salt")
+        sid = self.sdb.create_authz_session(ae, AREQ, client_id='client_id')
+        if self.db.native:
+            assert isinstance(self.db.get(sid), SessionInfo)
+        else:
+            assert isinstance(self.db.get(sid), (str, bytes))
+
+        info = self.sdb[sid]
+        assert isinstance(info, SessionInfo)
+        assert isinstance(info['authn_req'], AuthorizationRequest)
+        assert info['authn_req']['scope'] == ['openid']
+        assert info['authn_event']['uid'] == 'uid'
+
+    def test_read_returns_copy(self):
+        ae = create_authn_event("uid", "salt")
+        sid = self.sdb.create_authz_session(ae, AREQ, client_id='client_id')
+
+        info = self.sdb[sid]
+        info['client_id'] = 'other'
+        info['authn_req']['scope'].append('email')
+        info['authn_event']['uid'] = 'someone else'
+
+        info = self.sdb[sid]
+        assert info['client_id'] == 'client_id'
+        assert info['authn_req']['scope'] == ['openid']
+        assert info['authn_event']['uid'] == 'uid'
+
+    def test_write_stores_copy(self):
+        ae = create_authn_event("uid", "salt")
+        sid = self.sdb.create_authz_session(ae, AREQ, client_id='client_id')
+
+        info = self.sdb[sid]
+        info['state'] = 'written'
+        self.sdb[sid] = info
+        info['state'] = 'not written'
+        info['authn_req']['scope'].append('email')
+
+        info = self.sdb[sid]
+        assert info['state'] == 'written'
+        assert info['authn_req']['scope'] == ['openid']
+
+    def test_set_dict(self):
+        self.sdb['sid'] = {'oauth_state': 'authz', 'client_id': 'client_id',
+                           'authn_req': AREQ.to_dict(),
+                           'authn_event': create_authn_event('uid', 'salt')}
+        info = self.sdb['sid']
+        assert isinstance(info['authn_req'], AuthorizationRequest)
+        assert info['client_id'] == 'client_id'
+
+    def test_set_fields(self):
+        ae = create_authn_event("uid", "salt")
+        sid = self.sdb.create_authz_session(ae, AREQ, client_id='client_id')
+        _scope = ['openid', 'email']
+        self.sdb.set_fields(sid, revoked=True, access_token_scope=_scope)
+        _scope.append('phone')
+
+        info = self.sdb[sid]
+        assert info['revoked'] is True
+        assert info['access_token_scope'] == ['openid', 'email']
+        assert info['authn_req']['state'] == 'state000'
+
+    def test_set_fields_message(self):
+        ae = create_authn_event("uid", "salt")
+        sid = self.sdb.create_authz_session(ae, AREQ, client_id='client_id')
+        self.sdb.set_fields(sid, authn_req=AREQN.to_dict())
+        assert isinstance(self.sdb[sid]['authn_req'], AuthorizationRequest)
+        assert self.sdb[sid]['authn_req']['nonce'] == 'something'
+
+
+class MinimalDataBase(object):
+    """ Only the basic store interface, no set_fields """
+
+    def __init__(self):
+        self.db = {}
+
+    def get(self, key):
+        return self.db.get(key)
+
+    def set(self, key, value):
+        self.db[key] = value
+
+
+def test_set_fields_without_store_support():
+    sdb = SessionDB(MinimalDataBase(), token_handler.factory('losenord'),
+                    SSODb())
+    sdb['sid'] = {'oauth_state': 'authz', 'client_id': 'client_id',
+                  'authn_req': AREQ.to_dict(),
+                  'authn_event': create_authn_event('uid', 'salt')}
+    sdb.set_fields('sid', revoked=True)
+    assert sdb['sid']['revoked'] is True
+    assert sdb['sid']['client_id'] == 'client_id'
+
+
+class TestUnitOfWork(object):
+    @pytest.fixture(autouse=True)
+    def create_sdb(self):
+        self.sdb = SessionDB(InMemoryDataBase(),
+                             token_handler.factory('losenord'), SSODb())
+        ae = create_authn_event("uid", "salt")
+        self.sid = self.sdb.create_authz_session(ae, AREQ,
+                                                 client_id='client_id')
+
+    def test_read_once(self):
+        with self.sdb.unit_of_work():
+            info = self.sdb[self.sid]
+            del self.sdb._db.db[self.sid]
+            assert self.sdb[self.sid]['client_id'] == 'client_id'
+            # Still copies
+            info['client_id'] = 'other'
+            assert self.sdb[self.sid]['client_id'] == 'client_id'
+
+    def test_written_at_end(self):
+        with self.sdb.unit_of_work():
+            self.sdb.update(self.sid, user='diana')
+            assert self.sdb[self.sid]['user'] == 'diana'
+            assert 'user' not in self.sdb._db.get(self.sid)
+        assert self.sdb[self.sid]['user'] == 'diana'
+
+    def test_patch_without_read(self):
+        with self.sdb.unit_of_work() as uow:
+            self.sdb.update(self.sid, user='diana')
+            self.sdb.update(self.sid, revoked=True)
+            assert self.sid not in uow.sessions
+        info = self.sdb[self.sid]
+        assert info['user'] == 'diana'
+        assert info['revoked'] is True
+
+    def test_discarded_on_exception(self):
+        with pytest.raises(ValueError):
+            with self.sdb.unit_of_work():
+                self.sdb.update(self.sid, user='diana')
+                raise ValueError()
+        assert 'user' not in self.sdb[self.sid]
+
+    def test_nested(self):
+        with self.sdb.unit_of_work() as outer:
+            with self.sdb.unit_of_work():
+                self.sdb.update(self.sid, user='diana')
+            assert self.sdb.current_unit_of_work() is outer
+            assert 'user' not in self.sdb._db.get(self.sid)
+        assert self.sdb.current_unit_of_work() is None
+        assert self.sdb[self.sid]['user'] == 'diana'
+
+    def test_upgrade_to_token(self):
+        grant = self.sdb[self.sid]['code']
+        with self.sdb.unit_of_work():
+            _info = self.sdb.upgrade_to_token(grant, issue_refresh=True)
+            assert self.sdb.is_token_valid(_info['access_token'])
+            assert self.sdb[grant]['access_token'] == _info['access_token']
+            # The code is black listed at once
+            assert self.sdb.handler.is_black_listed(grant)
+        assert self.sdb[self.sid]['access_token'] == _info['access_token']
+
+    def test_side_writes_discarded_on_exception(self):
+        _token = self.sdb[self.sid]['code']
+        with pytest.raises(ValueError):
+            with self.sdb.unit_of_work():
+                self.sdb.do_sub(self.sid, 'client_salt')
+                self.sdb.map_kv2sid('nonce', 'abcdef', self.sid)
+                self.sdb.revoke_token(_token, 'code')
+                raise ValueError()
+        assert self.sdb.sso_db.get_sids_by_uid('uid') is None
+        assert self.sdb._indexed_sids('uid', {'client_id': 'client_id'}) == []
+        assert self.sdb.get_sid_by_kv('nonce', 'abcdef') is None
+        assert not self.sdb.handler.is_black_listed(_token)
+
+    def test_side_writes_at_end(self):
+        with self.sdb.unit_of_work():
+            self.sdb.do_sub(self.sid, 'client_salt')
+            self.sdb.update(self.sid, client_id='other')
+            assert self.sdb.sso_db.get_sids_by_uid('uid') is None
+        assert self.sdb.sso_db.get_sids_by_uid('uid') == [self.sid]
+        # Indexed as the session was written
+        assert self.sdb.match_session('uid', client_id='other') == self.sid
+        assert self.sdb._indexed_sids('uid', {'client_id': 'client_id'}) == []
+
+    def test_changes_made_meanwhile_kept(self):
+        with self.sdb.unit_of_work():
+            _info = self.sdb[self.sid]
+            _info['user'] = 'diana'
+            self.sdb[self.sid] = _info
+            # Revoked by another request
+            self.sdb._write_fields(self.sid, SessionInfo(revoked=True))
+        _info = self.sdb[self.sid]
+        assert _info['user'] == 'diana'
+        assert _info['revoked'] is True
+
+    def test_delete(self):
+        with self.sdb.unit_of_work():
+            self.sdb.update(self.sid, user='diana')
+            del self.sdb[self.sid]
+            assert self.sdb._db.get(self.sid) is not None
+            with pytest.raises(KeyError):
+                del self.sdb[self.sid]
+        assert self.sdb._db.get(self.sid) is None
+
+
+class TestSessionInfoLazy(object):
+    @pytest.fixture(autouse=True)
+    def create_info(self):
+        _authn_req = AREQ.to_dict()
+        _authn_req['extra'] = 'kept'
+        self.json = json.dumps({
+            'oauth_state': 'authz', 'client_id': 'client_id',
+            'authn_req': _authn_req,
+            'authn_event': create_authn_event('uid', 'salt').to_dict()})
+        self.info = SessionInfo().from_json(self.json)
+
+    def test_not_parsed_until_used(self):
+        assert self.info._lazy == {'authn_req', 'authn_event'}
+        assert self.info['client_id'] == 'client_id'
+        assert isinstance(self.info['authn_req'], AuthorizationRequest)
+        assert self.info._lazy == {'authn_event'}
+        assert self.info['authn_event']['uid'] == 'uid'
+        assert not self.info._lazy
+
+    def test_untouched_written_as_read(self):
+        self.info['revoked'] = True
+        _doc = json.loads(self.info.to_json())
+        assert _doc['authn_req'] == json.loads(self.json)['authn_req']
+        assert _doc['revoked'] is True
+        assert self.info._lazy == {'authn_req', 'authn_event'}
+
+    def test_copy(self):
+        _copy = copy_value(self.info)
+        _copy['authn_req']['state'] = 'other'
+        assert self.info._lazy == {'authn_req', 'authn_event'}
+        assert self.info['authn_req']['state'] == 'state000'
+
+    def test_set_and_update(self):
+        self.info['authn_req'] = AREQN
+        assert 'authn_req' not in self.info._lazy
+        self.info.update({'authn_req': AREQ.to_dict()})
+        assert isinstance(self.info['authn_req'], AuthorizationRequest)
+        assert self.info['authn_req']['state'] == 'state000'
+
+    def test_items_and_eq(self):
+        _items = dict(self.info.items())
+        assert isinstance(_items['authn_event'], Message)
+        assert SessionInfo().from_json(self.json) == self.info
+
+    def test_session_db_read(self):
+        sdb = SessionDB(JSONDataBase(), token_handler.factory('losenord'),
+                        SSODb())
+        sid = sdb.create_authz_session(create_authn_event('uid', 'salt'),
+                                       AREQ, client_id='client_id')
+        assert not sdb.is_session_revoked(sid)
+        assert 'authn_req' in sdb[sid]._lazy
+
+
+def test_sso_kept_as_long_as_session():
+    sso_store = InMemoryDataBase()
+    sdb = SessionDB(InMemoryDataBase(), token_handler.factory('losenord'),
+                    SSODb(sso_store, ttl=60))
+    sid = sdb.create_authz_session(create_authn_event('uid', 'salt'), AREQO,
+                                   client_id='client_id')
+    sdb.do_sub(sid, 'client_salt')
+    _dict = sdb.upgrade_to_token(sdb[sid]['code'], issue_refresh=True)
+    # As long as the refresh token
+    assert sso_store.ttl('__uid2sid__uid') > 86000
+
+    # The connections go before a refresh token is used again
+    for key in sso_store.keys():
+        sso_store._exp[key] = time.time() + 10
+    sdb.refresh_token(_dict['refresh_token'], new_refresh=True)
+    assert sso_store.ttl('__uid2sid__uid') > 86000
+    assert sso_store.ttl('__sid2sub__{}'.format(sid)) > 86000
+    assert sdb.match_session('uid', client_id='client_id') == sid
+
+
+class TestMatchSession(object):
+    @pytest.fixture(autouse=True)
+    def create_sdb(self):
+        self.sdb = SessionDB(InMemoryDataBase(),
+                             token_handler.factory('losenord'), SSODb())
+        self.sid = {}
+        for client_id in ['client_1', 'client_2', 'client_3']:
+            sid = self.sdb.create_authz_session(
+                create_authn_event("uid", "salt"), AREQ, client_id=client_id)
+            self.sdb.do_sub(sid, 'client_salt')
+            self.sid[client_id] = sid
+
+    def test_match(self):
+        for client_id, sid in self.sid.items():
+            assert self.sdb.match_session('uid', client_id=client_id) == sid
+        assert self.sdb.match_session('uid', client_id='other') is None
+
+    def test_index_used(self):
+        assert self.sdb._indexed_sids('uid', {'client_id': 'client_2'}) == [
+            self.sid['client_2']]
+        # Not indexed
+        assert self.sdb._indexed_sids('uid', {'state': 'state000'}) is None
+        assert self.sdb.match_session('uid', client_id='client_2',
+                                      state='state000') == self.sid['client_2']
+
+    def test_update_indexed_field(self):
+        self.sdb.update(self.sid['client_1'], client_id='client_4')
+        assert self.sdb.match_session('uid', client_id='client_1') is None
+        assert self.sdb.match_session(
+            'uid', client_id='client_4') == self.sid['client_1']
+
+    def test_delete(self):
+        del self.sdb[self.sid['client_3']]
+        assert self.sdb._indexed_sids('uid', {'client_id': 'client_3'}) == []
+
+    def test_delete_without_derived_keys(self):
+        sid = self.sid['client_3']
+        self.sdb._db.delete(self.sdb._derived_key(sid))
+        del self.sdb[sid]
+        assert self.sdb._indexed_sids('uid', {'client_id': 'client_3'}) == []
+
+    def test_index_expires(self):
+        _key = self.sdb._index_key('uid', 'client_id', 'client_2')
+        # Not shorter than the session it holds
+        assert self.sdb._db.ttl(_key) >= self.sdb._db.ttl(self.sid['client_2'])
+        # Once the sessions in it are gone so is the index
+        self.sdb._db.prune(when=time.time() + 100000, limit=0)
+        assert [k for k in self.sdb._db.keys()
+                if k.startswith('__index__')] == []
+
+    def test_expired_removed_from_index(self):
+        _old = []
+        for i in range(5):
+            sid = self.sdb.create_authz_session(
+                create_authn_event("uid", "salt"), AREQ, client_id='client_2')
+            self.sdb.do_sub(sid, 'client_salt')
+            _old.append(sid)
+        # Expire the sessions, the store forgets them
+        for sid in _old + [self.sid['client_2']]:
+            self.sdb._db._exp[sid] = 0
+        self.sdb._db.prune(limit=0)
+
+        sid = self.sdb.create_authz_session(
+            create_authn_event("uid", "salt"), AREQ, client_id='client_2')
+        self.sdb.do_sub(sid, 'client_salt')
+        assert self.sdb.match_session('uid', client_id='client_2') == sid
+        assert self.sdb._indexed_sids('uid', {'client_id': 'client_2'}) == [
+            sid]
+
+    def test_revoke_uid(self):
+        self.sdb.revoke_uid('uid')
+        assert self.sdb.match_session('uid', client_id='client_1') is None
+        assert self.sdb.match_session('uid') is None
+
+    def test_get_id_token(self):
+        self.sdb.update(self.sid['client_2'], id_token='id token')
+        assert self.sdb.get_id_token('uid', 'client_2') == 'id token'
+
+
+class CountingDataBase(InMemoryDataBase):
+    def __init__(self):
+        InMemoryDataBase.__init__(self)
+        self.calls = 0
+
+    def get(self, key):
+        self.calls += 1
+        return InMemoryDataBase.get(self, key)
+
+    def get_many(self, keys):
+        self.calls += 1
+        return {k: v for k, v in self.db.items() if k in keys}
+
+    def set_many(self, items, ttl=0):
+        self.calls += 1
+        InMemoryDataBase.set_many(self, items, ttl)
+
+
+class TestRevokeUids(object):
+    @pytest.fixture(autouse=True, params=['native', 'compact'])
+    def create_sdb(self, request):
+        self.db = CountingDataBase()
+        if request.param == 'compact':
+            # Binary records can not be patched, they are written back
+            self.db.native = False
+            _codec = CompactCodec()
+        else:
+            _codec = None
+        self.sdb = SessionDB(self.db, token_handler.factory('losenord'),
+                             SSODb(), codec=_codec)
+        self.sids = []
+        for uid in ['Lizz', 'Diana']:
+            for client_id in ['client_1', 'client_2', 'client_3']:
+                sid = self.sdb.create_authz_session(
+                    create_authn_event(uid, 'salt'), AREQ, client_id=client_id)
+                self.sdb.do_sub(sid, 'client_salt')
+                self.sids.append(sid)
+
+    def test_revoke_uids(self):
+        self.db.calls = 0
+        self.sdb.revoke_uids(['Lizz', 'Diana'])
+        # One read and at most one write, and one of when the sessions may
+        # be collected if that is kept in the store, whatever the number
+        # of sessions
+        assert self.db.calls <= (3 if self.sdb._persist_expiry else 2)
+        for sid in self.sids:
+            assert self.sdb.is_session_revoked(sid)
+        assert self.sdb.sso_db.get_sids_by_uid('Lizz') is None
+
+    def test_revoke_uid_unit_of_work(self):
+        with self.sdb.unit_of_work():
+            self.sdb.revoke_uid('Lizz')
+            assert self.sdb[self.sids[0]]['revoked'] is True
+        assert self.sdb.is_session_revoked(self.sids[0])
+        assert not self.sdb.is_session_revoked(self.sids[3])
+
+    def test_active_client_ids(self):
+        self.sdb.update(self.sids[1], revoked=True)
+        assert self.sdb.get_active_client_ids_for_uid('Lizz') == [
+            'client_1', 'client_3']
+        assert self.sdb.get_active_client_ids_for_uid('Ann') == []
+
+
+class TestSessionLifetime(object):
+    @pytest.fixture(autouse=True)
+    def create_sdb(self):
+        self.db = InMemoryDataBase()
+        _handler = token_handler.factory('losenord', token_expires_in=3600,
+                                         grant_expires_in=600,
+                                         refresh_token_expires_in=86400)
+        self.sdb = SessionDB(self.db, _handler, SSODb())
+
+    def _ttl(self, key):
+        return self.db._exp[key] - time.time()
+
+    def test_lifetime(self):
+        ae = create_authn_event("uid", "salt", expires_in=60)
+        sid = self.sdb.create_authz_session(ae, AREQ, client_id='client_id')
+        assert 590 < self._ttl(sid) <= 600
+        assert 590 < self._ttl('__state__state000__') <= 600
+
+        self.sdb.upgrade_to_token(key=sid)
+        assert 3590 < self._ttl(sid) <= 3600
+
+        self.sdb.upgrade_to_token(key=sid, issue_refresh=True)
+        assert 86390 < self._ttl(sid) <= 86400
+
+    def test_lifetime_authn_event(self):
+        ae = create_authn_event("uid", "salt", expires_in=7200)
+        sid = self.sdb.create_authz_session(ae, AREQ, client_id='client_id')
+        assert 7190 < self._ttl(sid) <= 7200
+
+    def test_expired_session(self):
+        ae = create_authn_event("uid", "salt", expires_in=60)
+        sid = self.sdb.create_authz_session(ae, AREQ, client_id='client_id')
+        self.sdb.do_sub(sid, 'client_salt')
+        self.db._exp[sid] = time.time() - 1
+
+        with pytest.raises(KeyError):
+            self.sdb[sid]
+        assert self.sdb.get_active_client_ids_for_uid('uid') == []
+        assert self.sdb.match_session('uid', client_id='client_id') is None
+        self.sdb.revoke_uid('uid')
@@ -0,0 +1,99 @@
+import json
+
+import pytest
+from oidcmsg.oidc import AuthorizationRequest
+
+from oidcendpoint.authn_event import create_authn_event
+from oidcendpoint.in_memory_db import InMemoryDataBase
+from oidcendpoint.session import SessionInfo
+from oidcendpoint.session_codec import CompactCodec
+
+AREQ = AuthorizationRequest(
+    response_type="code", client_id="client1",
+    redirect_uri="https://example.com/a/rather/long/path/to/the/callback",
+    scope=["openid", "email", "profile"], state="state000",
+    claims={'userinfo': {'email': {'essential': True}}})
+
+
+def session_info(**kwargs):
+    return SessionInfo(oauth_state='authz', client_id='client1',
+                       authn_req=AREQ,
+                       authn_event=create_authn_event('uid', 'salt'),
+                       **kwargs)
+
+
+class TestCompactCodec(object):
+    @pytest.fixture(autouse=True)
+    def create_codec(self):
+        self.refs = InMemoryDataBase()
+        self.codec = CompactCodec(self.refs)
+
+    def test_round_trip(self):
+        info = session_info(sub='sub', expires_in=3600, revoked=False,
+                            unknown_field=[1.5, -3, None, {'a': 'b'}])
+        _info = self.codec.decode(self.codec.encode(info), SessionInfo)
+        assert _info.to_dict() == info.to_dict()
+        assert isinstance(_info['authn_req'], AuthorizationRequest)
+        assert _info['authn_req']['claims'].to_dict() == {
+            'userinfo': {'email': {'essential': True}}}
+
+    @pytest.mark.parametrize('token', [
+        'A.kid.Z0FBQUFBQnEwb3lS', 'A.kid.not base64', 'Z0FBQUFBQnEwb3lS',
+        'T.kid.eyJhbGciOiJSUzI1NiJ9.eyJzdWIiOiJmb28ifQ.c2ln', 'A..'])
+    def test_token(self, token):
+        info = session_info(access_token=token)
+        _info = self.codec.decode(self.codec.encode(info), SessionInfo)
+        assert _info['access_token'] == token
+
+    def test_smaller_than_json(self):
+        info = session_info()
+        assert len(self.codec.encode(info)) < len(info.to_json()) / 2
+
+    def test_shared_values_stored_once(self):
+        self.codec.encode(session_info(sub='a'))
+        _len = len(self.refs)
+        assert _len
+        self.codec.encode(session_info(sub='b'))
+        assert len(self.refs) == _len
+
+    def test_per_authorization_values_not_shared(self):
+        self.codec.encode(session_info())
+        _len = len(self.refs)
+        for i in range(10):
+            _areq = AuthorizationRequest(**AREQ.to_dict())
+            _areq['claims'] = {'userinfo': {'email': {'value': str(i)}}}
+            _areq['request'] = 'eyJhbGciOiJub25lIn0.{}{}.'.format('x' * 40, i)
+            _info = session_info()
+            _info['authn_req'] = _areq
+            _value = self.codec.encode(_info)
+            assert self.codec.decode(_value, SessionInfo)['authn_req'][
+                'request'] == _areq['request']
+        assert len(self.refs) == _len
+        assert len(self.codec._known) == _len
+
+    def test_other_instance(self):
+        # A codec in another process only has the refs store
+        _value = self.codec.encode(session_info())
+        _info = CompactCodec(self.refs).decode(_value, SessionInfo)
+        assert _info['authn_req']['redirect_uri'] == AREQ['redirect_uri']
+
+    def test_missing_shared_value(self):
+        _value = self.codec.encode(session_info())
+        with pytest.raises(KeyError):
+            CompactCodec().decode(_value, SessionInfo)
+
+    def test_field(self):
+        info = session_info(sub='sub', expires_in=3600, revoked=True,
+                            access_token='A.kid.Z0FBQUFBQnEwb3lS',
+                            unknown_field=[1.5, -3, None, {'a': 'b'}])
+        _value = self.codec.encode(info)
+        # Shared values are not needed
+        _codec = CompactCodec(InMemoryDataBase())
+        assert _codec.field(_value, 'revoked') is True
+        assert _codec.field(_value, 'unknown_field') == [1.5, -3, None,
+                                                         {'a': 'b'}]
+        assert _codec.field(_value, 'verified_logout') is None
+
+    def test_unknown_type(self):
+        with pytest.raises(ValueError):
+            self.codec.encode(session_info(other=json))
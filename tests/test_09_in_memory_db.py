@@ -0,0 +1,187 @@
+import time
+
+import pytest
+from oidcmsg.oidc import AuthorizationRequest
+
+from oidcendpoint import token_handler
+from oidcendpoint.authn_event import create_authn_event
+from oidcendpoint.in_memory_db import InMemoryDataBase
+from oidcendpoint.in_memory_db import LRUDataBase
+from oidcendpoint.session import SessionDB
+from oidcendpoint.sso_db import SSODb
+
+AREQ = AuthorizationRequest(response_type="code", client_id="client1",
+                            redirect_uri="http://example.com/authz",
+                            scope=["openid"], state="state000")
+
+
+def test_set_get_delete():
+    db = InMemoryDataBase()
+    db.set('key', 'value')
+    assert db.get('key') == 'value'
+    db.delete('key')
+    assert db.get('key') is None
+
+
+def test_ttl():
+    db = InMemoryDataBase()
+    db.set('short', 'value', ttl=60)
+    db.set('forever', 'value')
+    assert db.get('short') == 'value'
+
+    db._exp['short'] = time.time() - 1
+    assert db.get('short') is None
+    assert 'short' not in db.db
+    assert db.get('forever') == 'value'
+
+
+def test_ttl_removed_by_set():
+    db = InMemoryDataBase()
+    db.set('key', 'value', ttl=60)
+    db.set('key', 'other')
+    assert db.prune(when=time.time() + 120, limit=0) == 1
+    assert db.get('key') == 'other'
+
+
+def test_ttl_renewed():
+    db = InMemoryDataBase()
+    db.set('key', 'value', ttl=60)
+    db.set('key', 'value', ttl=600)
+    db.prune(when=time.time() + 120, limit=0)
+    assert db.get('key') == 'value'
+
+
+def test_prune_bounded():
+    db = InMemoryDataBase(sweep=4)
+    for i in range(10):
+        db.set('key{}'.format(i), i, ttl=60)
+
+    assert db.prune(when=time.time() + 61) == 4
+    assert len(db) == 6
+    assert db.prune(when=time.time() + 61, limit=0) == 6
+    assert len(db) == 0
+
+
+def test_swept_on_set():
+    db = InMemoryDataBase(sweep=2)
+    for i in range(4):
+        db.set('key{}'.format(i), i, ttl=60)
+    for key in list(db._exp):
+        db._exp[key] = 0
+    db._heap = [(0, k) for _, k in db._heap]
+
+    db.set('new', 'value')
+    assert len(db) == 3
+    db.set('newer', 'value')
+    assert set(db.db.keys()) == {'new', 'newer'}
+
+
+def test_set_fields_keeps_ttl():
+    db = InMemoryDataBase()
+    db.set('key', {'a': 1}, ttl=60)
+    db.set_fields('key', b=2)
+    assert db.get('key') == {'a': 1, 'b': 2}
+    assert 'key' in db._exp
+
+
+def test_heap_compacted():
+    db = InMemoryDataBase()
+    for i in range(1000):
+        db.set('key', i, ttl=60)
+    assert len(db._heap) < 100
+    assert db.get('key') == 999
+
+
+def test_get_set_many():
+    db = InMemoryDataBase()
+    db.set_many([('a', 1), ('b', 2)], ttl=60)
+    db.set('c', 3, ttl=0.01)
+    time.sleep(0.02)
+    assert db.get_many(['a', 'b', 'c', 'd']) == {'a': 1, 'b': 2}
+    assert db._exp['a'] > time.time()
+
+
+class TestLRUDataBase(object):
+    @pytest.fixture(autouse=True)
+    def create_db(self, tmpdir):
+        self.db = LRUDataBase(str(tmpdir.join('overflow')), max_entries=3)
+        yield
+        self.db.close()
+
+    def test_spill_and_fault_in(self):
+        for i in range(5):
+            self.db.set('key{}'.format(i), {'value': i})
+        assert len(self.db) == 5
+        assert len(self.db.db) == 3
+        assert not self.db.in_memory('key0')
+
+        assert self.db.get('key0') == {'value': 0}
+        assert self.db.in_memory('key0')
+        # key2 was the least recently used one
+        assert not self.db.in_memory('key2')
+        assert len(self.db.db) == 3
+        assert len(self.db) == 5
+
+    def test_recently_used_stays(self):
+        for i in range(3):
+            self.db.set('key{}'.format(i), i)
+        self.db.get('key0')
+        self.db.set('key3', 3)
+        assert self.db.in_memory('key0')
+        assert not self.db.in_memory('key1')
+
+    def test_delete_spilled(self):
+        for i in range(5):
+            self.db.set('key{}'.format(i), i)
+        self.db.delete('key0')
+        assert self.db.get('key0') is None
+        assert len(self.db) == 4
+        with pytest.raises(KeyError):
+            self.db.delete('key0')
+
+    def test_set_spilled(self):
+        for i in range(5):
+            self.db.set('key{}'.format(i), i)
+        self.db.set('key0', 'new')
+        assert self.db.get('key0') == 'new'
+        assert len(self.db) == 5
+
+    def test_set_fields_spilled(self):
+        self.db.set('session', {'a': 1})
+        for i in range(5):
+            self.db.set('key{}'.format(i), i)
+        self.db.set_fields('session', b=2)
+        assert self.db.get('session') == {'a': 1, 'b': 2}
+
+    def test_expired_on_disk(self):
+        self.db.set('session', 'value', ttl=60)
+        for i in range(5):
+            self.db.set('key{}'.format(i), i)
+        assert not self.db.in_memory('session')
+
+        self.db.prune(when=time.time() + 61, limit=0)
+        assert self.db.get('session') is None
+        assert len(self.db) == 5
+
+    def test_byte_budget(self, tmpdir):
+        db = LRUDataBase(str(tmpdir.join('bytes')), max_entries=0,
+                         max_bytes=100)
+        for i in range(10):
+            db.set('key{}'.format(i), 'x' * 30)
+        assert len(db.db) == 3
+        assert db.get('key0') == 'x' * 30
+        assert db._bytes <= 100
+        db.close()
+
+    def test_session_db(self):
+        sdb = SessionDB(self.db, token_handler.factory('password'), SSODb())
+        sids = []
+        for i in range(5):
+            ae = create_authn_event('uid', 'salt')
+            sids.append(sdb.create_authz_session(ae, AREQ,
+                                                 client_id='client_id'))
+
+        assert not self.db.in_memory(sids[0])
+        info = sdb[sids[0]]
+        assert isinstance(info['authn_req'], AuthorizationRequest)
+        assert sdb.is_token_valid(info['code'])
@@ -0,0 +1,233 @@
+import time
+
+import pytest
+from oidcmsg.oidc import AuthorizationRequest
+
+from oidcendpoint import token_handler
+from oidcendpoint.authn_event import create_authn_event
+from oidcendpoint.in_memory_db import InMemoryDataBase
+from oidcendpoint.session import SessionDB
+from oidcendpoint.session_gc import SessionGC
+from oidcendpoint.shelve_wrapper import ShelfWrapper
+from oidcendpoint.sqlite_db import SQLiteDataBase
+from oidcendpoint.sqlite_db import SQLiteSSODb
+from oidcendpoint.sso_db import SSODb
+
+AREQ = AuthorizationRequest(response_type="code", client_id="client1",
+                            redirect_uri="http://example.com/authz",
+                            scope=["openid"], state="state000")
+
+LATER = 100000
+
+
+class TestCollect(object):
+    @pytest.fixture(autouse=True, params=['memory', 'sqlite'])
+    def create_sdb(self, request, tmpdir):
+        if request.param == 'sqlite':
+            _filename = str(tmpdir.join('session.db'))
+            self.db = SQLiteDataBase(_filename)
+            _sso_db = SQLiteSSODb(_filename)
+        else:
+            self.db = InMemoryDataBase()
+            _sso_db = SSODb()
+        self.sdb = SessionDB(self.db, token_handler.factory('losenord'),
+                             _sso_db)
+        SessionGC(self.sdb)
+        self.sdb.revoked_ttl = 0
+
+    def _create(self, uid='uid', state='state000'):
+        _areq = AuthorizationRequest(**AREQ.to_dict())
+        _areq['state'] = state
+        sid = self.sdb.create_authz_session(create_authn_event(uid, 'salt'),
+                                            _areq, client_id='client1')
+        self.sdb.do_sub(sid, 'client_salt')
+        return sid
+
+    def _gone(self, sid, uid='uid', state='state000'):
+        assert self.db.get(sid) is None
+        assert self.sdb.get_sid_by_kv('state', state) is None
+        assert self.db.get(self.sdb._derived_key(sid)) is None
+        assert self.sdb.sso_db.get_uid_by_sid(sid) is None
+        assert self.sdb.sso_db.get_sub_by_sid(sid) is None
+        assert sid not in (self.sdb.sso_db.get_sids_by_uid(uid) or [])
+        assert self.sdb.match_session(uid, client_id='client1') is None
+
+    def test_revoked(self):
+        sid = self._create()
+        _keep = self._create('other', 'state001')
+        _code = self.sdb[sid]['code']
+        self.sdb.revoke_session(sid)
+
+        assert self.sdb.collect(when=time.time() + 1) == 1
+        self._gone(sid)
+        assert self.sdb.handler.is_black_listed(_code)
+        assert self.sdb.match_session('other', client_id='client1') == _keep
+
+    def test_revoked_uids(self):
+        sid = self._create()
+        self.sdb.revoke_uids(['uid'])
+        assert self.sdb.collect(when=time.time() + 1) == 1
+        self._gone(sid)
+
+    def test_revoked_grace(self):
+        self.sdb.revoked_ttl = 600
+        sid = self._create()
+        self.sdb.update(sid, revoked=True)
+        assert self.sdb.collect(when=time.time() + 1) == 0
+        assert self.sdb.is_session_revoked(sid)
+        assert self.sdb.collect(when=time.time() + 601) == 1
+
+    def test_live_session_kept(self):
+        sid = self._create()
+        assert self.sdb.collect(when=time.time() + LATER) == 0
+        assert self.sdb[sid]['client_id'] == 'client1'
+        # Looked at again when it expires
+        assert self.sdb._expires[sid] > time.time()
+
+    def test_limit(self):
+        for i in range(5):
+            self.sdb.update(self._create('uid{}'.format(i),
+                                         'state{}'.format(i)), revoked=True)
+        assert self.sdb.collect(limit=2, when=time.time() + 1) == 2
+        assert self.sdb.collect(when=time.time() + 1) == 3
+
+    def test_delete(self):
+        sid = self._create()
+        del self.sdb[sid]
+        self._gone(sid)
+        with pytest.raises(KeyError):
+            del self.sdb[sid]
+
+
+class TestExpired(object):
+    @pytest.fixture(autouse=True)
+    def create_sdb(self):
+        self.db = InMemoryDataBase()
+        self.sdb = SessionDB(self.db, token_handler.factory('losenord'),
+                             SSODb())
+        SessionGC(self.sdb)
+        self.sid = self.sdb.create_authz_session(
+            create_authn_event('uid', 'salt'), AREQ, client_id='client1')
+        self.sdb.do_sub(self.sid, 'client_salt')
+
+    def test_expired_in_store(self):
+        self.db._exp[self.sid] = time.time() - 1
+        assert self.sdb.collect(when=time.time() + LATER) == 1
+        assert self.sdb.sso_db.get_sids_by_uid('uid') is None
+        assert self.sdb.get_sid_by_kv('state', 'state000') is None
+        # Nothing else left
+        assert len(self.db) == 0
+
+    def test_store_without_ttl(self):
+        # Nothing expires in the store, so a session is removed when due
+        self.db.supports_ttl = False
+        assert self.sdb.collect(when=time.time() + LATER) == 1
+        assert self.db.get(self.sid) is None
+
+    def test_nothing_due(self):
+        assert self.sdb.collect() == 0
+        assert self.sdb[self.sid]
+
+
+class TestRestart(object):
+    """
+    The SessionDB is created again, as after a restart, between the
+    sessions being written and collected.
+    """
+
+    @pytest.fixture(autouse=True, params=['sqlite', 'shelve'])
+    def create_sdb(self, request, tmpdir):
+        self.kind = request.param
+        _filename = str(tmpdir.join('session'))
+        if self.kind == 'sqlite':
+            self.db = SQLiteDataBase(_filename)
+            self.sso_db = SQLiteSSODb(_filename)
+        else:
+            self.db = ShelfWrapper(_filename)
+            self.sso_db = SSODb(ShelfWrapper(_filename + '.sso'))
+        sdb = self._restart()
+        self.sid = sdb.create_authz_session(
+            create_authn_event('uid', 'salt'), AREQ, client_id='client1')
+        sdb.do_sub(self.sid, 'client_salt')
+
+    def _restart(self):
+        sdb = SessionDB(self.db, token_handler.factory('losenord'),
+                        self.sso_db)
+        SessionGC(sdb)
+        return sdb
+
+    def test_expired(self):
+        if self.kind == 'sqlite':
+            self.db._write('UPDATE session SET exp = ? WHERE key = ?',
+                           (time.time() - 1, self.sid))
+
+        sdb = self._restart()
+        assert sdb.collect(when=time.time() + LATER) == 1
+        assert sdb.sso_db.get_sids_by_uid('uid') is None
+        assert sdb.match_session('uid', client_id='client1') is None
+        # Nothing else left
+        assert len(self.db) == 0
+
+    def test_live_session_kept(self):
+        sdb = self._restart()
+        assert sdb.collect(when=time.time() + 1) == 0
+        assert sdb.match_session('uid', client_id='client1') == self.sid
+        assert sdb.collect(when=time.time() + LATER) == (
+            0 if self.kind == 'sqlite' else 1)
+
+
+def test_nothing_kept_without_gc():
+    db = InMemoryDataBase()
+    sdb = SessionDB(db, token_handler.factory('losenord', grant_expires_in=1),
+                    SSODb())
+    for i in range(50):
+        _areq = AuthorizationRequest(**AREQ.to_dict())
+        _areq['state'] = 'state{}'.format(i)
+        sid = sdb.create_authz_session(
+            create_authn_event('uid', 'salt', expires_in=1), _areq,
+            client_id='client1')
+        sdb.do_sub(sid, 'client_salt')
+
+    # The store removes what has expired, nothing is kept in the process
+    assert not sdb._expires
+    db.prune(when=time.time() + 10, limit=0)
+    assert [k for k in db.keys() if k.startswith('__')] == []
+
+
+def test_session_gc():
+    sdb = SessionDB(InMemoryDataBase(), token_handler.factory('losenord'),
+                    SSODb())
+    sdb.revoked_ttl = 0
+    gc = SessionGC(sdb, interval=60)
+    sid = sdb.create_authz_session(create_authn_event('uid', 'salt'), AREQ,
+                                   client_id='client1')
+    sdb.update(sid, revoked=True)
+    time.sleep(0.01)
+    assert gc.tick() == 1
+    # Not until the interval has passed
+    sdb.update(sdb.create_authz_session(create_authn_event('uid', 'salt'),
+                                        AREQ, client_id='client2'),
+               revoked=True)
+    time.sleep(0.01)
+    assert gc.tick() == 0
+    assert gc.run() == 1
+
+
+def test_session_gc_thread():
+    sdb = SessionDB(InMemoryDataBase(), token_handler.factory('losenord'),
+                    SSODb())
+    sdb.revoked_ttl = 0
+    gc = SessionGC(sdb, interval=0.01)
+    sid = sdb.create_authz_session(create_authn_event('uid', 'salt'), AREQ,
+                                   client_id='client1')
+    sdb.update(sid, revoked=True)
+
+    gc.start()
+    try:
+        for _ in range(100):
+            if sdb._db.get(sid) is None:
+                break
+            time.sleep(0.01)
+    finally:
+        gc.stop()
+    assert sdb._db.get(sid) is None
@@ -0,0 +1,207 @@
+import time
+
+import pytest
+from oidcmsg.oidc import AuthorizationRequest
+
+from oidcendpoint import token_handler
+from oidcendpoint.authn_event import create_authn_event
+from oidcendpoint.in_memory_db import InMemoryDataBase
+from oidcendpoint.session import SessionDB
+from oidcendpoint.session_gc import SessionGC
+from oidcendpoint.sharded_db import HashRing
+from oidcendpoint.sharded_db import ShardedDataBase
+from oidcendpoint.shelve_wrapper import ShelfWrapper
+from oidcendpoint.sqlite_db import SQLiteDataBase
+from oidcendpoint.sso_db import SSODb
+from oidcendpoint.thread_safe import ThreadSafeDataBase
+
+AREQ = AuthorizationRequest(response_type="code", client_id="client1",
+                            redirect_uri="http://example.com/authz",
+                            scope=["openid"], state="state000")
+
+KEYS = ['key {}'.format(i) for i in range(3000)]
+
+
+def test_hash_ring():
+    ring = HashRing(['a', 'b', 'c'])
+    _owner = {key: ring.node(key) for key in KEYS}
+    for node in 'abc':
+        assert 600 < list(_owner.values()).count(node) < 1400
+
+    # Same answer every time
+    assert HashRing(['c', 'b', 'a']).node('key 42') == _owner['key 42']
+
+    # Only keys that go to the new node move
+    ring.add('d')
+    _moved = [key for key in KEYS if ring.node(key) != _owner[key]]
+    assert 400 < len(_moved) < 1200
+    assert {ring.node(key) for key in _moved} == {'d'}
+
+    ring.remove('d')
+    assert all(ring.node(key) == _owner[key] for key in KEYS)
+
+
+class TestShardedDataBase(object):
+    @pytest.fixture(autouse=True)
+    def create_db(self, tmpdir):
+        self.tmpdir = tmpdir
+        self.db = ShardedDataBase({
+            'memory': InMemoryDataBase(),
+            'sqlite': SQLiteDataBase(str(tmpdir.join('shard.db')))})
+
+    def test_set_get_delete(self):
+        for key in KEYS[:100]:
+            self.db.set(key, key.upper())
+        assert self.db.get('key 42') == 'KEY 42'
+        assert len(self.db) == 100
+        assert 20 < len(self.db.shards['memory']) < 80
+
+        self.db.delete('key 42')
+        assert self.db.get('key 42') is None
+        with pytest.raises(KeyError):
+            self.db.delete('key 42')
+
+    def test_capabilities(self):
+        assert not self.db.native
+        assert self.db.supports_ttl
+        assert hasattr(self.db, 'set_fields')
+        assert hasattr(self.db, 'ttl')
+        # Not all the stores can batch writes or have locks
+        assert not hasattr(self.db, 'batch')
+        assert not hasattr(self.db, 'lock')
+
+        self.db.add_shard('shelve',
+                          ShelfWrapper(str(self.tmpdir.join('shard'))))
+        assert not self.db.supports_ttl
+        assert not hasattr(self.db, 'set_fields')
+        assert not hasattr(self.db, 'ttl')
+
+        assert ShardedDataBase({'a': InMemoryDataBase(),
+                                'b': InMemoryDataBase()}).native
+
+    def test_many(self):
+        self.db.set_many([(key, key.upper()) for key in KEYS[:200]], ttl=60)
+        _res = self.db.get_many(KEYS[:200] + ['other'])
+        assert len(_res) == 200
+        assert _res['key 199'] == 'KEY 199'
+
+    def test_ttl(self):
+        for key in KEYS[:100]:
+            self.db.set(key, 'value', ttl=60)
+        assert all(55 < self.db.ttl(key) <= 60 for key in KEYS[:100])
+        self.db.set('forever', 'value')
+        assert self.db.ttl('forever') == 0
+
+    def test_set_fields(self):
+        self.db.set('key', '{"a": 1}')
+        self.db.set_fields('key', b=2)
+        assert self.db.get('key') == '{"a": 1, "b": 2}'
+
+    def test_add_shard(self):
+        for key in KEYS[:300]:
+            self.db.set(key, key.upper(), ttl=60)
+        _new = InMemoryDataBase()
+
+        # Everything can be read while the keys have not been moved
+        self.db.add_shard('new', _new, rebalance=False)
+        assert all(self.db.get(key) == key.upper() for key in KEYS[:300])
+        assert len(self.db.get_many(KEYS[:300])) == 300
+
+        assert self.db.rebalance() == len(_new)
+        assert 40 < len(_new) < 160
+        assert len(self.db) == 300
+        for key in _new.keys():
+            assert 55 < _new.ttl(key) <= 60
+        for name, shard in self.db.shards.items():
+            assert all(self.db.ring.node(key) == name for key in shard.keys())
+        assert all(self.db.get(key) == key.upper() for key in KEYS[:300])
+
+    def test_write_during_move(self):
+        for key in KEYS[:300]:
+            self.db.set(key, 'old')
+        self.db.add_shard('new', InMemoryDataBase(), rebalance=False)
+        _moving = [k for k in KEYS[:300] if self.db.ring.node(k) == 'new']
+
+        self.db.set(_moving[0], 'new')
+        self.db.delete(_moving[1])
+        self.db.rebalance()
+        assert self.db.get(_moving[0]) == 'new'
+        assert self.db.get(_moving[1]) is None
+        assert self.db.get(_moving[2]) == 'old'
+
+
+def test_batch(tmpdir):
+    _files = [str(tmpdir.join('shard{}.db'.format(i))) for i in range(2)]
+    db = ShardedDataBase({str(i): SQLiteDataBase(f)
+                          for i, f in enumerate(_files)})
+    with pytest.raises(ValueError):
+        with db.batch():
+            for key in KEYS[:10]:
+                db.set(key, 'value')
+            raise ValueError()
+    assert db.get_many(KEYS[:10]) == {}
+
+    with db.batch():
+        for key in KEYS[:10]:
+            db.set(key, 'value')
+    assert sum(len(SQLiteDataBase(f)) for f in _files) == 10
+
+
+def test_mixed_shards(tmpdir):
+    db = ShardedDataBase({
+        'memory': InMemoryDataBase(),
+        'shelve': ShelfWrapper(str(tmpdir.join('shard'))),
+        'sqlite': SQLiteDataBase(str(tmpdir.join('shard.db')))})
+    for key in KEYS[:100]:
+        db.set(key, key.upper(), ttl=60)
+    assert all(db.get(key) == key.upper() for key in KEYS[:100])
+    assert all(len(s) for s in db.shards.values())
+    db.delete('key 1')
+    assert db.get('key 1') is None
+
+
+def test_session_db(tmpdir):
+    db = ShardedDataBase({
+        'memory': InMemoryDataBase(),
+        'sqlite': SQLiteDataBase(str(tmpdir.join('shard.db')))})
+    sdb = SessionDB(db, token_handler.factory('losenord'),
+                    SSODb(ShardedDataBase({
+                        'a': InMemoryDataBase(),
+                        'b': SQLiteDataBase(str(tmpdir.join('sso.db')))})))
+    SessionGC(sdb)
+    sdb.revoked_ttl = 0
+    _sids = []
+    for i in range(10):
+        sid = sdb.create_authz_session(create_authn_event('uid', 'salt'),
+                                       AREQ, client_id='client{}'.format(i))
+        sdb.do_sub(sid, 'client_salt')
+        _sids.append(sid)
+
+    assert sdb.match_session('uid', client_id='client7') == _sids[7]
+    sdb.revoke_uid('uid')
+    assert sdb.is_session_revoked(_sids[3])
+    assert sdb.collect(when=time.time() + 1) == 10
+    assert len(db) == 0
+
+
+def test_locks():
+    db = ShardedDataBase({str(i): ThreadSafeDataBase(InMemoryDataBase())
+                          for i in range(3)})
+    assert db.lock('key 1') is db.shard('key 1').lock('key 1')
+    with db.lock_many(KEYS[:100]):
+        assert db.lock('key 42')._is_owned()
+        # Re-entrant
+        db.set('key 42', 'value')
+
+
+def test_sso_db(tmpdir):
+    sso_db = SSODb(ShardedDataBase({
+        'memory': InMemoryDataBase(),
+        'sqlite': SQLiteDataBase(str(tmpdir.join('shard.db')))}), ttl=60)
+    for i in range(20):
+        sso_db.map_sid('session id {}'.format(i), uid='uid', sub='sub')
+    sso_db.remove_session_id('session id 3')
+
+    assert len(sso_db.get_sids_by_uid('uid')) == 19
+    assert sso_db.get_uid_by_sid('session id 7') == 'uid'
+    assert sso_db.get_subs_by_uids(['uid']) == {'uid': {'sub'}}
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from oidcendpoint import shelve_wrapper
+
+
+class TestShelfWrapper(object):
+    @pytest.fixture(autouse=True)
+    def create_shelf(self, tmpdir):
+        self.filename = str(tmpdir.join('cdb'))
+        self.db = shelve_wrapper.open(self.filename)
+
+    def test_set_get(self):
+        self.db['client'] = {'client_secret': 'hemligt'}
+        assert 'client' in self.db
+        assert self.db['client'] == {'client_secret': 'hemligt'}
+        assert self.db.get('other') is None
+        assert self.db.keys() == ['client']
+        del self.db['client']
+        assert len(self.db) == 0
+
+    def test_one_handle(self):
+        self.db['client'] = 'info'
+        _handle = self.db._db
+        assert self.db['client'] == 'info'
+        assert self.db._db is _handle
+
+    def test_sync_every(self):
+        self.db.sync_every = 3
+        self.db['a'] = 1
+        self.db['b'] = 2
+        assert self.db._writes == 2
+        self.db['c'] = 3
+        assert self.db._writes == 0
+
+    def test_close_and_reopen(self):
+        self.db.sync_every = 0
+        self.db['client'] = 'info'
+        self.db.sync()
+        assert shelve_wrapper.open(self.filename)['client'] == 'info'
+
+        self.db.close()
+        assert self.db['client'] == 'info'
+
+    def test_forked_child(self):
+        self.db['parent'] = 'info'
+
+        pid = os.fork()
+        if pid == 0:  # child
+            try:
+                ok = self.db['parent'] == 'info'
+                self.db['child'] = 'info'
+                self.db.close()
+            finally:
+                os._exit(0 if ok else 1)
+
+        _, status = os.waitpid(pid, 0)
+        assert status == 0
+        assert shelve_wrapper.open(self.filename)['child'] == 'info'
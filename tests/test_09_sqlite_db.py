@@ -0,0 +1,109 @@
+import json
+import time
+
+import pytest
+from oidcmsg.oidc import AuthorizationRequest
+
+from oidcendpoint import token_handler
+from oidcendpoint.authn_event import create_authn_event
+from oidcendpoint.session import SessionDB
+from oidcendpoint.sqlite_db import SQLiteDataBase
+from oidcendpoint.sqlite_db import SQLiteSSODb
+
+AREQ = AuthorizationRequest(response_type="code", client_id="client1",
+                            redirect_uri="http://example.com/authz",
+                            scope=["openid"], state="state000")
+
+
+class TestSQLiteDataBase(object):
+    @pytest.fixture(autouse=True)
+    def create_db(self, tmpdir):
+        self.filename = str(tmpdir.join('session.db'))
+        self.db = SQLiteDataBase(self.filename)
+
+    def test_set_get_delete(self):
+        self.db.set('key', 'value')
+        assert self.db.get('key') == 'value'
+        self.db.delete('key')
+        assert self.db.get('key') is None
+        with pytest.raises(KeyError):
+            self.db.delete('key')
+
+    def test_ttl(self):
+        self.db.set('short', 'value', ttl=60)
+        self.db.set('forever', 'value')
+        assert len(self.db) == 2
+
+        assert self.db.prune(when=time.time() + 120) == 1
+        assert self.db.get('short') is None
+        assert self.db.get('forever') == 'value'
+
+    def test_expired_not_returned(self):
+        self.db.set('key', 'value', ttl=0.01)
+        time.sleep(0.02)
+        assert self.db.get('key') is None
+        assert len(self.db) == 0
+
+    def test_set_fields(self):
+        self.db.set('key', json.dumps({'a': 1, 'b': {'c': 2}}))
+        self.db.set_fields('key', a=[1, 2], d='new')
+        assert json.loads(self.db.get('key')) == {'a': [1, 2], 'b': {'c': 2},
+                                                  'd': 'new'}
+        with pytest.raises(KeyError):
+            self.db.set_fields('other', a=1)
+
+    def test_get_set_many(self):
+        self.db.set_many([('key{}'.format(i), str(i)) for i in range(1200)],
+                         ttl=60)
+        self.db.set('expired', 'value', ttl=0.01)
+        time.sleep(0.02)
+        _keys = ['key{}'.format(i) for i in range(1200)]
+        _res = self.db.get_many(_keys + ['expired', 'other'])
+        assert len(_res) == 1200
+        assert _res['key1199'] == '1199'
+
+    def test_batch(self):
+        with self.db.batch():
+            self.db.set('a', '1')
+            with self.db.batch():
+                self.db.set('b', '2')
+            # Not committed until the outermost batch ends
+            assert SQLiteDataBase(self.filename).get('a') is None
+
+        assert SQLiteDataBase(self.filename).get('b') == '2'
+
+    def test_batch_rollback(self):
+        with pytest.raises(ValueError):
+            with self.db.batch():
+                self.db.set('a', '1')
+                raise ValueError()
+        assert self.db.get('a') is None
+
+    def test_shared(self):
+        self.db.set('key', 'value')
+        assert SQLiteDataBase(self.filename).get('key') == 'value'
+
+    def test_tables(self):
+        other = SQLiteDataBase(self.filename, table='other')
+        self.db.set('key', 'value')
+        assert other.get('key') is None
+
+
+def test_session_db(tmpdir):
+    _filename = str(tmpdir.join('session.db'))
+    sdb = SessionDB(SQLiteDataBase(_filename),
+                    token_handler.factory('losenord'),
+                    SQLiteSSODb(_filename))
+    ae = create_authn_event('uid', 'salt')
+    sid = sdb.create_authz_session(ae, AREQ, client_id='client1')
+    sdb.do_sub(sid, 'salt')
+
+    other = SessionDB(SQLiteDataBase(_filename),
+                      token_handler.factory('losenord'),
+                      SQLiteSSODb(_filename))
+    assert other[sid]['authn_req']['state'] == 'state000'
+    assert other.sso_db.get_sids_by_uid('uid') == [sid]
+
+    with other.unit_of_work():
+        other.set_fields(sid, revoked=True)
+    assert sdb.is_session_revoked(sid)
@@ -0,0 +1,141 @@
+import copy
+import json
+import threading
+import time
+
+import pytest
+from oidcmsg.oidc import AuthorizationRequest
+
+from oidcendpoint import token_handler
+from oidcendpoint.authn_event import create_authn_event
+from oidcendpoint.in_memory_db import InMemoryDataBase
+from oidcendpoint.session import SessionDB
+from oidcendpoint.session_codec import CompactCodec
+from oidcendpoint.sso_db import SSODb
+from oidcendpoint.thread_safe import StripedLocks
+from oidcendpoint.thread_safe import ThreadSafeDataBase
+
+AREQ = AuthorizationRequest(response_type="code", client_id="client1",
+                            redirect_uri="http://example.com/authz",
+                            scope=["openid"], state="state000")
+
+THREADS = 8
+
+
+class SlowDataBase(InMemoryDataBase):
+    """
+    Values are copies, as with a store that serializes them, and another
+    thread is likely to run between a read and a write.
+    """
+    native = False
+
+    def get(self, key):
+        _val = InMemoryDataBase.get(self, key)
+        time.sleep(0)
+        return copy.deepcopy(_val)
+
+    def set_fields(self, key, **kwargs):
+        _doc = json.loads(self.get(key))
+        _doc.update(kwargs)
+        self.set(key, json.dumps(_doc))
+
+
+def run_threads(func, n=THREADS):
+    _threads = [threading.Thread(target=func, args=(i,)) for i in range(n)]
+    for thread in _threads:
+        thread.start()
+    for thread in _threads:
+        thread.join()
+
+
+def test_sso_db():
+    sso_db = SSODb(ThreadSafeDataBase(SlowDataBase()))
+
+    def login(n):
+        for i in range(50):
+            sso_db.map_sid('session {} {}'.format(n, i), uid='Lizz',
+                           sub='sub {}'.format(i % 3))
+
+    run_threads(login)
+    assert len(sso_db.get_sids_by_uid('Lizz')) == THREADS * 50
+    assert len(sso_db.get_sids_by_sub('sub 0')) == THREADS * 17
+    assert sso_db.get_uid_by_sid('session 3 7') == 'Lizz'
+
+    def logout(n):
+        for i in range(50):
+            sso_db.remove_session_id('session {} {}'.format(n, i))
+
+    run_threads(logout)
+    assert sso_db.get_sids_by_uid('Lizz') is None
+    assert sso_db.get_subs_by_uid('Lizz') == set()
+
+
+class TestSessionDB(object):
+    @pytest.fixture(autouse=True, params=['json', 'compact'])
+    def create_sdb(self, request):
+        if request.param == 'compact':
+            _codec = CompactCodec()
+        else:
+            _codec = None
+        self.sdb = SessionDB(ThreadSafeDataBase(SlowDataBase()),
+                             token_handler.factory('losenord'),
+                             SSODb(ThreadSafeDataBase(SlowDataBase())),
+                             codec=_codec)
+
+    def test_set_fields(self):
+        sid = self.sdb.create_authz_session(create_authn_event('uid', 'salt'),
+                                            AREQ, client_id='client1')
+
+        def update(n):
+            for i in range(20):
+                self.sdb.update(sid, **{'field_{}_{}'.format(n, i): i})
+
+        run_threads(update)
+        _info = self.sdb[sid]
+        for n in range(THREADS):
+            assert _info['field_{}_19'.format(n)] == 19
+        assert _info['client_id'] == 'client1'
+
+    def test_index(self):
+        _sids = []
+
+        def login(n):
+            for i in range(10):
+                sid = self.sdb.create_authz_session(
+                    create_authn_event('uid', 'salt{}'.format(i)), AREQ,
+                    client_id='client1')
+                self.sdb.do_sub(sid, 'client_salt')
+                _sids.append(sid)
+
+        run_threads(login)
+        assert len(set(_sids)) == THREADS * 10
+        assert set(self.sdb._indexed_sids(
+            'uid', {'client_id': 'client1'})) == set(_sids)
+
+
+def test_striped_locks_many():
+    locks = StripedLocks(8)
+    _keys = ['key {}'.format(i) for i in range(32)]
+    _count = [0]
+
+    def work(n):
+        # Overlapping sets of keys, given in different orders
+        _mine = _keys[n:] + _keys[:n]
+        for _ in range(100):
+            with locks.many(_mine[:5]):
+                _count[0] += 1
+
+    run_threads(work)
+    assert _count[0] == THREADS * 100
+
+
+def test_optional_methods():
+    class Plain(object):
+        def get(self, key):
+            return None
+
+    db = ThreadSafeDataBase(Plain())
+    assert not hasattr(db, 'set_fields')
+    assert not hasattr(db, 'get_many')
+    assert hasattr(ThreadSafeDataBase(InMemoryDataBase()), 'set_fields')
+    assert ThreadSafeDataBase(InMemoryDataBase()).native
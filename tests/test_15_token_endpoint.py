@@ -17,6 +17,7 @@ from oidcendpoint.oidc.registration import Registration
 from oidcendpoint.oidc.token import AccessToken
 from oidcendpoint.authn_event import create_authn_event
 from oidcendpoint.endpoint_context import EndpointContext
+from oidcendpoint.in_memory_db import InMemoryDataBase
 from oidcendpoint.user_authn.authn_context import INTERNETPROTOCOLPASSWORD
 from oidcendpoint.user_info import UserInfo
 
@@ -70,6 +71,20 @@ def full_path(local_file):
 USERINFO = UserInfo(json.loads(open(full_path('users.json')).read()))
 
 
+class RecordingDataBase(InMemoryDataBase):
+    def __init__(self):
+        InMemoryDataBase.__init__(self)
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append(('get', key))
+        return InMemoryDataBase.get(self, key)
+
+    def set(self, key, value, ttl=0):
+        self.calls.append(('set', key))
+        InMemoryDataBase.set(self, key, value, ttl)
+
+
 def setup_session(endpoint_context, areq):
     authn_event = create_authn_event(uid="uid", salt='salt',
                              authn_info=INTERNETPROTOCOLPASSWORD,
@@ -183,3 +198,22 @@ class TestEndpoint(object):
         msg = self.endpoint.do_response(request=_req, **_resp)
         assert isinstance(msg, dict)
 
+    def test_process_request_one_write(self):
+        session_id = setup_session(self.endpoint.endpoint_context, AUTH_REQ)
+        _context = self.endpoint.endpoint_context
+        _context.sdb.update(session_id, user='diana')
+        _token_request = TOKEN_REQ_DICT.copy()
+        _token_request['code'] = _context.sdb[session_id]['code']
+        _req = self.endpoint.parse_request(_token_request)
+
+        _db = RecordingDataBase()
+        _db.db = _context.sdb._db.db
+        _db._exp = _context.sdb._db._exp
+        _context.sdb._db = _db
+
+        _resp = self.endpoint.process_request(request=_req)
+        assert 'access_token' in _resp['response_args']
+        # Read again when the changes are written back, changes made
+        # meanwhile by others are kept
+        assert _db.calls == [('get', session_id), ('get', session_id),
+                             ('set', session_id)]
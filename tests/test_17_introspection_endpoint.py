@@ -0,0 +1,175 @@
+import json
+import time
+
+import pytest
+from cryptojwt.key_jar import build_keyjar
+from oidcmsg.oidc import AuthorizationRequest
+
+from oidcendpoint.authn_event import AuthnEvent
+from oidcendpoint.client_authn import verify_client
+from oidcendpoint.endpoint_context import EndpointContext
+from oidcendpoint.oidc.introspection import Introspection
+from oidcendpoint.oidc.revocation import Revocation
+from oidcendpoint.user_authn.authn_context import INTERNETPROTOCOLPASSWORD
+
+KEYDEFS = [
+    {"type": "RSA", "key": '', "use": ["sig"]},
+    {"type": "EC", "crv": "P-256", "use": ["sig"]}
+]
+
+KEYJAR = build_keyjar(KEYDEFS)
+
+AUTH_REQ = AuthorizationRequest(client_id='client_1',
+                                redirect_uri='https://example.com/cb',
+                                scope=['openid', 'email'],
+                                state='STATE',
+                                response_type='code')
+
+CLIENT_AUTHN = {'client_id': 'client_1', 'client_secret': 'hemligt'}
+
+
+def setup_session(endpoint_context, areq):
+    authn_event = AuthnEvent(uid="uid", salt='salt',
+                             authn_info=INTERNETPROTOCOLPASSWORD,
+                             time_stamp=time.time())
+    sid = endpoint_context.sdb.create_authz_session(authn_event, areq,
+                                                    client_id='client_1')
+    endpoint_context.sdb.do_sub(sid, '')
+    return sid
+
+
+class TestEndpoint(object):
+    @pytest.fixture(autouse=True)
+    def create_endpoint(self):
+        conf = {
+            "issuer": "https://example.com/",
+            "password": "mycket hemligt",
+            "token_expires_in": 600,
+            "grant_expires_in": 300,
+            "refresh_token_expires_in": 86400,
+            "verify_ssl": False,
+            'endpoint': {
+                'introspection': {
+                    'path': '{}/introspection',
+                    'class': Introspection,
+                    'kwargs': {'cache_size': 16}
+                },
+                'revocation': {
+                    'path': '{}/revocation',
+                    'class': Revocation,
+                    'kwargs': {}
+                }
+            },
+            'client_authn': verify_client,
+            'template_dir': 'template'
+        }
+        self.endpoint_context = EndpointContext(conf, keyjar=KEYJAR)
+        for client_id in ['client_1', 'client_2']:
+            self.endpoint_context.cdb[client_id] = {
+                "client_secret": 'hemligt',
+                "redirect_uris": [("https://example.com/cb", None)],
+                "client_salt": "salted",
+                'token_endpoint_auth_method': 'client_secret_post',
+                'response_types': ['code']
+            }
+        self.introspection = self.endpoint_context.endpoint['introspection']
+        self.revocation = self.endpoint_context.endpoint['revocation']
+
+    def _access_token(self):
+        session_id = setup_session(self.endpoint_context, AUTH_REQ)
+        return self.endpoint_context.sdb.upgrade_to_token(
+            key=session_id, issue_refresh=True)
+
+    def _introspect(self, token):
+        _req = self.introspection.parse_request(
+            dict(CLIENT_AUTHN, token=token))
+        _resp = self.introspection.process_request(_req)
+        return json.loads(
+            self.introspection.do_response(**_resp)['response'])
+
+    def _revoke(self, tokens, **kwargs):
+        _args = dict(CLIENT_AUTHN)
+        _args.update(kwargs)
+        _req = self.revocation.parse_request(dict(_args, token=tokens))
+        _resp = self.revocation.process_request(_req)
+        return self.revocation.do_response(**_resp)
+
+    def test_provider_info(self):
+        _pinfo = self.endpoint_context.provider_info
+        assert _pinfo['introspection_endpoint'].endswith('/introspection')
+        assert _pinfo['revocation_endpoint'].endswith('/revocation')
+
+    def test_introspect_active(self):
+        _info = self._access_token()
+        _resp = self._introspect(_info['access_token'])
+        assert _resp['active'] is True
+        assert _resp['client_id'] == 'client_1'
+        assert _resp['scope'] == 'openid email'
+        assert _resp['token_type'] == 'Bearer'
+        assert _resp['iss'] == 'https://example.com/'
+        assert _resp['sub'] == _info['sub']
+        assert _resp['exp'] > time.time()
+
+    def test_introspect_refresh_token(self):
+        _info = self._access_token()
+        _resp = self._introspect(_info['refresh_token'])
+        assert _resp['active'] is True
+        assert _resp['client_id'] == 'client_1'
+        assert _resp['sub'] == _info['sub']
+
+        self._revoke([_info['refresh_token']])
+        assert self._introspect(_info['refresh_token']) == {'active': False}
+
+    def test_introspect_revoked_session(self):
+        session_id = setup_session(self.endpoint_context, AUTH_REQ)
+        _info = self.endpoint_context.sdb.upgrade_to_token(
+            key=session_id, issue_refresh=True)
+        self.endpoint_context.sdb.update(session_id, revoked=True)
+        assert self._introspect(_info['refresh_token']) == {'active': False}
+        assert self._introspect(_info['access_token']) == {'active': False}
+
+    def test_introspect_unknown(self):
+        assert self._introspect('no such token') == {'active': False}
+
+    def test_introspect_code(self):
+        session_id = setup_session(self.endpoint_context, AUTH_REQ)
+        _code = self.endpoint_context.sdb[session_id]['code']
+        assert self._introspect(_code) == {'active': False}
+
+    def test_introspect_cached(self):
+        _token = self._access_token()['access_token']
+        self._introspect(_token)
+        _resp = self._introspect(_token)
+        assert _resp['active'] is True
+        assert self.introspection.cache.hits == 1
+
+    def test_cached_result_revoked(self):
+        _token = self._access_token()['access_token']
+        assert self._introspect(_token)['active'] is True
+        self._revoke([_token])
+        assert self._introspect(_token) == {'active': False}
+
+    def test_revoke_many(self):
+        _info = self._access_token()
+        _other = self._access_token()
+        _resp = self._revoke([_info['access_token'], _info['refresh_token'],
+                              _other['access_token'], 'no such token'])
+        assert json.loads(_resp['response']) == {}
+
+        _sdb = self.endpoint_context.sdb
+        for token in [_info['access_token'], _info['refresh_token'],
+                      _other['access_token']]:
+            assert _sdb.handler.is_black_listed(token)
+        assert _sdb.is_token_valid(_other['access_token']) is False
+
+    def test_revoke_with_hint(self):
+        _info = self._access_token()
+        self._revoke([_info['refresh_token']],
+                     token_type_hint='access_token')
+        assert self.endpoint_context.sdb.handler.is_black_listed(
+            _info['refresh_token'])
+
+    def test_revoke_other_clients_token(self):
+        _info = self._access_token()
+        self._revoke([_info['access_token']], client_id='client_2')
+        assert self.endpoint_context.sdb.is_token_valid(_info['access_token'])